@@ -1,6 +1,10 @@
-from .instruction import Op, Instruction, Label, Program, Fn
+from .instruction import Op, Instruction, Label, Program, Fn, Code, VerifyError
 from .parser import parse
 from .runtime import State, execute
 from .compiler import compile
 
-from . import syscall
\ No newline at end of file
+from . import syscall
+from . import threaded
+from . import transpiler
+from . import cfg
+from . import profile
\ No newline at end of file
@@ -0,0 +1,248 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from .instruction import Op, Instruction, Label, Program, Fn, JUMPS
+
+
+# Control-flow graph of a single function. Blocks are built from the symbolic
+# Program.source, so a graph can be edited and lowered back into a Program.
+
+@dataclass
+class Block:
+    index: int
+    labels: List[Label] = field(default_factory=list)
+    instructions: List[Instruction] = field(default_factory=list)
+    # block reached by falling through the last instruction
+    fallthrough: Optional[int] = None
+    # block reached by taking the jump at the end of the block
+    target: Optional[int] = None
+    predecessors: List[int] = field(default_factory=list)
+
+    @property
+    def successors(self):
+        return [b for b in (self.fallthrough, self.target) if b is not None]
+
+    @property
+    def terminator(self):
+        if self.instructions and self.instructions[-1].op in (*JUMPS, Op.RET, Op.LEAVE):
+            return self.instructions[-1]
+        return None
+
+
+@dataclass
+class Loop:
+    header: int
+    blocks: set
+    parent: Optional['Loop'] = None
+    children: List['Loop'] = field(default_factory=list)
+
+    @property
+    def depth(self):
+        return 1 if self.parent is None else self.parent.depth + 1
+
+
+@dataclass
+class Graph:
+    fn: Fn
+    name: Label
+    blocks: List[Block]
+    # immediate dominator of every block (None for the entry and unreachable blocks)
+    idom: List[Optional[int]] = field(default_factory=list)
+    # reverse postorder of reachable blocks
+    order: List[int] = field(default_factory=list)
+    loops: List[Loop] = field(default_factory=list)
+    # innermost loop of every block
+    loop_of: List[Optional[Loop]] = field(default_factory=list)
+
+    def build(source, fn):
+        '''Splits source[fn.start:fn.end] into basic blocks'''
+        assert type(source[fn.start - 1]) is Label
+        blocks = [Block(0)]
+        labels = {}
+        for i in range(fn.start, fn.end):
+            instruction = source[i]
+            current = blocks[-1]
+            if type(instruction) is Label:
+                if current.instructions:
+                    current = Block(len(blocks))
+                    blocks.append(current)
+                current.labels.append(instruction)
+                labels[instruction.name] = current.index
+                continue
+
+            if current.terminator is not None:
+                current = Block(len(blocks))
+                blocks.append(current)
+            current.instructions.append(instruction)
+
+        for block in blocks:
+            last = block.terminator
+            if last is None or last.op not in (Op.JMP, Op.RET, Op.LEAVE):
+                if block.index + 1 < len(blocks):
+                    block.fallthrough = block.index + 1
+            if last is not None and last.op in JUMPS:
+                block.target = labels[last.args[0].name]
+            for successor in block.successors:
+                blocks[successor].predecessors.append(block.index)
+
+        graph = Graph(fn, source[fn.start - 1], blocks)
+        graph.compute_dominators()
+        graph.compute_loops()
+        return graph
+
+    def compute_dominators(self):
+        # Cooper, Harvey, Kennedy: "A Simple, Fast Dominance Algorithm"
+        order = []
+        visited = [False] * len(self.blocks)
+        stack = [(0, iter(self.blocks[0].successors))]
+        visited[0] = True
+        while stack:
+            block, successors = stack[-1]
+            for successor in successors:
+                if not visited[successor]:
+                    visited[successor] = True
+                    stack.append((successor, iter(self.blocks[successor].successors)))
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        order.reverse()
+        self.order = order
+
+        rpo = [None] * len(self.blocks)
+        for i, block in enumerate(order):
+            rpo[block] = i
+
+        idom = [None] * len(self.blocks)
+        idom[0] = 0
+        changed = True
+        while changed:
+            changed = False
+            for block in order[1:]:
+                new = None
+                for p in self.blocks[block].predecessors:
+                    if idom[p] is None:
+                        continue
+                    if new is None:
+                        new = p
+                        continue
+                    a, b = p, new
+                    while a != b:
+                        while rpo[a] > rpo[b]:
+                            a = idom[a]
+                        while rpo[b] > rpo[a]:
+                            b = idom[b]
+                    new = a
+                if idom[block] != new:
+                    idom[block] = new
+                    changed = True
+        idom[0] = None
+        self.idom = idom
+
+    def dominates(self, a, b):
+        while b is not None:
+            if a == b:
+                return True
+            b = self.idom[b]
+        return False
+
+    def compute_loops(self):
+        loops = {}
+        for block in self.order:
+            for successor in self.blocks[block].successors:
+                if not self.dominates(successor, block):
+                    continue
+                # back edge block -> successor, collect the natural loop
+                loop = loops.setdefault(successor, Loop(successor, {successor}))
+                worklist = [block]
+                while worklist:
+                    b = worklist.pop()
+                    if b not in loop.blocks:
+                        loop.blocks.add(b)
+                        worklist.extend(self.blocks[b].predecessors)
+
+        # inner loops are smaller than the loops containing them
+        self.loops = sorted(loops.values(), key=lambda loop: len(loop.blocks))
+        self.loop_of = [None] * len(self.blocks)
+        for loop in self.loops:
+            for b in loop.blocks:
+                inner = self.loop_of[b]
+                if inner is None:
+                    self.loop_of[b] = loop
+                    continue
+                while inner.parent is not None:
+                    inner = inner.parent
+                if inner is not loop:
+                    inner.parent = loop
+                    loop.children.append(inner)
+
+    def loop_depth(self, block):
+        loop = self.loop_of[block]
+        return 0 if loop is None else loop.depth
+
+    def live_at_entry(self):
+        '''Variables the function may read before storing them: its args and
+        the locals that are still 0 from ENTER when they are read'''
+        reads = {}
+        writes = {}
+        for block in self.blocks:
+            read, written = set(), set()
+            for instruction in block.instructions:
+                if instruction.op in (Op.LOAD, Op.INC_LOCAL, Op.LIST_PUSH_CONST) and \
+                        instruction.args[0] not in written:
+                    read.add(instruction.args[0])
+                if instruction.op in (Op.STORE, Op.INC_LOCAL):
+                    written.add(instruction.args[0])
+            reads[block.index] = read
+            writes[block.index] = written
+
+        live = {block.index: set() for block in self.blocks}
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(self.blocks):
+                out = set().union(*(live[s] for s in block.successors))
+                live_in = reads[block.index] | (out - writes[block.index])
+                if live_in != live[block.index]:
+                    live[block.index] = live_in
+                    changed = True
+        return live[self.blocks[0].index]
+
+    def lower(self):
+        '''Returns the symbolic instructions of the function in the order of
+        self.blocks, adding jumps for fallthrough edges that are no longer
+        followed by their successor. The ENTER block has to stay first and
+        the LEAVE block last.'''
+        by_index = {block.index: block for block in self.blocks}
+        jumps = {}
+        for i, block in enumerate(self.blocks):
+            following = self.blocks[i + 1].index if i + 1 < len(self.blocks) else None
+            if block.fallthrough is not None and block.fallthrough != following:
+                jumps[block.index] = Instruction(Op.JMP, self.label(by_index[block.fallthrough]))
+
+        instructions = [self.name]
+        for block in self.blocks:
+            instructions += block.labels
+            instructions += block.instructions
+            if block.index in jumps:
+                instructions.append(jumps[block.index])
+        return instructions
+
+    def label(self, block):
+        if not block.labels:
+            block.labels.append(Label.gen(f'{self.name.name}_bb'))
+        return block.labels[0]
+
+
+def build(program):
+    '''Builds a control-flow graph for every function of the program'''
+    return {
+        name: Graph.build(program.source, fn)
+        for name, fn in program.functions.items()
+    }
+
+
+def lower(graphs, entrypoint='main'):
+    graphs = sorted(graphs.values(), key=lambda graph: graph.fn.start)
+    instructions = [i for graph in graphs for i in graph.lower()]
+    return Program.build(instructions, entrypoint)
@@ -3,6 +3,9 @@ from dataclasses import dataclass, field
 from lark import Tree
 
 from . import syscall
+from . import optimizer
+from . import refcount
+from .refcount import FRESH, OWNED, BORROWED, GLOBAL, MAIN
 from .instruction import Program, Instruction, Op, Label
 
 
@@ -12,6 +15,14 @@ class Compiler:
     globals: set = field(default_factory=set)
     locals: list = field(default_factory=lambda: [set()])
     is_fn: bool = field(default=False)
+    ownership: refcount.Ownership = field(default=None)
+    fn: str = field(default=MAIN)
+    # hidden locals in use
+    temps: int = field(default=0)
+    # (scope, name) of the list variables known to be 0
+    null: set = field(default_factory=set)
+    # functions returning a value
+    returns: set = field(default_factory=set)
 
     def push(self, instruction):
         self.instructions.append(instruction)
@@ -19,19 +30,128 @@ class Compiler:
     def push_op(self, op, *args):
         self.push(Instruction(op, *args))
 
+    def push_syscall(self, name):
+        self.push_op(Op.SYSCALL, syscall.number_by_name(name))
+
+    def temp(self):
+        name = f'__tmp{self.temps}'
+        self.temps += 1
+        return name
+
+    def kind(self, ast):
+        return self.ownership.kind(self.fn, ast)
+
+    def list_var(self, var):
+        scope = self.ownership.scope(self.fn, var)
+        load = Op.GLOAD if scope is GLOBAL else Op.LOAD
+        return (scope, var), load
+
+    def ref_top(self):
+        tmp = self.temp()
+        self.push_op(Op.STORE, tmp)
+        self.push_op(Op.LOAD, tmp)
+        self.push_syscall('list_ref')
+        self.push_op(Op.LOAD, tmp)
+        self.temps -= 1
+
+    def keep(self, ast):
+        '''Compiles a value that is stored, a list gets a reference for the
+        place it is stored in'''
+        kind = self.kind(ast)
+        self.compile(ast)
+        if kind in (FRESH, BORROWED):
+            self.ref_top()
+
+    def borrow(self, ast, across_call=False):
+        '''Compiles an operand. A list the operand creates is held by a hidden
+        local until release, which frees it after the operand is used.'''
+        kind = self.kind(ast)
+        self.compile(ast)
+        if kind is None:
+            return None
+        if kind is BORROWED:
+            # the callee may reassign a global, so it is referenced for the call
+            key, _ = self.list_var(ast.children[0].value)
+            if not across_call or key[0] is not GLOBAL:
+                return None
+
+        tmp = self.temp()
+        if kind is OWNED and self.instructions[-1] == Instruction(Op.LOAD, tmp):
+            # a literal, it is still held by the same hidden local
+            return tmp
+        self.push_op(Op.STORE, tmp)
+        if kind is not OWNED:
+            self.push_op(Op.LOAD, tmp)
+            self.push_syscall('list_ref')
+        self.push_op(Op.LOAD, tmp)
+        return tmp
+
+    def release(self, temps):
+        for tmp in reversed(temps):
+            if tmp is None:
+                continue
+            self.push_op(Op.LOAD, tmp)
+            self.push_syscall('list_unref')
+            self.temps -= 1
+
+    def unref(self, var):
+        key, load = self.list_var(var)
+        if key in self.null:
+            return
+        self.push_op(load, var)
+        self.push_syscall('list_unref')
+
+    def leave_scope(self, moved=None):
+        # variables of main live until the exit
+        if self.fn == MAIN:
+            return
+        for var in self.ownership.locals(self.fn):
+            if var != moved:
+                self.unref(var)
+
+    def clear_null(self, globals_only=False):
+        # a loop may come back with the variables assigned, a call may assign
+        # any global
+        if globals_only:
+            self.null = {key for key in self.null if key[0] is not GLOBAL}
+        else:
+            self.null.clear()
+
     def compile(self, ast):
         assert type(ast) is Tree, ast
         handler = getattr(self, ast.data, None) or getattr(self, ast.data + '_')
         handler(ast)
 
+    def statement(self, ast):
+        self.compile(ast)
+        if ast.data != 'call':
+            return
+        name = ast.children[0].value
+        s = syscall.by_name(name)
+        if s[1].returns_value if s is not None else name in self.returns:
+            # the result of a call statement is dropped, the stack has to be
+            # balanced for the verifier (see Program.verify)
+            if self.kind(ast) is OWNED:
+                self.push_syscall('list_unref')
+            else:
+                self.push_op(Op.STORE, '__discard')
+
     def program(self, ast):
+        self.ownership = refcount.analyze(ast)
+        self.returns = {
+            node.children[0].value for node in ast.children
+            if node.data == 'function' and len(node.children) == 4
+        }
         main_marked = False
         for node in ast.children:
             if not main_marked and node.data not in ('global', 'function'):
                 self.push(Label('main'))
                 self.push_op(Op.ENTER, 'proc')
+                self.fn = MAIN
+                self.null = {(MAIN, var) for var in self.ownership.locals(MAIN)}
+                self.null |= {(GLOBAL, var) for var in self.ownership.locals(GLOBAL)}
                 main_marked = True
-            self.compile(node)
+            self.statement(node)
 
         self.push_op(Op.CONST, 0)
         self.push_op(Op.SYSCALL, syscall.number_by_name('exit'))
@@ -55,19 +175,27 @@ class Compiler:
         self.locals.append(set(args))
         self.push_op(Op.ENTER, "fn" if ret else "proc", *args)
         self.is_fn = ret is not None
-        self.compile(body)
+        self.fn = name.value
+        self.null = {(self.fn, var) for var in self.ownership.locals(self.fn)}
+        self.statement(body)
         if not ret:
+            self.leave_scope()
             self.push_op(Op.RET)
         self.push_op(Op.LEAVE)
         self.locals.pop()
 
     def block(self, ast):
         for statement in ast.children:
-            self.compile(statement)
+            self.statement(statement)
 
     def assign(self, ast):
         var, op, expr = ast.children
-        self.compile(expr)
+        self.keep(expr)
+        if self.ownership.is_list_var(self.fn, var.value):
+            # the old value loses its reference
+            self.unref(var.value)
+            self.null.discard(self.list_var(var.value)[0])
+
         if var.value in self.locals[-1]:
             op = Op.STORE
         elif var.value in self.globals:
@@ -81,16 +209,18 @@ class Compiler:
 
     def assign_at(self, ast):
         location, idx, op, expr = ast.children
-        self.compile(expr)
+        self.keep(expr)
         self.compile(idx)
-        self.compile(location)
+        tmp = self.borrow(location)
         self.push_op(Op.SYSCALL, syscall.number_by_name('list_set'))
+        self.release([tmp])
 
     def list_at(self, ast):
         location, idx = ast.children
         self.compile(idx)
-        self.compile(location)
+        tmp = self.borrow(location)
         self.push_op(Op.SYSCALL, syscall.number_by_name('list_get'))
+        self.release([tmp])
 
     def var_expr(self, ast):
         var = ast.children[0].value
@@ -110,25 +240,35 @@ class Compiler:
         val = ord(ast.children[0].value)
         self.push_op(Op.CONST, val)
 
-    def list_lit(self, ast):
+    def new_list(self):
+        # literals are built in a hidden local holding a reference, so nested
+        # literals don't clobber each other and the result is OWNED
+        tmp = self.temp()
         self.push_op(Op.SYSCALL, syscall.number_by_name('list'))
-        self.push_op(Op.STORE, '__list_lit')
+        self.push_op(Op.STORE, tmp)
+        self.push_op(Op.LOAD, tmp)
+        self.push_syscall('list_ref')
+        return tmp
+
+    def list_lit(self, ast):
+        tmp = self.new_list()
         values = ast.children
         for val in values:
-            self.compile(val)
-            self.push_op(Op.LOAD, '__list_lit')
+            self.keep(val)
+            self.push_op(Op.LOAD, tmp)
             self.push_op(Op.SYSCALL, syscall.number_by_name('push'))
-        self.push_op(Op.LOAD, '__list_lit')
+        self.push_op(Op.LOAD, tmp)
+        self.temps -= 1
 
     def str_lit(self, ast):
-        self.push_op(Op.SYSCALL, syscall.number_by_name('list'))
-        self.push_op(Op.STORE, '__str_lit')
+        tmp = self.new_list()
         assert len(ast.children) == 1
         for c in literal_eval(ast.children[0]):
             self.push_op(Op.CONST, ord(c))
-            self.push_op(Op.LOAD, '__str_lit')
+            self.push_op(Op.LOAD, tmp)
             self.push_op(Op.SYSCALL, syscall.number_by_name('push'))
-        self.push_op(Op.LOAD, '__str_lit')
+        self.push_op(Op.LOAD, tmp)
+        self.temps -= 1
 
     def if_else(self, ast):
         condition, if_true, *if_false = ast.children
@@ -136,7 +276,7 @@ class Compiler:
         false = Label.gen('if_false')
         end = Label.gen('if_end')
         self.push_op(Op.JZ, false if len(if_false) else end)
-        self.compile(if_true)
+        self.statement(if_true)
 
         if len(if_false):
             self.push_op(Op.JMP, end)
@@ -148,13 +288,13 @@ class Compiler:
             self.compile(condition)
             false = Label.gen('if_false')
             self.push_op(Op.JZ, false)
-            self.compile(body)
+            self.statement(body)
             self.push_op(Op.JMP, end)
             i += 2
 
         if i != len(if_false):
             self.push(false)
-            self.compile(if_false[-1])
+            self.statement(if_false[-1])
 
         self.push(end)
 
@@ -164,7 +304,8 @@ class Compiler:
         while_body = Label.gen('while_body')
         self.push_op(Op.JMP, cond_start)
         self.push(while_body)
-        self.compile(body)
+        self.clear_null()
+        self.statement(body)
         self.push(cond_start)
         self.compile(condition)
         self.push_op(Op.JNZ, while_body)
@@ -173,7 +314,8 @@ class Compiler:
         body, condition = ast.children
         start = Label.gen('do_while')
         self.push(start)
-        self.compile(body)
+        self.clear_null()
+        self.statement(body)
         self.compile(condition)
         self.push_op(Op.JNZ, start)
 
@@ -181,11 +323,12 @@ class Compiler:
         initialization, condition, step, body = ast.children
         for_cond = Label.gen('for_cond')
         for_body = Label.gen('for_body')
-        self.compile(initialization)
+        self.statement(initialization)
         self.push_op(Op.JMP, for_cond)
         self.push(for_body)
-        self.compile(body)
-        self.compile(step)
+        self.clear_null()
+        self.statement(body)
+        self.statement(step)
         self.push(for_cond)
         self.compile(condition)
         self.push_op(Op.JNZ, for_body)
@@ -195,9 +338,25 @@ class Compiler:
         if len(ast.children):
             assert self.is_fn, f'Attempt to return value from procedure at {ast.line}:{ast.column}'
             ret = ast.children[0]
-            self.compile(ret)
+            if self.fn in self.ownership.list_fns and self.kind(ret) is BORROWED and \
+                    self.list_var(ret.children[0].value)[0][0] is not GLOBAL:
+                # the reference of the local moves to the caller
+                self.compile(ret)
+                self.leave_scope(moved=ret.children[0].value)
+            elif self.fn in self.ownership.list_fns:
+                # the caller releases the value, so anything but a list that
+                # already carries a reference gets one, untyped values too
+                kind = self.kind(ret)
+                self.compile(ret)
+                if kind is not OWNED:
+                    self.ref_top()
+                self.leave_scope()
+            else:
+                self.keep(ret)
+                self.leave_scope()
         else:
             assert not self.is_fn, f'No return value in function at {ast.line}:{ast.column}'
+            self.leave_scope()
         self.push_op(Op.RET)
 
     def pass_(self, ast):
@@ -206,14 +365,24 @@ class Compiler:
 
     def call(self, ast):
         name, *args = ast.children
-        for arg in reversed(args):
-            self.compile(arg)
-
-        number = syscall.number_by_name(name.value)
-        if number is not None:
-            self.push_op(Op.SYSCALL, number)
+        s = syscall.by_name(name.value)
+        temps = []
+        for i, arg in reversed(list(enumerate(args))):
+            if s is not None:
+                stored = i < len(s[1].args) and (name.value, s[1].args[i]) in refcount.STORED
+            else:
+                stored = self.ownership.keeps(name.value, i)
+            if stored:
+                self.keep(arg)
+            else:
+                temps.append(self.borrow(arg, across_call=s is None))
+
+        if s is not None:
+            self.push_op(Op.SYSCALL, s[0])
         else:
             self.push_op(Op.CALL, Label(name.value))
+            self.clear_null(globals_only=True)
+        self.release(temps)
 
     def binop(self, ast):
         assert len(ast.children) % 2 != 0, f'Invalid binop tree: {ast}'
@@ -235,7 +404,8 @@ class Compiler:
     product = binop
 
 
-def compile(ast):
+def compile(ast, level=1):
     compiler = Compiler()
     compiler.compile(ast)
-    return Program.build(compiler.instructions)
+    instructions = optimizer.optimize(compiler.instructions, level)
+    return Program.build(instructions)
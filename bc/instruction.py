@@ -1,5 +1,7 @@
-import copy
+import sys
+import struct
 
+from array import array
 from enum import Enum
 from dataclasses import dataclass
 from typing import List, Dict, Union
@@ -37,6 +39,15 @@ class Op(Enum):
     # Function boundaries
     ENTER   = 0x18
     LEAVE   = 0x19
+    # Superinstructions (see peephole.py)
+    INC_LOCAL       = 0x1A
+    LIST_PUSH_CONST = 0x1B
+    JLT     = 0x1C
+    JLE     = 0x1D
+    JGT     = 0x1E
+    JGE     = 0x1F
+    JEQ     = 0x20
+    JNE     = 0x21
 
     def __str__(self):
         return self.name.lower()
@@ -74,18 +85,34 @@ class Instruction:
             return f'{self.op} {self.args[0]}({", ".join(str(arg) for arg in self.args[1:])})'
         return f'{self.op} {", ".join(str(arg) for arg in self.args)}'
 
-    def bytecode(self):
-        opcode = self.op.value
+    def operand(self):
+        '''The argument as a single 64-bit integer, the way vm.c reads it'''
         if self.op is Op.ENTER:
-            _, n_args, n_locals = self.args
-            arg = n_locals << 32 | n_args
-        elif len(self.args) != 0:
+            # n_args in the low 31 bits, whether the function returns a value
+            # in bit 31 and n_locals in the high half
+            returns_value, n_args, n_locals = self.args
+            return n_locals << 32 | int(returns_value) << 31 | n_args
+        if self.op in (Op.INC_LOCAL, Op.LIST_PUSH_CONST):
+            # local index in the low half, 32-bit signed immediate in the high one
+            var, val = self.args
+            return val << 32 | var
+        if len(self.args) != 0:
             assert len(self.args) == 1
-            arg = self.args[0]
-        else:
-            arg = 0
-        pad = b'\0' * 7
-        return int.to_bytes(opcode, 1, 'little') + pad  + int.to_bytes(arg, 8, 'little')
+            return self.args[0]
+        return 0
+
+    def bytecode(self):
+        return V1_INSTRUCTION.pack(self.op.value, self.operand())
+
+    def decode(op, operand):
+        '''Inverse of operand'''
+        if op is Op.ENTER:
+            return Instruction(op, bool(operand >> 31 & 1), operand & 0x7FFFFFFF, operand >> 32)
+        if op in (Op.INC_LOCAL, Op.LIST_PUSH_CONST):
+            return Instruction(op, operand & 0xFFFFFFFF, operand >> 32)
+        if op in NO_OPERAND:
+            return Instruction(op)
+        return Instruction(op, operand)
 
 
 @dataclass
@@ -116,9 +143,11 @@ def list_functions(instructions):
             locals = {}
             returns_value = instruction.args[0] == 'fn'
             start = i
-        elif instruction.op is Op.STORE:
+        elif instruction.op in (Op.LOAD, Op.STORE, Op.INC_LOCAL, Op.LIST_PUSH_CONST):
+            # dead code elimination might remove the only store to a local,
+            # so loads have to define locals too
             n = instruction.args[0]
-            if n not in locals:
+            if n not in locals and n not in args:
                 locals[n] = i
         elif instruction.op is Op.LEAVE:
             locals = sorted(locals, key=lambda n: locals[n])
@@ -136,6 +165,35 @@ def list_globals(instructions):
     return sorted(globals)
 
 
+NO_OPERAND = (
+    Op.ADD, Op.SUB, Op.MUL, Op.DIV, Op.MOD, Op.AND, Op.OR,
+    Op.LT, Op.LE, Op.GT, Op.GE, Op.EQ, Op.NE, Op.RET, Op.LEAVE,
+)
+
+LOCAL_OPS = (Op.LOAD, Op.STORE, Op.INC_LOCAL, Op.LIST_PUSH_CONST)
+
+# ops whose args don't fit a single operand as they are
+MULTI_ARG = (Op.ENTER, Op.INC_LOCAL, Op.LIST_PUSH_CONST)
+
+JUMPS = (Op.JZ, Op.JNZ, Op.JMP, Op.JLT, Op.JLE, Op.JGT, Op.JGE, Op.JEQ, Op.JNE)
+
+# values an instruction pops from and pushes to the operand stack, CALL and
+# SYSCALL depend on the callee
+STACK_EFFECTS = {
+    Op.LOAD: (0, 1), Op.STORE: (1, 0), Op.GLOAD: (0, 1), Op.GSTORE: (1, 0), Op.CONST: (0, 1),
+    Op.ADD: (2, 1), Op.SUB: (2, 1), Op.MUL: (2, 1), Op.DIV: (2, 1), Op.MOD: (2, 1),
+    Op.AND: (2, 1), Op.OR: (2, 1), Op.LT: (2, 1), Op.LE: (2, 1), Op.GT: (2, 1), Op.GE: (2, 1),
+    Op.EQ: (2, 1), Op.NE: (2, 1),
+    Op.JMP: (0, 0), Op.JZ: (1, 0), Op.JNZ: (1, 0),
+    Op.JLT: (2, 0), Op.JLE: (2, 0), Op.JGT: (2, 0), Op.JGE: (2, 0), Op.JEQ: (2, 0), Op.JNE: (2, 0),
+    Op.RET: (0, 0), Op.ENTER: (0, 0), Op.LEAVE: (0, 0), Op.INC_LOCAL: (0, 0), Op.LIST_PUSH_CONST: (0, 0),
+}
+
+
+class VerifyError(Exception):
+    pass
+
+
 def resolve_labels(instructions):
     labels = {}
     for i, instruction in enumerate(instructions):
@@ -143,67 +201,533 @@ def resolve_labels(instructions):
             assert instruction.name not in labels, f'Label {instruction.name} defined twice'
             labels[instruction.name] = i - len(labels)
 
-    instructions = [i for i in instructions if type(i) is not Label]
+    resolved = []
     for instruction in instructions:
         if type(instruction) is Label:
             continue
-
-        if instruction.op in (Op.JZ, Op.JNZ, Op.JMP, Op.CALL):
+        if instruction.op in JUMPS or instruction.op is Op.CALL:
             assert len(instruction.args) == 1
-            target = labels[instruction.args[0].name]
-            instruction.args = (target,)
-    return instructions, labels
+            instruction = Instruction(instruction.op, labels[instruction.args[0].name])
+        resolved.append(instruction)
+    return resolved, labels
 
 
 def resolve_memops(instructions, fns, globals):
+    '''Returns a copy of instructions with indices for the names of functions,
+    locals and globals, the instructions that change are new objects'''
+    resolved = list(instructions)
+    global_index = {name: i for i, name in enumerate(globals)}
     for _, fn in fns.items():
         assert instructions[fn.start].op is Op.ENTER
-        instructions[fn.start].args = (fn.returns_value, len(fn.args), len(fn.locals))
-        # resolve locals locations
+        resolved[fn.start] = Instruction(Op.ENTER, fn.returns_value, len(fn.args), len(fn.locals))
+        # resolve locals locations, an arg shadows a local of the same name
+        index = {name: len(fn.args) + i for i, name in enumerate(fn.locals)}
+        index.update((name, i) for i, name in enumerate(fn.args))
         for i in range(fn.start, fn.end):
-            if type(instructions[i]) is Label:
+            instruction = instructions[i]
+            if type(instruction) is Label:
                 continue
 
-            if instructions[i].op in (Op.LOAD, Op.STORE):
-                name = instructions[i].args[0]
-                try:
-                    index = fn.args.index(name)
-                except ValueError:
-                    index = len(fn.args) + fn.locals.index(name)
-                instructions[i].args = (index,)
-            elif instructions[i].op in (Op.GLOAD, Op.GSTORE):
-                name = instructions[i].args[0]
-                index = globals.index(name)
-                instructions[i].args = (index,)
+            if instruction.op in LOCAL_OPS:
+                name, *rest = instruction.args
+                resolved[i] = Instruction(instruction.op, index[name], *rest)
+            elif instruction.op in (Op.GLOAD, Op.GSTORE):
+                resolved[i] = Instruction(instruction.op, global_index[instruction.args[0]])
+    return resolved
+
+
+def symbolic(instructions, entry, names, globals):
+    '''Undoes resolve_labels and resolve_memops for deserialized instructions,
+    names maps the start of a function to its name'''
+    functions = {
+        i: names.get(i, 'main' if i == entry else f'fn{i}')
+        for i, instruction in enumerate(instructions)
+        if instruction.op is Op.ENTER
+    }
+    targets = {instruction.args[0] for instruction in instructions if instruction.op in JUMPS}
+
+    source = []
+    n_args = 0
+    for i, instruction in enumerate(instructions):
+        if i in functions:
+            source.append(Label(functions[i]))
+        if i in targets:
+            source.append(Label(f'label_{i}'))
+
+        op, args = instruction.op, instruction.args
+        if op is Op.ENTER:
+            returns_value, n_args, _ = args
+            args = ('fn' if returns_value else 'proc', *(f'a{j}' for j in range(n_args)))
+        elif op in (Op.LOAD, Op.STORE, Op.INC_LOCAL, Op.LIST_PUSH_CONST):
+            var, *rest = args
+            args = (f'a{var}' if var < n_args else f'l{var - n_args}', *rest)
+        elif op in (Op.GLOAD, Op.GSTORE):
+            args = (globals[args[0]],)
+        elif op in JUMPS:
+            args = (Label(f'label_{args[0]}'),)
+        elif op is Op.CALL:
+            args = (Label(functions[args[0]]),)
+        source.append(Instruction(op, *args))
+    return source
+
+
+def infer_returns(instructions):
+    '''Version 1 files don't tell whether a function returns a value, it's
+    the stack height at its RET. A function is resolved when a RET is reached
+    through calls of resolved functions only, until no more are. Returns the
+    instructions with ENTER set accordingly, verify checks the result.'''
+    from . import syscall
+
+    n = len(instructions)
+    starts = [i for i, instruction in enumerate(instructions) if instruction.op is Op.ENTER]
+    returns = {}
+    changed = True
+    while changed:
+        changed = False
+        for start in starts:
+            if start in returns:
+                continue
+            heights = {start + 1: 0}
+            worklist = [start + 1]
+            blocked = False
+            result = None
+            while worklist:
+                i = worklist.pop()
+                if not 0 <= i < n:
+                    continue
+                instruction = instructions[i]
+                op, height = instruction.op, heights[i]
+                if op is Op.RET:
+                    result = height
+                    break
+                if op is Op.LEAVE or op is Op.ENTER:
+                    continue
+                effect = STACK_EFFECTS.get(op)
+                if op is Op.CALL:
+                    target = instruction.args[0]
+                    if target not in returns:
+                        blocked = True
+                        continue
+                    effect = instructions[target].args[1], int(returns[target])
+                elif op is Op.SYSCALL:
+                    s = syscall.by_number(instruction.args[0])
+                    if s is None:
+                        continue
+                    effect = len(s.args), int(s.returns_value)
+                pops, pushes = effect
+                if height < pops:
+                    continue
+                height += pushes - pops
+
+                successors = () if op is Op.JMP else (i + 1,)
+                if op in JUMPS:
+                    successors += (instruction.args[0],)
+                for successor in successors:
+                    if successor not in heights:
+                        heights[successor] = height
+                        worklist.append(successor)
+            if result is not None or not blocked:
+                returns[start] = result == 1
+                changed = True
+
+    return [
+        Instruction(Op.ENTER, returns.get(i, False), *instruction.args[1:])
+        if instruction.op is Op.ENTER else instruction
+        for i, instruction in enumerate(instructions)
+    ]
+
+
+# .noxbc files start with MAGIC and a 2 byte tag. Version 1 files are tagged
+# with MAGIC_V1, the header holds the globals count and the entry point (4
+# bytes each), and every instruction takes 16 bytes as in memory. ENTER has
+# no bit for whether the function returns a value, the loaders infer it, see
+# infer_returns, and the stack limits come from verify. Version 2
+# files are tagged with the version and have a header of 4 byte fields:
+#
+#   n_globals, entry, max_depth, max_frame, n_instructions, code_size,
+#   n_constants, n_functions, names_size, 0
+#
+# followed by the constant pool (8 bytes per constant), the function table
+# (start instruction and offset of the name for every function), the names
+# (NUL terminated) and the code. An instruction is the opcode byte, whose top
+# two bits tell how its operand follows: not at all (the operand is 0), as a
+# 1 or 4 byte signed integer, or as a 4 byte index into the constant pool.
+MAGIC = b'.noxbc'
+MAGIC_V1 = b'--'
+VERSION = 2
+
+ARG_NONE  = 0
+ARG_I8    = 1
+ARG_I32   = 2
+ARG_CONST = 3
+
+V1_HEADER = struct.Struct('<6s2sII')
+V1_INSTRUCTION = struct.Struct('<B7xq')
+V2_HEADER = struct.Struct('<6sH10I')
+V1_HEADER_SIZE = V1_HEADER.size
+V2_HEADER_SIZE = V2_HEADER.size
+PACK_I8 = struct.Struct('<b').pack
+PACK_I32 = struct.Struct('<i').pack
+PACK_U32 = struct.Struct('<I').pack
+UNPACK_I8 = struct.Struct('<b').unpack_from
+UNPACK_I32 = struct.Struct('<i').unpack_from
+UNPACK_U32 = struct.Struct('<I').unpack_from
+
+OPS = {op.value: op for op in Op}
+
+
+class Code:
+    '''Resolved instructions in parallel arrays: the opcodes, the operands as
+    Instruction.operand encodes them and, by index, the args of the MULTI_ARG
+    instructions. Indexing makes Instruction objects, so Code can stand in for
+    a list of them where speed doesn't matter.'''
+    __slots__ = ('ops', 'operands', 'args')
+
+    def __init__(self, ops, operands, args):
+        self.ops = ops
+        self.operands = operands
+        self.args = args
+
+    def build(instructions):
+        return Code(
+            array('B', [instruction.op.value for instruction in instructions]),
+            array('q', [instruction.operand() for instruction in instructions]),
+            {
+                i: instruction.args for i, instruction in enumerate(instructions)
+                if instruction.op in MULTI_ARG
+            },
+        )
+
+    def arg_tuples(self):
+        '''The args of every instruction, the ones without any get the unused
+        operand 0'''
+        args = [(operand,) for operand in self.operands]
+        for i, multi in self.args.items():
+            args[i] = multi
+        return args
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.ops)
+        op = OPS[self.ops[i]]
+        if i in self.args:
+            return Instruction(op, *self.args[i])
+        return Instruction.decode(op, self.operands[i])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.ops)))
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return f'Code({list(self)})'
+
 
 @dataclass
 class Program:
     __slots__ = ('source', 'instructions', 'globals', 'functions', 'entry')
 
     source: List[Union[Instruction, Label]]
-    instructions: List[Instruction]
+    instructions: Union[List[Instruction], Code]
     globals: list
     functions: Dict[str, Fn]
     entry: int
 
-    def build(instructions, entrypoint='main'):
-        source = copy.deepcopy(instructions)
-        globals = list_globals(instructions)
+    def build(instructions, entrypoint='main', compact=False):
+        '''Resolves instructions into a Program. Instructions are never
+        modified once built, so the source shares the ones resolving doesn't
+        change with the resolved instructions, and instructions is left as is.
+        With compact the resolved instructions are kept as Code.'''
+        source = list(instructions)
+        globals = list_globals(source)
         fns = list_functions(source)
-        resolve_memops(instructions, fns, globals)
+        instructions = resolve_memops(source, fns, globals)
         instructions, labels = resolve_labels(instructions)
         entry = labels[entrypoint]
+        if compact:
+            instructions = Code.build(instructions)
         return Program(source, instructions, globals, fns, entry)
 
-    def serialize(self):
-        magic = b'.noxbc--'
-        entry = int.to_bytes(self.entry, 4, 'little')
-        n_globals = int.to_bytes(len(self.globals), 4, 'little')
-        program = magic + n_globals + entry
-        for instruction in self.instructions:
-            program += instruction.bytecode()
+    def verify(self):
+        '''Checks that the resolved instructions can run without runtime checks,
+        raises VerifyError otherwise. Returns the deepest operand stack of a
+        single frame and the largest frame (args and locals) of any function,
+        the args of a call are counted in the frame of the caller.
+
+        vm.c does the same checks when it loads a file.'''
+        from . import syscall
+
+        instructions = self.instructions
+
+        def fail(i, message):
+            raise VerifyError(f'{message} at {i}: {instructions[i]}')
+
+        # the ops and args as lists, which is cheaper for Code than indexing
+        if type(instructions) is Code:
+            ops = [OPS[op] for op in instructions.ops]
+            args = instructions.arg_tuples()
+        else:
+            for i, instruction in enumerate(instructions):
+                if type(instruction) is not Instruction or type(instruction.op) is not Op:
+                    fail(i, 'Unknown instruction')
+            ops = [instruction.op for instruction in instructions]
+            args = [instruction.args for instruction in instructions]
+
+        n = len(instructions)
+        functions = []
+        start = None
+        for i, op in enumerate(ops):
+            if op is Op.ENTER:
+                if start is not None:
+                    fail(i, 'Function without LEAVE')
+                start = i
+            elif op is Op.LEAVE:
+                if start is None:
+                    fail(i, 'LEAVE outside of a function')
+                functions.append((start, i + 1))
+                start = None
+            elif start is None:
+                fail(i, 'Instruction outside of a function')
+        if start is not None:
+            raise VerifyError(f'Function at {start} has no LEAVE')
+
+        if not (0 <= self.entry < n and ops[self.entry] is Op.ENTER):
+            raise VerifyError(f'Invalid entry {self.entry}')
+        if args[self.entry][1] != 0:
+            fail(self.entry, 'Entry with arguments')
+
+        n_globals = len(self.globals)
+        max_depth = max_frame = 0
+        for start, end in functions:
+            returns_value, n_args, n_locals = args[start]
+            if not (0 <= n_args < 2**31 and 0 <= n_locals < 2**31):
+                fail(start, 'Invalid frame')
+            frame = n_args + n_locals
+            max_frame = max(max_frame, frame)
+
+            # operand stack height before every reachable instruction, the
+            # args are popped by ENTER so a frame starts empty
+            heights = {start + 1: 0}
+            worklist = [start + 1]
+            while worklist:
+                i = worklist.pop()
+                op, height = ops[i], heights[i]
+                effect = STACK_EFFECTS.get(op)
+
+                if op in LOCAL_OPS:
+                    if not 0 <= args[i][0] < frame:
+                        fail(i, 'Local out of the frame')
+                elif op is Op.GLOAD or op is Op.GSTORE:
+                    if not 0 <= args[i][0] < n_globals:
+                        fail(i, 'Unknown global')
+                elif op is Op.CALL:
+                    target = args[i][0]
+                    if not (0 <= target < n and ops[target] is Op.ENTER):
+                        fail(i, 'Call of a non-function')
+                    if target == self.entry:
+                        fail(i, 'Call of the entry')
+                    callee_returns_value, callee_args, _ = args[target]
+                    effect = callee_args, int(callee_returns_value)
+                elif op is Op.SYSCALL:
+                    s = syscall.by_number(args[i][0])
+                    if s is None:
+                        fail(i, 'Unknown syscall')
+                    effect = len(s.args), int(s.returns_value)
+                elif op is Op.RET:
+                    if start == self.entry:
+                        fail(i, 'Return from the entry')
+                    if height != int(returns_value):
+                        fail(i, 'Unbalanced stack at return')
+
+                pops, pushes = effect
+                if height < pops:
+                    fail(i, 'Stack underflow')
+                height += pushes - pops
+                if height > max_depth:
+                    max_depth = height
+
+                if op in JUMPS:
+                    target = args[i][0]
+                    if not start < target < end:
+                        fail(i, 'Jump out of the function')
+                    successors = (target,) if op is Op.JMP else (target, i + 1)
+                elif op is Op.RET or op is Op.LEAVE:
+                    successors = ()
+                else:
+                    successors = (i + 1,)
+                for successor in successors:
+                    if successor not in heights:
+                        heights[successor] = height
+                        worklist.append(successor)
+                    elif heights[successor] != height:
+                        fail(successor, 'Different stack heights')
+        return max_depth, max_frame
+
+    def serialize(self, version=VERSION):
+        '''Returns the program as a .noxbc file in a bytearray'''
+        max_depth, max_frame = self.verify()
+        if version == 1:
+            return self.serialize_v1()
+        assert version == 2, version
+
+        code = self.code()
+        # wide operands are stored once in the constant pool
+        constants = {}
+        encoded = bytearray()
+        append = encoded.append
+        for opcode, operand in zip(code.ops, code.operands):
+            if operand == 0:
+                append(opcode)
+            elif -2**7 <= operand < 2**7:
+                append(ARG_I8 << 6 | opcode)
+                encoded += PACK_I8(operand)
+            elif -2**31 <= operand < 2**31:
+                append(ARG_I32 << 6 | opcode)
+                encoded += PACK_I32(operand)
+            else:
+                append(ARG_CONST << 6 | opcode)
+                encoded += PACK_U32(constants.setdefault(operand, len(constants)))
+
+        # every function has one ENTER, in the same order as in the source
+        starts = [i for i, opcode in enumerate(code.ops) if opcode == Op.ENTER.value]
+        functions = []
+        names = bytearray()
+        for start, fn in zip(starts, sorted(self.functions.values(), key=lambda fn: fn.start)):
+            functions += start, len(names)
+            names += fn.name.encode() + b'\0'
+
+        at = V2_HEADER_SIZE
+        size = at + 8 * len(constants) + 4 * len(functions) + len(names) + len(encoded)
+        program = bytearray(size)
+        V2_HEADER.pack_into(
+            program, 0, MAGIC, version,
+            len(self.globals), self.entry, max_depth, max_frame, len(code),
+            len(encoded), len(constants), len(self.functions), len(names), 0,
+        )
+        struct.pack_into(f'<{len(constants)}q', program, at, *constants)
+        at += 8 * len(constants)
+        struct.pack_into(f'<{len(functions)}I', program, at, *functions)
+        at += 4 * len(functions)
+        program[at:at + len(names)] = names
+        program[size - len(encoded):] = encoded
         return program
 
+    def serialize_v1(self):
+        code = self.code()
+        # an instruction is the opcode widened to 8 bytes and the operand, so
+        # the columns are copied into every other slot of a single array
+        instructions = array('q', bytes(V1_INSTRUCTION.size * len(code)))
+        instructions[0::2] = array('q', code.ops)
+        instructions[1::2] = code.operands
+        # without the returns value bit of ENTER, as the first vm.c read it
+        for i, opcode in enumerate(code.ops):
+            if opcode == Op.ENTER.value:
+                instructions[2 * i + 1] &= ~(1 << 31)
+        if sys.byteorder != 'little':
+            instructions.byteswap()
+
+        program = bytearray(V1_HEADER_SIZE + V1_INSTRUCTION.size * len(code))
+        V1_HEADER.pack_into(program, 0, MAGIC, MAGIC_V1, len(self.globals), self.entry)
+        program[V1_HEADER_SIZE:] = instructions
+        return program
+
+    def code(self):
+        '''The instructions as Code, without a copy if they already are'''
+        if type(self.instructions) is Code:
+            return self.instructions
+        return Code.build(self.instructions)
+
+    def starts(self):
+        '''Maps the index of the ENTER of every function to its Fn'''
+        if type(self.instructions) is Code:
+            starts = [i for i, opcode in enumerate(self.instructions.ops) if opcode == Op.ENTER.value]
+        else:
+            starts = [i for i, instruction in enumerate(self.instructions) if instruction.op is Op.ENTER]
+        # every function has one ENTER, in the same order as in the source
+        return dict(zip(starts, sorted(self.functions.values(), key=lambda fn: fn.start)))
+
+    def deserialize(data):
+        '''Loads a program written by serialize, of either version, from a
+        bytes-like object without copying it. Names the file doesn't keep are
+        made up. Raises ValueError for a corrupted file and VerifyError for
+        instructions that don't verify, the way vm.c rejects them.'''
+        view = memoryview(data)
+        if len(view) < 8 or view[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a .noxbc file')
+
+        decode = Instruction.decode
+        names = {}
+        try:
+            if view[len(MAGIC):8] == MAGIC_V1:
+                _, _, n_globals, entry = V1_HEADER.unpack_from(view)
+                if (len(view) - V1_HEADER_SIZE) % V1_INSTRUCTION.size:
+                    raise ValueError('Corrupted .noxbc file (size)')
+                instructions = [
+                    decode(OPS[opcode], operand)
+                    for opcode, operand in V1_INSTRUCTION.iter_unpack(view[V1_HEADER_SIZE:])
+                ]
+                n = len(instructions)
+                if n_globals > n:
+                    raise ValueError('Corrupted .noxbc file (globals)')
+                instructions = infer_returns(instructions)
+            else:
+                _, version, *header = V2_HEADER.unpack_from(view)
+                if version != 2:
+                    raise ValueError(f'Unsupported .noxbc version {version}')
+                n_globals, entry, _, _, n, code_size, n_constants, n_functions, names_size, _ = header
+                # the counts are checked against the size before anything is
+                # allocated for them, every instruction takes at least a byte
+                # and every global and function is used by one
+                size = V2_HEADER_SIZE + 8 * n_constants + 8 * n_functions + names_size + code_size
+                if size != len(view) or n > code_size or n_globals > n or n_functions > n:
+                    raise ValueError('Corrupted .noxbc file (size)')
+
+                at = V2_HEADER_SIZE
+                constants = struct.unpack_from(f'<{n_constants}q', view, at)
+                at += 8 * n_constants
+                functions = struct.unpack_from(f'<{2 * n_functions}I', view, at)
+                at += 8 * n_functions
+                blob = bytes(view[at:at + names_size])
+                for start, name in zip(functions[::2], functions[1::2]):
+                    names[start] = blob[name:blob.index(b'\0', name)].decode()
+                at += names_size
+
+                code = view[at:at + code_size]
+                at = 0
+                instructions = []
+                for _ in range(n):
+                    byte = code[at]
+                    width = byte >> 6
+                    if width == ARG_NONE:
+                        operand = 0
+                        at += 1
+                    elif width == ARG_I8:
+                        operand, = UNPACK_I8(code, at + 1)
+                        at += 2
+                    elif width == ARG_I32:
+                        operand, = UNPACK_I32(code, at + 1)
+                        at += 5
+                    else:
+                        operand = constants[UNPACK_U32(code, at + 1)[0]]
+                        at += 5
+                    instructions.append(decode(OPS[byte & 0x3F], operand))
+                if at != code_size:
+                    raise ValueError('Corrupted .noxbc file (code)')
+                for start in names:
+                    if not (start < n and instructions[start].op is Op.ENTER):
+                        raise ValueError('Corrupted .noxbc file (function table)')
+        except (KeyError, IndexError, struct.error) as e:
+            raise ValueError('Corrupted .noxbc file') from e
+
+        globals = [f'g{i}' for i in range(n_globals)]
+        Program(None, instructions, globals, None, entry).verify()
+        source = symbolic(instructions, entry, names, globals)
+        return Program(source, instructions, globals, list_functions(source), entry)
+
     def __str__(self):
         return '\n'.join(
             '    ' + str(i) if type(i) is Instruction else str(i) + ':'
@@ -0,0 +1,151 @@
+import operator
+
+from . import peephole
+from .instruction import Op, Instruction, Label, JUMPS
+from .runtime import and_, or_
+
+
+def is_int64(val):
+    return -2**63 <= val < 2**63
+
+
+def divide(op):
+    def fold(l, r):
+        # python and C disagree on negative operands, leave those to the runtime
+        if l < 0 or r <= 0:
+            return None
+        return op(l, r)
+    return fold
+
+def logic(op):
+    def fold(l, r):
+        return int(op(l, r))
+    return fold
+
+FOLDS = {
+    Op.ADD: operator.add,
+    Op.SUB: operator.sub,
+    Op.MUL: operator.mul,
+    Op.DIV: divide(operator.floordiv),
+    Op.MOD: divide(operator.mod),
+    Op.AND: logic(and_),
+    Op.OR:  logic(or_),
+    Op.LT:  logic(operator.lt),
+    Op.LE:  logic(operator.le),
+    Op.GT:  logic(operator.gt),
+    Op.GE:  logic(operator.ge),
+    Op.EQ:  logic(operator.eq),
+    Op.NE:  logic(operator.ne),
+}
+
+
+def is_const(instruction):
+    return type(instruction) is Instruction and instruction.op is Op.CONST
+
+
+def fold_constants(instructions):
+    '''Evaluates arithmetic on constants and conditional jumps on constants.
+
+    const a; const b; <op>  ->  const (a <op> b)
+    const 0; jz L           ->  jmp L
+    const 1; jz L           ->  (nothing)
+    '''
+    result = []
+    for instruction in instructions:
+        if type(instruction) is Instruction and len(result) >= 2 and \
+                instruction.op in FOLDS and is_const(result[-1]) and is_const(result[-2]):
+            l, = result[-2].args
+            r, = result[-1].args
+            val = FOLDS[instruction.op](l, r)
+            if val is not None and is_int64(val):
+                result[-2:] = [Instruction(Op.CONST, val)]
+                continue
+        elif type(instruction) is Instruction and result and \
+                instruction.op in (Op.JZ, Op.JNZ) and is_const(result[-1]):
+            val, = result.pop().args
+            if bool(val) == (instruction.op is Op.JNZ):
+                result.append(Instruction(Op.JMP, *instruction.args))
+            continue
+        result.append(instruction)
+    return result
+
+
+def function_labels(instructions):
+    return {
+        instructions[i - 1].name
+        for i, instruction in enumerate(instructions)
+        if type(instruction) is Instruction and instruction.op is Op.ENTER
+    }
+
+
+def eliminate_dead_code(instructions):
+    '''Removes instructions that are not reachable from any function entry,
+    jumps to the next instruction and labels that are never jumped to.
+
+    ENTER and LEAVE are always kept since they delimit functions.
+    '''
+    positions = {
+        instruction.name: i
+        for i, instruction in enumerate(instructions)
+        if type(instruction) is Label
+    }
+    functions = function_labels(instructions)
+
+    reachable = [False] * len(instructions)
+    worklist = [positions[name] for name in functions]
+    while worklist:
+        i = worklist.pop()
+        while i < len(instructions) and not reachable[i]:
+            reachable[i] = True
+            instruction = instructions[i]
+            if type(instruction) is Instruction:
+                if instruction.op in JUMPS:
+                    worklist.append(positions[instruction.args[0].name])
+                if instruction.op in (Op.JMP, Op.RET, Op.LEAVE):
+                    break
+            i += 1
+
+    live = [
+        instruction
+        for i, instruction in enumerate(instructions)
+        if reachable[i] or (type(instruction) is Instruction and instruction.op in (Op.ENTER, Op.LEAVE))
+    ]
+
+    # jmp L; L:  ->  L:
+    result = []
+    for i, instruction in enumerate(live):
+        if type(instruction) is Instruction and instruction.op is Op.JMP:
+            target = instruction.args[0].name
+            j = i + 1
+            while j < len(live) and type(live[j]) is Label and live[j].name != target:
+                j += 1
+            if j < len(live) and type(live[j]) is Label:
+                continue
+        result.append(instruction)
+
+    targets = functions | {
+        instruction.args[0].name
+        for instruction in result
+        if type(instruction) is Instruction and (instruction.op in JUMPS or instruction.op is Op.CALL)
+    }
+    return [i for i in result if type(i) is not Label or i.name in targets]
+
+
+def optimize(instructions, level=1):
+    '''Optimizes the symbolic instruction list.
+
+    level 0: no optimizations
+    level 1: superinstructions (see peephole.py)
+    level 2: constant folding and dead code elimination, then superinstructions
+    '''
+    if level >= 2:
+        while True:
+            n = len(instructions)
+            instructions = eliminate_dead_code(fold_constants(instructions))
+            if len(instructions) == n:
+                break
+
+    if level >= 1:
+        instructions = peephole.fuse(instructions)
+
+    return instructions
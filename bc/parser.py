@@ -1,4 +1,5 @@
 from . import Op, Instruction, Label, Program
+from . import optimizer
 from lark import Lark, Transformer, v_args
 
 
@@ -36,6 +37,14 @@ bytecode_grammar = '''
         | "ret"             -> ret
         | "leave"           -> leave
         | "enter" fn_tag "(" [var ("," var)*] ")" -> enter
+        | "inc_local" var "," num       -> inc_local
+        | "list_push_const" var "," num -> list_push_const
+        | "jlt" label       -> jlt
+        | "jle" label       -> jle
+        | "jgt" label       -> jgt
+        | "jge" label       -> jge
+        | "jeq" label       -> jeq
+        | "jne" label       -> jne
 
     fn_tag: "fn" -> fn
         | "proc" -> proc
@@ -64,7 +73,7 @@ def const(val):
 @v_args(inline=True)
 class BytecodeTransformer(Transformer):
     def program(self, *instructions):
-        return Program.build(list(instructions))
+        return list(instructions)
 
     number  = int
     var     = str
@@ -103,10 +112,25 @@ class BytecodeTransformer(Transformer):
     enter   = make_handler(Op.ENTER)
     leave   = make_handler(Op.LEAVE)
 
+    inc_local       = make_handler(Op.INC_LOCAL)
+    list_push_const = make_handler(Op.LIST_PUSH_CONST)
+    jlt     = make_handler(Op.JLT)
+    jle     = make_handler(Op.JLE)
+    jgt     = make_handler(Op.JGT)
+    jge     = make_handler(Op.JGE)
+    jeq     = make_handler(Op.JEQ)
+    jne     = make_handler(Op.JNE)
+
 bytecode_parser = Lark(
     bytecode_grammar,
     parser='lalr',
+    cache=True,
     transformer=BytecodeTransformer()
 )
 
-parse = bytecode_parser.parse
\ No newline at end of file
+def parse(source, level=0):
+    instructions = bytecode_parser.parse(source)
+    instructions = optimizer.optimize(instructions, level)
+    program = Program.build(instructions)
+    program.verify()
+    return program
\ No newline at end of file
@@ -0,0 +1,105 @@
+from . import syscall
+from .instruction import Op, Instruction
+
+
+# cmp -> (fused op for `cmp; jnz`, fused op for `cmp; jz`)
+CMP_JUMPS = {
+    Op.LT: (Op.JLT, Op.JGE),
+    Op.LE: (Op.JLE, Op.JGT),
+    Op.GT: (Op.JGT, Op.JLE),
+    Op.GE: (Op.JGE, Op.JLT),
+    Op.EQ: (Op.JEQ, Op.JNE),
+    Op.NE: (Op.JNE, Op.JEQ),
+}
+
+PUSH = syscall.number_by_name('push')
+
+
+def is_int32(val):
+    return -2**31 <= val < 2**31
+
+
+def window(instructions, i, n):
+    '''Returns n instructions starting at i, or None if a label is in the way'''
+    w = instructions[i:i+n]
+    if len(w) != n or any(type(instruction) is not Instruction for instruction in w):
+        return None
+    return w
+
+
+def inc_local(instructions, i):
+    # load x; const k; add|sub; store x  ->  inc_local x, +-k
+    w = window(instructions, i, 4)
+    if w is None:
+        return None
+
+    load, const, op, store = w
+    if (load.op, const.op, store.op) != (Op.LOAD, Op.CONST, Op.STORE) or op.op not in (Op.ADD, Op.SUB):
+        return None
+
+    var, = load.args
+    k, = const.args
+    if store.args[0] != var:
+        return None
+
+    k = k if op.op is Op.ADD else -k
+    if not is_int32(k):
+        return None
+    return Instruction(Op.INC_LOCAL, var, k), 4
+
+
+def list_push_const(instructions, i):
+    # const c; load l; syscall push  ->  list_push_const l, c
+    w = window(instructions, i, 3)
+    if w is None:
+        return None
+
+    const, load, call = w
+    if (const.op, load.op, call.op) != (Op.CONST, Op.LOAD, Op.SYSCALL) or call.args[0] != PUSH:
+        return None
+
+    val, = const.args
+    if not is_int32(val):
+        return None
+    return Instruction(Op.LIST_PUSH_CONST, load.args[0], val), 3
+
+
+def cmp_jump(instructions, i):
+    # lt; jnz L  ->  jlt L
+    # lt; jz L   ->  jge L
+    w = window(instructions, i, 2)
+    if w is None:
+        return None
+
+    cmp, jump = w
+    if cmp.op not in CMP_JUMPS or jump.op not in (Op.JZ, Op.JNZ):
+        return None
+
+    if_true, if_false = CMP_JUMPS[cmp.op]
+    op = if_true if jump.op is Op.JNZ else if_false
+    return Instruction(op, *jump.args), 2
+
+
+PATTERNS = (inc_local, list_push_const, cmp_jump)
+
+
+def fuse(instructions):
+    '''Replaces common instruction sequences with superinstructions.
+
+    Works on the symbolic (not yet built) instruction list, patterns never
+    match across labels.
+    '''
+    result = []
+    i = 0
+    while i < len(instructions):
+        for pattern in PATTERNS:
+            fused = pattern(instructions, i)
+            if fused is not None:
+                instruction, n = fused
+                result.append(instruction)
+                i += n
+                break
+        else:
+            result.append(instructions[i])
+            i += 1
+    return result
@@ -0,0 +1,129 @@
+from collections import Counter
+
+from .instruction import Op, Label, JUMPS
+
+
+# Profiles of bc.execute (see execute(..., profile=Profile())) and of vm.c
+# built with PROFILE share a JSON format, all counts are of instructions run:
+#
+#   {"instructions": total,
+#    "opcodes": {"<op>": count},
+#    "pairs": {"<op> <next op>": count},
+#    "functions": {"<index of the ENTER>": {"calls": n, "instructions": inclusive}},
+#    "loops": {"<index of the target>": taken backward jumps}}
+#
+# Indices are of Program.instructions. The instructions of a function run from
+# its ENTER to its RET, both included, with its callees. A recursive function
+# is counted by its outermost frame and the functions running at the exit up
+# to the exit.
+
+class Profile:
+    def __init__(self):
+        self.executed = 0
+        self.opcodes = Counter()
+        self.pairs = Counter()
+        # by the index of the ENTER
+        self.calls = Counter()
+        self.inclusive = Counter()
+        self.active = Counter()
+        # by the index of the target
+        self.loops = Counter()
+        # (index of the ENTER, instructions run before it)
+        self.frames = []
+        self.previous = None
+
+    def step(self, ip, op):
+        '''Counts the instruction at ip, before it runs'''
+        self.executed += 1
+        self.opcodes[op] += 1
+        if self.previous is not None:
+            previous_ip, previous_op = self.previous
+            self.pairs[previous_op, op] += 1
+            if previous_op in JUMPS and ip <= previous_ip:
+                self.loops[ip] += 1
+        self.previous = ip, op
+
+        if op is Op.ENTER:
+            self.frames.append((ip, self.executed - 1))
+            self.active[ip] += 1
+            self.calls[ip] += 1
+        elif op is Op.RET:
+            self.ret()
+
+    def ret(self):
+        start, entered_at = self.frames.pop()
+        self.active[start] -= 1
+        if not self.active[start]:
+            self.inclusive[start] += self.executed - entered_at
+
+    def finish(self):
+        while self.frames:
+            self.ret()
+
+    def to_json(self):
+        return {
+            'instructions': self.executed,
+            'opcodes': {
+                str(op): count for op, count in sorted(self.opcodes.items(), key=lambda i: i[0].value)
+            },
+            'pairs': {
+                f'{a} {b}': count
+                for (a, b), count in sorted(self.pairs.items(), key=lambda i: (i[0][0].value, i[0][1].value))
+            },
+            'functions': {
+                str(start): {'calls': self.calls[start], 'instructions': self.inclusive[start]}
+                for start in sorted(self.calls)
+            },
+            'loops': {str(target): count for target, count in sorted(self.loops.items())},
+        }
+
+
+def labels(program):
+    '''Maps indices of program.instructions to the last label of the source
+    before them'''
+    result = {}
+    i = 0
+    for instruction in program.source:
+        if type(instruction) is Label:
+            result[i] = instruction.name
+        else:
+            i += 1
+    return result
+
+
+def report(program, profile, top=10):
+    '''Renders the top entries of profile, in the JSON format, with the names
+    of the functions and the labels of the loops in program.source'''
+    total = profile['instructions']
+    starts = program.starts()
+    names = labels(program)
+
+    def share(count):
+        return f'{100 * count / total:5.1f}%' if total else '    -'
+
+    def function(ip):
+        return starts[max(start for start in starts if start <= ip)].name
+
+    def hottest(counts):
+        return sorted(counts.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    lines = [f'{total} instructions', '', 'opcodes:']
+    for op, count in hottest(profile['opcodes']):
+        lines.append(f'  {op:<24} {count:>12} {share(count)}')
+
+    lines += ['', 'opcode pairs:']
+    for pair, count in hottest(profile['pairs']):
+        lines.append(f'  {pair:<24} {count:>12} {share(count)}')
+
+    lines += ['', 'functions (calls, instructions including callees):']
+    functions = {start: counts['instructions'] for start, counts in profile['functions'].items()}
+    for start, count in hottest(functions):
+        calls = profile['functions'][start]['calls']
+        lines.append(f'  {starts[int(start)].name:<24} {calls:>12} {count:>12} {share(count)}')
+
+    lines += ['', 'loops (taken backward jumps):']
+    for target, count in hottest(profile['loops']):
+        target = int(target)
+        name = f'{names.get(target, target)} in {function(target)}'
+        lines.append(f'  {name:<24} {count:>12}')
+    return '\n'.join(lines)
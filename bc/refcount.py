@@ -0,0 +1,174 @@
+from dataclasses import dataclass
+from lark import Tree
+
+from . import syscall
+
+
+# Ownership analysis for the reference counting of lists. Values are untyped,
+# so references are only counted for what is known to be a list:
+#
+# - list and string literals, list() and slice() create lists
+# - functions declared `-> list` or `-> str` return lists
+# - a list variable is a variable, other than an argument, every assignment of
+#   which stores a list
+#
+# A list variable owns a reference to its value. A list stored anywhere else
+# (into a list, an untyped variable, returned from an int function or passed
+# to an argument the callee may keep) is pinned: it gets a reference that is
+# never released. Arguments the callee doesn't keep are borrowed.
+
+# kinds of list expressions
+FRESH    = 'fresh'     # a new list, nothing references it yet
+OWNED    = 'owned'     # carries a reference the user of the value releases
+BORROWED = 'borrowed'  # the value of a list variable, the variable keeps its reference
+
+MAIN = 'main'
+# scope of the global variables
+GLOBAL = None
+
+CREATE = ('list', 'slice')
+# syscall arguments stored into a list
+STORED = {('push', 'val'), ('list_set', 'val')}
+
+
+def walk(body):
+    for node in body:
+        if type(node) is Tree:
+            yield node
+            yield from walk(node.children)
+
+
+@dataclass
+class Ownership:
+    globals: set
+    args: dict
+    # functions returning lists
+    list_fns: set
+    # (scope, name) of every list variable
+    list_vars: set
+    # indices of the arguments every function may keep after it returns
+    escaping: dict
+
+    def scope(self, fn, var):
+        if var in self.args[fn] or var not in self.globals:
+            return fn
+        return GLOBAL
+
+    def is_list_var(self, fn, var):
+        return (self.scope(fn, var), var) in self.list_vars
+
+    def locals(self, fn):
+        return sorted(var for scope, var in self.list_vars if scope == fn)
+
+    def keeps(self, fn, i):
+        # unknown functions are assumed to keep everything
+        return i in self.escaping.get(fn, (i,))
+
+    def kind(self, fn, ast):
+        if ast.data in ('list_lit', 'str_lit'):
+            # literals are built holding a reference (see Compiler.list_lit)
+            return OWNED
+        if ast.data == 'call':
+            name = ast.children[0].value
+            if name in CREATE:
+                return FRESH
+            if syscall.by_name(name) is None and name in self.list_fns:
+                return OWNED
+        if ast.data == 'var_expr' and self.is_list_var(fn, ast.children[0].value):
+            return BORROWED
+        return None
+
+    def carries(self, ast, var):
+        '''Whether the value of ast may be the value of the argument var'''
+        if ast.data == 'var_expr':
+            return ast.children[0].value == var
+        if ast.data == 'call':
+            name, *args = ast.children
+            # syscalls return ints and new lists
+            if syscall.by_name(name.value) is not None:
+                return False
+            return any(
+                self.carries(arg, var)
+                for i, arg in enumerate(args)
+                if self.keeps(name.value, i)
+            )
+        if ast.data in ('int_lit', 'char_lit', 'list_lit', 'str_lit', 'list_at'):
+            return False
+        # arithmetic on a list is still the list as far as we know
+        return any(self.carries(child, var) for child in ast.children if type(child) is Tree)
+
+    def stored(self, body):
+        '''Expressions of body whose values may outlive the call'''
+        for node in walk(body):
+            if node.data == 'assign':
+                yield node.children[2]
+            elif node.data == 'assign_at':
+                yield node.children[3]
+            elif node.data in ('list_lit', 'return'):
+                yield from node.children
+            elif node.data == 'call':
+                name, *args = node.children
+                s = syscall.by_name(name.value)
+                for i, arg in enumerate(args):
+                    if s is None:
+                        if self.keeps(name.value, i):
+                            yield arg
+                    elif i < len(s[1].args) and (name.value, s[1].args[i]) in STORED:
+                        yield arg
+
+
+def analyze(ast):
+    globals = set()
+    args = {MAIN: []}
+    list_fns = set()
+    bodies = {MAIN: []}
+    for node in ast.children:
+        if node.data == 'global':
+            globals.update(var.value for var in node.children)
+        elif node.data == 'function':
+            name, fn_args, *ret, body = node.children
+            args[name.value] = [arg.value for arg in fn_args.children]
+            bodies[name.value] = [body]
+            if ret and ret[0].children[0].value in ('list', 'str'):
+                list_fns.add(name.value)
+        else:
+            bodies[MAIN].append(node)
+
+    ownership = Ownership(globals, args, list_fns, set(), {fn: set() for fn in args})
+
+    assignments = {}
+    for fn, body in bodies.items():
+        for node in walk(body):
+            if node.data == 'assign':
+                var, _, expr = node.children
+                key = (ownership.scope(fn, var.value), var.value)
+                assignments.setdefault(key, []).append((fn, expr))
+
+    # start from every assigned variable and drop the ones that get a value
+    # not known to be a list, until nothing changes
+    ownership.list_vars = {
+        (scope, var) for scope, var in assignments
+        if scope is GLOBAL or var not in args[scope]
+    }
+    while True:
+        list_vars = {
+            key for key in ownership.list_vars
+            if all(ownership.kind(fn, expr) for fn, expr in assignments[key])
+        }
+        if list_vars == ownership.list_vars:
+            break
+        ownership.list_vars = list_vars
+
+    # an argument escapes when its value may be stored, keeping an argument
+    # of another function stores it too
+    changed = True
+    while changed:
+        changed = False
+        for fn, body in bodies.items():
+            for expr in list(ownership.stored(body)):
+                for i, arg in enumerate(args[fn]):
+                    if i not in ownership.escaping[fn] and ownership.carries(expr, arg):
+                        ownership.escaping[fn].add(i)
+                        changed = True
+
+    return ownership
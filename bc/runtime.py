@@ -4,7 +4,7 @@ import sys
 from typing import List
 
 from . import syscall
-from .instruction import Op
+from .instruction import Op, Code, NO_OPERAND, MULTI_ARG
 
 def binop(op):
     def handler(self):
@@ -15,17 +15,93 @@ def binop(op):
         self.ip += 1
     return handler
 
+def cjump(op):
+    def handler(self, target):
+        r = self.stack.pop()
+        l = self.stack.pop()
+        self.ip = target if op(l, r) else self.ip + 1
+    return handler
+
 def and_(l, r):
     return operator.truth(l and r)
 
 def or_(l, r):
     return operator.truth(l or r)
 
+class BufferedIO:
+    '''Reads stdin in chunks split into integers and collects output until
+    flush. The streams are checked for a tty once, interactive streams are
+    used a line at a time, the same way as without buffering.'''
+
+    chunk_size = 1 << 16
+    max_pending = 1 << 12
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.interactive_in = stdin.isatty()
+        self.interactive_out = stdout.isatty()
+        # bytes when stdin is backed by a binary stream, str otherwise
+        stream = getattr(stdin, 'buffer', stdin)
+        self.read = getattr(stream, 'read1', stream.read)
+        self.tokens = []
+        self.next_token = 0
+        self.partial = None
+        self.pending = []
+
+    def fill(self):
+        chunk = self.read(self.chunk_size)
+        data = chunk if self.partial is None else self.partial + chunk
+        self.partial = None
+        if not chunk and not data:
+            raise EOFError()
+
+        self.tokens = data.split()
+        self.next_token = 0
+        # the last token may continue in the next chunk
+        if chunk and self.tokens and not data[-1:].isspace():
+            self.partial = self.tokens.pop()
+
+    def input(self):
+        if self.interactive_in:
+            self.flush()
+            return int(input('I: '))
+
+        while self.next_token == len(self.tokens):
+            self.fill()
+        token = self.tokens[self.next_token]
+        self.next_token += 1
+        return int(token)
+
+    def print(self, value):
+        if self.interactive_out:
+            print(f'O: {value}', file=self.stdout)
+            return
+
+        self.pending.append(str(value))
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.pending.append('')
+            self.stdout.write('\n'.join(self.pending))
+            self.pending = []
+        self.stdout.flush()
+
 def sys_input(self):
+    if self.fast_io:
+        self.stack.append(self.io().input())
+        return
+
     value = input('I: ') if sys.stdin.isatty() else input()
     self.stack.append(int(value))
 
 def sys_print(self, value):
+    if self.fast_io:
+        self.io().print(value)
+        return
+
     if sys.stdout.isatty():
         print(f'O: {value}')
     else:
@@ -38,8 +114,35 @@ class ExitCode(Exception):
 def sys_exit(self, value):
     raise ExitCode(value)
 
+# sizes of rt/list.c, so the live bytes agree with the native runtime
+LIST_SIZE = 32
+INT_SIZE = 8
+MIN_CAPACITY = 4
+
+class List(list):
+    '''A list with the reference count and capacity of rt/list.h'''
+    __slots__ = ('refs', 'capacity')
+
+    def __init__(self, data=()):
+        super().__init__(data)
+        self.refs = 0
+        self.capacity = len(self)
+
+def new_list(self, data=()):
+    l = List(data)
+    self.live_lists += 1
+    self.live_bytes += LIST_SIZE + l.capacity * INT_SIZE
+    return l
+
+def push(self, l, v):
+    if len(l) == l.capacity:
+        capacity = l.capacity * 2 or MIN_CAPACITY
+        self.live_bytes += (capacity - l.capacity) * INT_SIZE
+        l.capacity = capacity
+    l.append(v)
+
 def sys_list(self):
-    self.stack.append([])
+    self.stack.append(new_list(self))
 
 def sys_list_get(self, l, i):
     self.stack.append(l[i])
@@ -48,7 +151,7 @@ def sys_list_set(self, l, i, v):
     l[i] = v
 
 def sys_list_push(self, l, v):
-    l.append(v)
+    push(self, l, v)
 
 def sys_list_len(self, l):
     self.stack.append(len(l))
@@ -61,7 +164,29 @@ def sys_list_slice(self, l, left, right):
         left = None
     if right == -1:
         right = None
-    self.stack.append(l[slice(left, right)])
+    self.stack.append(new_list(self, l[slice(left, right)]))
+
+# list variables are 0 until the first assignment
+def sys_list_ref(self, l):
+    if type(l) is List:
+        l.refs += 1
+
+def sys_list_unref(self, l):
+    if type(l) is not List:
+        return
+    l.refs -= 1
+    if not l.refs:
+        self.live_lists -= 1
+        self.live_bytes -= LIST_SIZE + l.capacity * INT_SIZE
+        # a use after free reads out of range instead of the old data
+        l.clear()
+        l.capacity = 0
+
+def sys_live_lists(self):
+    self.stack.append(self.live_lists)
+
+def sys_live_bytes(self):
+    self.stack.append(self.live_bytes)
 
 _syscalls = {
     'exit': sys_exit,
@@ -73,6 +198,10 @@ _syscalls = {
     'len': sys_list_len,
     'clear': sys_list_clear,
     'slice': sys_list_slice,
+    'list_ref': sys_list_ref,
+    'list_unref': sys_list_unref,
+    'live_lists': sys_live_lists,
+    'live_bytes': sys_live_bytes,
 
     'input': sys_input,
     'print': sys_print
@@ -92,12 +221,27 @@ class State:
     globals: List[int]
     locals: List[List[int]]
 
-    def __init__(self, program):
+    def __init__(self, program, fast_io=False):
         self.ip = program.entry
         self.stack = []
         self.callstack = []
         self.globals = [0] * len(program.globals)
         self.locals = []
+        self.fast_io = fast_io
+        self.buffered_io = None
+        self.live_lists = 0
+        self.live_bytes = 0
+
+    def io(self):
+        # sys.stdin and sys.stdout are looked up at the first syscall, they
+        # may be redirected after the state is created
+        if self.buffered_io is None:
+            self.buffered_io = BufferedIO(sys.stdin, sys.stdout)
+        return self.buffered_io
+
+    def flush(self):
+        if self.buffered_io is not None:
+            self.buffered_io.flush()
 
     def load(self, var_id):
         val = self.locals[-1][var_id]
@@ -173,17 +317,87 @@ class State:
     def leave(self):
         assert False, "Should be unreachable"
 
+    def inc_local(self, var_id, val):
+        self.locals[-1][var_id] += val
+        self.ip += 1
+
+    def list_push_const(self, var_id, val):
+        push(self, self.locals[-1][var_id], val)
+        self.ip += 1
+
+    jlt = cjump(operator.lt)
+    jle = cjump(operator.le)
+    jgt = cjump(operator.gt)
+    jge = cjump(operator.ge)
+    jeq = cjump(operator.eq)
+    jne = cjump(operator.ne)
+
 def getop(op):
     op = str(op)
     return getattr(State, op, None) or getattr(State, op + '_')
 
 HANDLERS = {op: getop(op) for op in Op}
 
-def execute(state, program, handlers=HANDLERS):
+def execute(state, program, handlers=HANDLERS, profile=None):
+    if profile is not None:
+        return execute_profiled(state, program, profile, handlers)
+    if type(program.instructions) is Code:
+        return execute_code(state, program.instructions, program.entry, handlers)
     state.ip = program.entry
     try:
         while True:
             instruction = program.instructions[state.ip]
             handlers[instruction.op](state, *instruction.args)
     except ExitCode as e:
-        return e.code
\ No newline at end of file
+        return e.code
+    finally:
+        state.flush()
+
+def execute_profiled(state, program, profile, handlers=HANDLERS):
+    '''execute counting every instruction in profile, a bc.profile.Profile'''
+    instructions = program.instructions
+    step = profile.step
+    state.ip = program.entry
+    try:
+        while True:
+            ip = state.ip
+            instruction = instructions[ip]
+            step(ip, instruction.op)
+            handlers[instruction.op](state, *instruction.args)
+    except ExitCode as e:
+        return e.code
+    finally:
+        profile.finish()
+        state.flush()
+
+# how execute_code passes the args to the handler of an opcode
+NO_ARGS, OPERAND, ARGS = 0, 1, 2
+
+def execute_code(state, code, entry, handlers=HANDLERS):
+    '''execute for Code, the handlers are looked up by opcode in a list'''
+    table = [None] * (max(op.value for op in Op) + 1)
+    kinds = [OPERAND] * len(table)
+    for op, handler in handlers.items():
+        table[op.value] = handler
+        if op in NO_OPERAND:
+            kinds[op.value] = NO_ARGS
+        elif op in MULTI_ARG:
+            kinds[op.value] = ARGS
+
+    ops, operands, args = code.ops, code.operands, code.args
+    state.ip = entry
+    try:
+        while True:
+            ip = state.ip
+            op = ops[ip]
+            kind = kinds[op]
+            if kind == OPERAND:
+                table[op](state, operands[ip])
+            elif kind == NO_ARGS:
+                table[op](state)
+            else:
+                table[op](state, *args[ip])
+    except ExitCode as e:
+        return e.code
+    finally:
+        state.flush()
\ No newline at end of file
@@ -25,6 +25,9 @@ _by_number = {
     26: syscall('slice', 'list', 'left', 'right'),
     27: syscall('list_ref', 'list', returns_value=False),
     28: syscall('list_unref', 'list', returns_value=False),
+    # lists and bytes held by the live lists, for leak checks
+    29: syscall('live_lists'),
+    30: syscall('live_bytes'),
 
     # stdin/stdout
     100: syscall('print', 'val', returns_value=False),
@@ -0,0 +1,202 @@
+import operator
+
+from .instruction import Op
+from .runtime import ExitCode, SYSCALLS, and_, or_, push as push_list
+
+
+# Closure-compiled interpreter: every instruction of the program is translated
+# once into a specialized closure with its operands and successor index bound
+# in advance. Each closure performs the operation and returns the index of the
+# next instruction to run, so the dispatch loop is just `ip = code[ip]()`.
+
+ARITHMETIC = {
+    Op.ADD: operator.add,
+    Op.SUB: operator.sub,
+    Op.MUL: operator.mul,
+    Op.DIV: operator.floordiv,
+    Op.MOD: operator.mod,
+}
+
+LOGIC = {
+    Op.AND: and_,
+    Op.OR:  or_,
+    Op.LT:  operator.lt,
+    Op.LE:  operator.le,
+    Op.GT:  operator.gt,
+    Op.GE:  operator.ge,
+    Op.EQ:  operator.eq,
+    Op.NE:  operator.ne,
+}
+
+CMP_JUMPS = {
+    Op.JLT: operator.lt,
+    Op.JLE: operator.le,
+    Op.JGT: operator.gt,
+    Op.JGE: operator.ge,
+    Op.JEQ: operator.eq,
+    Op.JNE: operator.ne,
+}
+
+
+def translate(state, program):
+    stack = state.stack
+    push = stack.append
+    pop = stack.pop
+    frames = state.locals
+    callstack = state.callstack
+    globals = state.globals
+
+    def load(i, next):
+        def op():
+            push(frames[-1][i])
+            return next
+        return op
+
+    def store(i, next):
+        def op():
+            frames[-1][i] = pop()
+            return next
+        return op
+
+    def gload(i, next):
+        def op():
+            push(globals[i])
+            return next
+        return op
+
+    def gstore(i, next):
+        def op():
+            globals[i] = pop()
+            return next
+        return op
+
+    def const(val, next):
+        assert type(val) is int
+        def op():
+            push(val)
+            return next
+        return op
+
+    def arithmetic(f, next):
+        def op():
+            r = pop()
+            stack[-1] = f(stack[-1], r)
+            return next
+        return op
+
+    def logic(f, next):
+        def op():
+            r = pop()
+            stack[-1] = int(f(stack[-1], r))
+            return next
+        return op
+
+    def jmp(target, next):
+        def op():
+            return target
+        return op
+
+    def jz(target, next):
+        def op():
+            return next if pop() else target
+        return op
+
+    def jnz(target, next):
+        def op():
+            return target if pop() else next
+        return op
+
+    def cjump(f, target, next):
+        def op():
+            r = pop()
+            return target if f(pop(), r) else next
+        return op
+
+    def call(target, next):
+        def op():
+            callstack.append(next)
+            return target
+        return op
+
+    def syscall(number, next):
+        handler, n_args = SYSCALLS[number]
+        def op():
+            handler(state, *[pop() for _ in range(n_args)])
+            return next
+        return op
+
+    def ret(next):
+        def op():
+            frames.pop()
+            return callstack.pop()
+        return op
+
+    def enter(scope_type, n_args, n_locals, next):
+        zeros = [0] * n_locals
+        def op():
+            frame = [pop() for _ in range(n_args)]
+            frame += zeros
+            frames.append(frame)
+            return next
+        return op
+
+    def leave(next):
+        def op():
+            assert False, "Should be unreachable"
+        return op
+
+    def inc_local(i, val, next):
+        def op():
+            frames[-1][i] += val
+            return next
+        return op
+
+    def list_push_const(i, val, next):
+        def op():
+            push_list(state, frames[-1][i], val)
+            return next
+        return op
+
+    handlers = {
+        Op.LOAD:    load,
+        Op.STORE:   store,
+        Op.GLOAD:   gload,
+        Op.GSTORE:  gstore,
+        Op.CONST:   const,
+        Op.JMP:     jmp,
+        Op.JZ:      jz,
+        Op.JNZ:     jnz,
+        Op.CALL:    call,
+        Op.SYSCALL: syscall,
+        Op.RET:     ret,
+        Op.ENTER:   enter,
+        Op.LEAVE:   leave,
+        Op.INC_LOCAL:       inc_local,
+        Op.LIST_PUSH_CONST: list_push_const,
+    }
+
+    code = []
+    for ip, instruction in enumerate(program.instructions):
+        if instruction.op in ARITHMETIC:
+            code.append(arithmetic(ARITHMETIC[instruction.op], ip + 1))
+        elif instruction.op in LOGIC:
+            code.append(logic(LOGIC[instruction.op], ip + 1))
+        elif instruction.op in CMP_JUMPS:
+            code.append(cjump(CMP_JUMPS[instruction.op], *instruction.args, ip + 1))
+        else:
+            code.append(handlers[instruction.op](*instruction.args, ip + 1))
+    return code
+
+
+def execute(state, program):
+    code = translate(state, program)
+    ip = program.entry
+    state.ip = ip
+    try:
+        while True:
+            ip = code[ip]()
+    except ExitCode as e:
+        return e.code
+    finally:
+        state.ip = ip
+        state.flush()
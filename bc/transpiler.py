@@ -0,0 +1,492 @@
+import sys
+import builtins
+
+from . import cfg
+from . import syscall
+from .instruction import Op, STACK_EFFECTS
+from .runtime import ExitCode, SYSCALLS, push as push_list
+
+
+# Translates every function of a program into a Python function, which is
+# compiled once and cached. Args and locals become Python locals, the
+# operand stack is resolved at translation time into expressions and
+# temporaries, and the control-flow graph is rebuilt into while/if
+# statements. A function the structuring doesn't fit (it expects the loops
+# and branches the compiler emits for nox) falls back to a loop dispatching
+# on the block index.
+
+ARITHMETIC = {Op.ADD: '+', Op.SUB: '-', Op.MUL: '*'}
+# raise on a zero divisor, so they are evaluated in place
+DIVISION = {Op.DIV: '//', Op.MOD: '%'}
+COMPARISONS = {Op.LT: '<', Op.LE: '<=', Op.GT: '>', Op.GE: '>=', Op.EQ: '==', Op.NE: '!='}
+CMP_JUMPS = {Op.JLT: '<', Op.JLE: '<=', Op.JGT: '>', Op.JGE: '>=', Op.JEQ: '==', Op.JNE: '!='}
+LOGIC = {Op.AND: 'and', Op.OR: 'or'}
+
+# kinds of values: an int, a bool (which behaves like 0 or 1 in arithmetic)
+# and the operands of and/or, only their truth matters
+INT, BOOL, TRUTH = 'int', 'bool', 'truth'
+
+# marks reads of the globals in Value.reads
+GLOBALS = None
+
+# the translated functions recurse as deep as the nox program does
+RECURSION_LIMIT = 1 << 20
+
+# parentheses an expression nests before it goes into a temporary, the
+# parser of CPython stops at 200
+MAX_DEPTH = 50
+
+
+class Unstructured(Exception):
+    '''The control flow of a function doesn't map onto while and if'''
+
+
+class Value:
+    __slots__ = ('expr', 'reads', 'kind', 'depth')
+
+    def __init__(self, expr, reads=frozenset(), kind=INT, depth=0):
+        self.expr = expr
+        self.reads = reads
+        self.kind = kind
+        # parentheses nested in expr
+        self.depth = depth
+
+    def int(self):
+        '''The expression of the value as an int'''
+        if self.kind is INT:
+            return self.expr
+        return f'(1 if {self.expr} else 0)'
+
+    def operand(self):
+        '''The expression of the value inside arithmetic and comparisons'''
+        return self.int() if self.kind is TRUTH else self.expr
+
+
+class Function:
+    '''Translates a single function of the program'''
+
+    def __init__(self, program, graph, functions):
+        self.program = program
+        self.graph = graph
+        self.fn = graph.fn
+        self.blocks = graph.blocks
+        # Python names of the functions of the program
+        self.functions = functions
+        self.lines = []
+        self.temps = 0
+        self.heights = self.stack_heights()
+
+    def var(self, name):
+        return f'v_{name}'
+
+    def temp(self):
+        name = f't{self.temps}'
+        self.temps += 1
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def effect(self, instruction):
+        op = instruction.op
+        if op is Op.CALL:
+            callee = self.program.functions[instruction.args[0].name]
+            return len(callee.args), int(callee.returns_value)
+        if op is Op.SYSCALL:
+            s = syscall.by_number(instruction.args[0])
+            return len(s.args), int(s.returns_value)
+        return STACK_EFFECTS[op]
+
+    def stack_heights(self):
+        '''Operand stack height at the start of every reachable block'''
+        heights = {0: 0}
+        worklist = [0]
+        while worklist:
+            b = worklist.pop()
+            height = heights[b]
+            for instruction in self.blocks[b].instructions:
+                pops, pushes = self.effect(instruction)
+                height += pushes - pops
+            for successor in self.blocks[b].successors:
+                if successor not in heights:
+                    heights[successor] = height
+                    worklist.append(successor)
+        return heights
+
+    def block(self, b, indent):
+        '''Emits the code of block b up to its terminator and returns what
+        ends the block: ('next', None), ('jump', None), ('return', value),
+        ('leave', None) or ('branch', condition) with the condition true when
+        the jump is taken'''
+        stack = [Value(f's{k}') for k in range(self.heights[b])]
+
+        def materialize(keep):
+            # entries whose value a store is about to change get their own
+            # temporary first
+            for k, value in enumerate(stack):
+                if not keep(value):
+                    t = self.temp()
+                    self.emit(indent, f'{t} = {value.int()}')
+                    stack[k] = Value(t)
+
+        def pop_args(n):
+            return [stack.pop().int() for _ in range(n)]
+
+        def flush():
+            targets, values = [], []
+            for k, value in enumerate(stack):
+                if value.expr != f's{k}':
+                    targets.append(f's{k}')
+                    values.append(value.int())
+            if targets:
+                self.emit(indent, f'{", ".join(targets)} = {", ".join(values)}')
+
+        instructions = self.blocks[b].instructions
+        if b == 0:
+            assert instructions[0].op is Op.ENTER
+            instructions = instructions[1:]
+
+        for instruction in instructions:
+            op, args = instruction.op, instruction.args
+            if op is Op.LOAD:
+                stack.append(Value(self.var(args[0]), frozenset((args[0],))))
+            elif op is Op.STORE:
+                value = stack.pop()
+                materialize(lambda v: args[0] not in v.reads)
+                self.emit(indent, f'{self.var(args[0])} = {value.int()}')
+            elif op is Op.GLOAD:
+                index = self.program.globals.index(args[0])
+                stack.append(Value(f'G[{index}]', frozenset((GLOBALS,))))
+            elif op is Op.GSTORE:
+                value = stack.pop()
+                materialize(lambda v: GLOBALS not in v.reads)
+                self.emit(indent, f'G[{self.program.globals.index(args[0])}] = {value.int()}')
+            elif op is Op.CONST:
+                stack.append(Value(repr(args[0]) if args[0] >= 0 else f'({args[0]})'))
+            elif op in ARITHMETIC or op in COMPARISONS or op in LOGIC:
+                r = stack.pop()
+                l = stack.pop()
+                if op in ARITHMETIC:
+                    expr, kind = f'({l.operand()} {ARITHMETIC[op]} {r.operand()})', INT
+                elif op in COMPARISONS:
+                    expr, kind = f'({l.operand()} {COMPARISONS[op]} {r.operand()})', BOOL
+                else:
+                    expr, kind = f'({l.expr} {LOGIC[op]} {r.expr})', TRUTH
+                # int() may add another pair
+                depth = max(l.depth, r.depth) + 2
+                if depth > MAX_DEPTH:
+                    # evaluated where the stack machine evaluates it
+                    t = self.temp()
+                    self.emit(indent, f'{t} = {expr}')
+                    stack.append(Value(t, kind=kind))
+                else:
+                    stack.append(Value(expr, l.reads | r.reads, kind, depth))
+            elif op in DIVISION:
+                r = stack.pop()
+                l = stack.pop()
+                t = self.temp()
+                self.emit(indent, f'{t} = {l.operand()} {DIVISION[op]} {r.operand()}')
+                stack.append(Value(t))
+            elif op is Op.INC_LOCAL:
+                var, val = args
+                materialize(lambda v: var not in v.reads)
+                self.emit(indent, f'{self.var(var)} += {val}')
+            elif op is Op.LIST_PUSH_CONST:
+                var, val = args
+                self.emit(indent, f'push(state, {self.var(var)}, {val})')
+            elif op is Op.CALL:
+                name = args[0].name
+                callee = self.program.functions[name]
+                call = f'{self.functions[name]}({", ".join(pop_args(len(callee.args)))})'
+                # the callee may assign any global
+                materialize(lambda v: GLOBALS not in v.reads)
+                if callee.returns_value:
+                    t = self.temp()
+                    self.emit(indent, f'{t} = {call}')
+                    stack.append(Value(t))
+                else:
+                    self.emit(indent, call)
+            elif op is Op.SYSCALL:
+                number, s = args[0], syscall.by_number(args[0])
+                operands = pop_args(len(s.args))
+                if s.name == 'list_get':
+                    l, i = operands
+                    line = f'{l}[{i}]'
+                elif s.name == 'len':
+                    line = f'len({operands[0]})'
+                elif s.name == 'list_set':
+                    l, i, val = operands
+                    line = f'{l}[{i}] = {val}'
+                elif s.name == 'push':
+                    line = f'push(state, {", ".join(operands)})'
+                else:
+                    # the handler pushes its result onto the stack of the state
+                    line = f'sys{number}(state{"".join(", " + o for o in operands)})'
+                    if s.returns_value:
+                        self.emit(indent, line)
+                        line = 'pop()'
+                if s.returns_value:
+                    t = self.temp()
+                    self.emit(indent, f'{t} = {line}')
+                    stack.append(Value(t))
+                else:
+                    self.emit(indent, line)
+            elif op is Op.JMP:
+                flush()
+                return 'jump', None
+            elif op in (Op.JZ, Op.JNZ):
+                value = stack.pop()
+                flush()
+                return 'branch', value.expr if op is Op.JNZ else f'not {value.expr}'
+            elif op in CMP_JUMPS:
+                r = stack.pop()
+                l = stack.pop()
+                flush()
+                return 'branch', f'{l.operand()} {CMP_JUMPS[op]} {r.operand()}'
+            elif op is Op.RET:
+                return 'return', stack.pop().int() if stack else None
+            elif op is Op.LEAVE:
+                return 'leave', None
+            else:
+                assert False, f'Unknown instruction {instruction}'
+        flush()
+        return 'next', None
+
+    def terminate(self, kind, value, indent):
+        '''Emits the end of a block without successors'''
+        if kind == 'return':
+            self.emit(indent, 'return' if value is None else f'return {value}')
+        else:
+            self.emit(indent, "assert False, 'Should be unreachable'")
+
+    def post_dominators(self):
+        '''Immediate post-dominator of every reachable block, None when it is
+        the exit of the function or there is none'''
+        reachable = set(self.heights)
+        everything = frozenset(reachable)
+        # blocks from which the function can return
+        returning = {b for b in reachable if not self.blocks[b].successors}
+        worklist = list(returning)
+        while worklist:
+            for p in self.blocks[worklist.pop()].predecessors:
+                if p in reachable and p not in returning:
+                    returning.add(p)
+                    worklist.append(p)
+
+        pdom = {b: everything for b in reachable}
+        changed = True
+        while changed:
+            changed = False
+            for b in sorted(reachable, reverse=True):
+                successors = self.blocks[b].successors
+                new = frozenset((b,)).union(
+                    frozenset.intersection(*(pdom[s] for s in successors)) if successors else ())
+                if new != pdom[b]:
+                    pdom[b] = new
+                    changed = True
+
+        ipdom = {}
+        for b, dominators in pdom.items():
+            ipdom[b] = None
+            if b not in returning:
+                continue
+            for d in dominators - {b}:
+                if len(pdom[d]) == len(dominators) - 1:
+                    ipdom[b] = d
+        return ipdom
+
+    def structured(self):
+        self.ipdom = self.post_dominators()
+        self.loops = {loop.header: loop for loop in self.graph.loops}
+        # blocks emitted inside every loop and the block after it
+        self.bodies = {}
+        self.exits = {}
+        for header, loop in self.loops.items():
+            exits = {
+                s for b in loop.blocks for s in self.blocks[b].successors
+                if s not in loop.blocks
+            }
+            # a return from the loop is emitted in it
+            returns = {
+                s for s in exits
+                if not self.blocks[s].successors
+                and all(p in loop.blocks for p in self.blocks[s].predecessors)
+            }
+            self.bodies[header] = loop.blocks | returns
+            exits -= returns
+            if len(exits) > 1:
+                raise Unstructured(f'Loop at block {header} with several exits')
+            self.exits[header] = exits.pop() if exits else None
+        self.emitted = set()
+        self.region(0, None, None, 1)
+
+    def leave(self, b, loop):
+        '''The statement jumping to b if the jump leaves the region of loop'''
+        if loop is not None and b == loop.header:
+            return 'continue'
+        if loop is not None and b == self.exits[loop.header]:
+            return 'break'
+        return None
+
+    def region(self, b, stop, loop, indent, entering=False):
+        '''Emits the blocks from b until stop, within loop'''
+        start = len(self.lines)
+        while b != stop:
+            if not entering and self.leave(b, loop):
+                self.emit(indent, self.leave(b, loop))
+                break
+            if loop is not None and b not in self.bodies[loop.header]:
+                raise Unstructured(f'Block {b} leaves the loop at {loop.header}')
+            if b in self.loops and not entering:
+                inner = self.loops[b]
+                self.emit(indent, 'while True:')
+                body = len(self.lines)
+                self.region(b, None, inner, indent + 1, entering=True)
+                if self.lines[-1].strip() == 'continue' and len(self.lines) > body + 1:
+                    self.lines.pop()
+                b = self.exits[b]
+                if b is None:
+                    break
+                continue
+            entering = False
+
+            if b in self.emitted:
+                raise Unstructured(f'Block {b} is reached twice')
+            self.emitted.add(b)
+            block = self.blocks[b]
+            kind, value = self.block(b, indent)
+            if kind in ('return', 'leave'):
+                self.terminate(kind, value, indent)
+                break
+            if kind == 'next':
+                b = block.fallthrough
+                continue
+            if kind == 'jump':
+                b = block.target
+                continue
+
+            taken, not_taken = block.target, block.fallthrough
+            join = self.ipdom[b]
+            if loop is not None and join not in self.bodies[loop.header]:
+                join = None
+            if self.leave(taken, loop):
+                self.emit(indent, f'if {value}:')
+                self.emit(indent + 1, self.leave(taken, loop))
+                b = not_taken
+            elif self.leave(not_taken, loop):
+                self.emit(indent, f'if not ({value}):')
+                self.emit(indent + 1, self.leave(not_taken, loop))
+                b = taken
+            elif not_taken == join:
+                self.emit(indent, f'if {value}:')
+                self.branch(taken, join if join is not None else stop, loop, indent + 1)
+                b = join
+            elif taken == join:
+                self.emit(indent, f'if not ({value}):')
+                self.branch(not_taken, join, loop, indent + 1)
+                b = join
+            else:
+                self.emit(indent, f'if {value}:')
+                self.branch(taken, join if join is not None else stop, loop, indent + 1)
+                self.emit(indent, 'else:')
+                self.branch(not_taken, join if join is not None else stop, loop, indent + 1)
+                b = join
+            if b is None:
+                break
+        return len(self.lines) > start
+
+    def branch(self, b, stop, loop, indent):
+        if not self.region(b, stop, loop, indent):
+            self.emit(indent, 'pass')
+
+    def dispatch(self):
+        '''The fallback: a loop running a block at a time'''
+        self.lines = []
+        self.temps = 0
+        self.emit(1, 'b = 0')
+        self.emit(1, 'while True:')
+        first = True
+        for b in sorted(self.heights):
+            block = self.blocks[b]
+            self.emit(2, f'{"if" if first else "elif"} b == {b}:')
+            first = False
+            kind, value = self.block(b, 3)
+            if kind in ('return', 'leave'):
+                self.terminate(kind, value, 3)
+            elif kind == 'next':
+                self.emit(3, f'b = {block.fallthrough}')
+            elif kind == 'jump':
+                self.emit(3, f'b = {block.target}')
+            else:
+                self.emit(3, f'b = {block.target} if {value} else {block.fallthrough}')
+
+    def translate(self):
+        name = self.functions[self.fn.name]
+        args = ', '.join(self.var(arg) for arg in self.fn.args)
+        try:
+            self.structured()
+        except Unstructured:
+            self.dispatch()
+
+        header = [f'def {name}({args}):']
+        if self.fn.locals:
+            # ENTER zeroes the locals
+            header.append(f'    {" = ".join(self.var(var) for var in self.fn.locals)} = 0')
+        return header + self.lines
+
+
+def translate(program):
+    '''Returns the Python source of program, a function for every function of
+    the program named f_<name>'''
+    graphs = cfg.build(program)
+    functions = {name: f'f_{name}' for name in program.functions}
+    lines = []
+    for name, graph in graphs.items():
+        lines += Function(program, graph, functions).translate()
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def entry(program):
+    '''Name of the function at program.entry'''
+    return program.starts()[program.entry].name
+
+
+# compiled programs by id, the program is kept so the id isn't reused
+CACHE_SIZE = 16
+cache = {}
+
+
+def compile(program):
+    '''Returns the code object of the translated program and the Python name
+    of its entry function, translating only the first time'''
+    cached = cache.get(id(program))
+    if cached is not None and cached[0] is program:
+        return cached[1:]
+    code = builtins.compile(translate(program), f'<nox {id(program):x}>', 'exec')
+    if len(cache) >= CACHE_SIZE:
+        del cache[next(iter(cache))]
+    cache[id(program)] = program, code, f'f_{entry(program)}'
+    return code, f'f_{entry(program)}'
+
+
+def execute(state, program):
+    code, main = compile(program)
+    namespace = {
+        'state': state,
+        'G': state.globals,
+        'pop': state.stack.pop,
+        'push': push_list,
+        **{f'sys{number}': handler for number, (handler, _) in SYSCALLS.items()},
+    }
+    exec(code, namespace)
+
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, RECURSION_LIMIT))
+    try:
+        namespace[main]()
+    except ExitCode as e:
+        return e.code
+    finally:
+        sys.setrecursionlimit(limit)
+        state.flush()
@@ -0,0 +1,115 @@
+'''Runs allocation heavy programs on the x64 binary and vm.c with a runtime
+built with ALLOC_STATS, reports the time and the allocator statistics
+
+Builds with driver.py, so nasm and a C compiler have to be in PATH.
+
+Usage: python -m bench.alloc [n]
+'''
+import os
+import sys
+import tempfile
+import subprocess
+
+import syntax
+import bc
+import x64
+import driver
+from bench.common import root, timeit
+
+
+programs = {
+    'string building': '''
+fn join(a, b) -> str {
+    s = slice(a, -1, -1)
+    for i = 0, i < len(b), i = i + 1 {
+        push(s, b[i])
+    }
+    return s
+}
+
+n = input()
+total = 0
+for i = 0, i < n, i = i + 1 {
+    s = join("hello, ", "world")
+    total = total + len(s)
+}
+print(total)
+''',
+    'list literals in a loop': '''
+fn sum(xs) -> int {
+    s = 0
+    for i = 0, i < len(xs), i = i + 1 {
+        s = s + xs[i]
+    }
+    return s
+}
+
+n = input()
+total = 0
+for i = 0, i < n, i = i + 1 {
+    total = total + sum([i, i + 1, i + 2]) + sum([i])
+}
+print(total)
+''',
+    'growing lists': '''
+n = input()
+total = 0
+for i = 0, i < n / 100, i = i + 1 {
+    xs = []
+    for j = 0, j < 100 + i % 100, j = j + 1 {
+        push(xs, j)
+    }
+    total = total + len(xs)
+}
+print(total)
+''',
+}
+
+
+def run(inp, *args):
+    status = subprocess.run(args, input=inp.encode(), capture_output=True, check=True)
+    return status.stdout.decode(), status.stderr.decode()
+
+
+def stats(stderr):
+    return dict(
+        (name.strip(), int(val))
+        for name, val in (line.split(':') for line in stderr.splitlines())
+    )
+
+
+def main(n=1_000_000):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            rt = driver.compile(driver.runtime(), definitions=['ALLOC_STATS'])
+            vm_source = os.path.join(root, 'vm.c')
+            driver.build(vm_source, [rt], with_runtime=False)
+            vm = os.path.join(tmp, 'vm' + driver.exe_ext)
+            os.replace(driver.executable(vm_source), vm)
+
+            inp = f'{n}\n'
+            for i, (name, source) in enumerate(programs.items()):
+                program = bc.compile(syntax.parse(source))
+                asm_file = os.path.join(tmp, f'program{i}.s')
+                with open(asm_file, 'wt') as f:
+                    x64.compile(program, f)
+                driver.build(asm_file, [rt], with_runtime=False)
+
+                bytecode = os.path.join(tmp, f'program{i}.noxbc')
+                with open(bytecode, 'wb') as f:
+                    f.write(program.serialize())
+
+                for backend, args in ('x64', [driver.executable(asm_file)]), ('vm.c', [vm, bytecode]):
+                    elapsed, (output, stderr) = timeit(run, inp, *args)
+                    s = stats(stderr)
+                    print(f'{name:<24} {backend:<5} {elapsed:.3f}s, {s["allocations"]} allocations, '
+                          f'{s["live bytes"]} bytes live at exit, peak {s["peak bytes"]}, '
+                          f'mapped {s["mapped bytes"]}')
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,55 @@
+'''Measures Program.build time and peak memory on large synthetic programs,
+next to the deepcopy of the instructions the build used to start with
+
+Usage: python -m bench.build [n_lines ...]
+'''
+import sys
+import copy
+import tracemalloc
+
+import syntax
+import bc
+from bc import compiler, optimizer
+from bench.common import timeit, synthetic_program
+
+
+def instructions(n_lines):
+    '''The optimized instructions bc.compile builds a Program from'''
+    c = compiler.Compiler()
+    c.compile(syntax.parse(synthetic_program(n_lines)))
+    return optimizer.optimize(c.instructions, 1)
+
+
+def peak(f, *args):
+    '''Bytes allocated at most while f runs, over what is allocated before'''
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        f(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - base
+
+
+def main(*sizes):
+    sizes = sizes or (10_000, 20_000, 40_000)
+    for n_lines in sizes:
+        source = instructions(n_lines)
+        n = len(source)
+
+        t_build, program = timeit(bc.Program.build, source)
+        t_copy, _ = timeit(copy.deepcopy, source, repeat=1)
+        # building doesn't modify its input, so it can be built again
+        assert str(bc.Program.build(source)) == str(program)
+        m_build = peak(bc.Program.build, source)
+        m_copy = peak(copy.deepcopy, source)
+
+        print(f'{n_lines:>7} lines, {n:>8} instructions: build {t_build:.3f}s '
+              f'({t_build / n * 1e6:.2f}us/instruction), peak {m_build / 2**20:.1f} MiB; '
+              f'deepcopy {t_copy:.3f}s, peak {m_copy / 2**20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,66 @@
+'''Compares the version 1 and version 2 .noxbc formats: file sizes of the
+tests and of large synthetic programs, and the time vm.c takes to load and
+run them
+
+Builds with driver.py, so a C compiler has to be in PATH.
+
+Usage: python -m bench.bytecode [scale] [synthetic lines]
+'''
+import os
+import sys
+import tempfile
+
+import syntax
+import bc
+import driver
+from bench.common import timeit, corpus, synthetic_program
+from bench.dispatch import build_vm, run, workloads
+
+
+def write(tmp, name, data):
+    path = os.path.join(tmp, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def main(scale=100, n_lines=100_000):
+    sizes = [0, 0]
+    for source in corpus():
+        program = bc.compile(syntax.parse(source))
+        for i, version in enumerate((1, 2)):
+            sizes[i] += len(program.serialize(version))
+    print(f'{"tests":<28} v1 {sizes[0]} bytes, v2 {sizes[1]} bytes, {sizes[0] / sizes[1]:.2f}x smaller')
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            rt = driver.compile(driver.runtime())
+            vm = build_vm(rt, os.path.join(tmp, 'vm' + driver.exe_ext), [])
+
+            # loading dominates, the program prints a line per function
+            program = bc.compile(syntax.parse(synthetic_program(n_lines)))
+            v1, v2 = program.serialize(1), program.serialize(2)
+            t1, expected = timeit(run, vm, write(tmp, 'synthetic1.noxbc', v1), '')
+            t2, output = timeit(run, vm, write(tmp, 'synthetic2.noxbc', v2), '')
+            assert output == expected
+            print(f'{f"synthetic {n_lines} lines":<28} v1 {len(v1)} bytes {t1:.3f}s, '
+                  f'v2 {len(v2)} bytes {t2:.3f}s, {len(v1) / len(v2):.2f}x smaller')
+
+            total1 = total2 = 0
+            for i, (name, source, inp) in enumerate(workloads(scale)):
+                program = bc.compile(syntax.parse(source))
+                t1, expected = timeit(run, vm, write(tmp, f'program{i}_1.noxbc', program.serialize(1)), inp)
+                t2, output = timeit(run, vm, write(tmp, f'program{i}_2.noxbc', program.serialize(2)), inp)
+                assert output == expected, name
+                total1 += t1
+                total2 += t2
+                print(f'{name:<28} v1 {t1:.3f}s, v2 {t2:.3f}s')
+            print(f'{"total":<28} v1 {total1:.3f}s, v2 {total2:.3f}s')
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,40 @@
+'''Measures x64 code generation time on large synthetic .noxtbc programs
+
+Usage: python -m bench.codegen [n_lines ...]
+'''
+import os
+import sys
+import time
+import tempfile
+
+import syntax
+import bc
+import x64
+from bench.common import synthetic_program
+
+
+def main(*sizes):
+    sizes = sizes or (10_000, 20_000, 40_000, 80_000)
+    for n_lines in sizes:
+        # go through the textual bytecode, the way driver.main compiles .noxtbc
+        text = str(bc.compile(syntax.parse(synthetic_program(n_lines))))
+        program = bc.parse(text)
+        n = len(program.instructions)
+
+        start = time.perf_counter()
+        listing = x64.compile(program)
+        to_string = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            with open(os.path.join(tmp, 'program.s'), 'wt') as f:
+                x64.compile(program, f)
+            to_file = time.perf_counter() - start
+
+        print(f'{n_lines:>7} lines, {n:>8} instructions, {len(program.functions):>5} functions: '
+              f'to string {to_string:.3f}s ({to_string / n * 1e6:.2f}us/instruction), '
+              f'to file {to_file:.3f}s, {len(listing) / 2**20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,64 @@
+import os
+import glob
+import time
+import random
+
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def corpus():
+    files = sorted(glob.glob(os.path.join(root, 'tests', '*.nox')))
+    return [open(f, 'rt', encoding='utf-8').read() for f in files]
+
+
+def timeit(f, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def synthetic_function(i, rng):
+    name = f'f{i}'
+    lines = [
+        f'fn {name}(a, b) -> int {{',
+        '    s = 0',
+        '    i = 0',
+        f'    while i < a + {rng.randint(1, 100)} {{',
+        f'        if i % {rng.randint(2, 9)} == 0 && b > {rng.randint(0, 9)} {{',
+        f'            s = s + i * {rng.randint(1, 9)}',
+        '        }',
+        '        else if i > b {',
+        f'            s = s - (b - {rng.randint(1, 9)}) / 2',
+        '        }',
+        '        else {',
+        '            s = s + 1',
+        '        }',
+        '        i = i + 1',
+        '    }',
+        f'    xs = [a, b, s, {rng.randint(0, 1000)}]',
+        '    for j = 0, j < len(xs), j = j + 1 {',
+        '        xs[j] = xs[j] * 2',
+        '    }',
+        '    return s + xs[2]',
+        '}',
+    ]
+    return lines
+
+
+def synthetic_program(n_lines, seed=0):
+    '''Generates a valid nox program with roughly n_lines lines of code'''
+    rng = random.Random(seed)
+    functions = []
+    n = 0
+    while n + 1 < n_lines:
+        lines = synthetic_function(len(functions), rng)
+        functions.append(lines)
+        n += len(lines) + 1
+
+    main = [f'print(f{i}({i}, {i % 7}))' for i in range(len(functions))]
+    return '\n'.join(line for f in functions for line in f) + '\n' + '\n'.join(main) + '\n'
@@ -0,0 +1,56 @@
+'''Compares programs built with Instruction objects and with Code: memory kept
+by the program, bc.execute and Program.serialize times on large synthetic
+programs
+
+Usage: python -m bench.compact [n_lines ...]
+'''
+import io
+import sys
+import contextlib
+import tracemalloc
+
+import bc
+from bench.build import instructions
+from bench.common import timeit
+
+
+def retained(f, *args):
+    '''Returns the result of f and the bytes still allocated for it'''
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        result = f(*args)
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current - base
+
+
+def run(program):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        assert bc.execute(bc.State(program), program) == 0
+    return out.getvalue()
+
+
+def main(*sizes):
+    sizes = sizes or (5_000, 10_000, 20_000)
+    for n_lines in sizes:
+        source = instructions(n_lines)
+        line = f'{n_lines:>7} lines:'
+        results = []
+        for compact in False, True:
+            program, memory = retained(bc.Program.build, source, 'main', compact)
+            t_run, output = timeit(run, program, repeat=1)
+            t_v1, v1 = timeit(program.serialize, 1)
+            t_v2, v2 = timeit(program.serialize, 2)
+            results.append((output, v1, v2))
+            kind = 'Code' if compact else 'list'
+            line += (f' {kind} {memory / 2**20:.1f} MiB, execute {t_run:.3f}s, '
+                     f'serialize v1 {t_v1:.3f}s, v2 {t_v2:.3f}s;')
+        assert results[0] == results[1]
+        print(f'{line} {len(program.instructions)} instructions')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,78 @@
+'''Compares the switch and the computed goto dispatch of vm.c
+
+Builds with driver.py, so a C compiler supporting computed goto has to be in
+PATH.
+
+Usage: python -m bench.dispatch [scale]
+'''
+import os
+import sys
+import glob
+import tempfile
+import subprocess
+
+import syntax
+import bc
+import driver
+from bench.common import root, timeit
+from bench.interpreter import programs, scaled
+
+
+def build_vm(rt, out, definitions):
+    vm = os.path.join(root, 'vm.c')
+    driver.build(vm, [rt], with_runtime=False, definitions=definitions)
+    os.replace(driver.executable(vm), out)
+    return out
+
+
+def run(vm, bytecode, inp):
+    status = subprocess.run([vm, bytecode], input=inp.encode(), capture_output=True, check=True)
+    return status.stdout.decode()
+
+
+def workloads(scale):
+    for name, make in programs.items():
+        yield name, *make(scale)
+
+    # the tests with loop bounds that can be scaled
+    for file in sorted(glob.glob(os.path.join(root, 'tests', '*.nox'))):
+        source = scaled(os.path.basename(file), scale)
+        if source == scaled(os.path.basename(file), 1):
+            continue
+        with open(file.replace('.nox', '.in'), 'rt', encoding='utf-8') as f:
+            inp = f.read()
+        yield os.path.relpath(file, root), source, inp
+
+
+def main(scale=100):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            rt = driver.compile(driver.runtime())
+            switch = build_vm(rt, os.path.join(tmp, 'vm_switch' + driver.exe_ext), ['SWITCH_DISPATCH'])
+            threaded = build_vm(rt, os.path.join(tmp, 'vm_threaded' + driver.exe_ext), [])
+
+            total_switch = total_threaded = 0
+            for i, (name, source, inp) in enumerate(workloads(scale)):
+                program = bc.compile(syntax.parse(source))
+                bytecode = os.path.join(tmp, f'program{i}.noxbc')
+                with open(bytecode, 'wb') as f:
+                    f.write(program.serialize())
+
+                t_switch, expected = timeit(run, switch, bytecode, inp)
+                t_threaded, output = timeit(run, threaded, bytecode, inp)
+                assert output == expected, name
+                total_switch += t_switch
+                total_threaded += t_threaded
+                print(f'{name:<28} switch {t_switch:.3f}s, threaded {t_threaded:.3f}s, '
+                      f'speedup {t_switch / t_threaded:.2f}x')
+
+            print(f'{"total":<28} switch {total_switch:.3f}s, threaded {total_threaded:.3f}s, '
+                  f'speedup {total_switch / total_threaded:.2f}x')
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,59 @@
+'''Compares bc.execute with the closure-compiled bc.threaded.execute and the
+Python functions of bc.transpiler.execute
+
+Usage: python -m bench.interpreter [scale]
+'''
+import os
+import io
+import sys
+import contextlib
+
+import syntax
+import bc
+from bench.common import root, timeit
+
+
+def scaled(name, scale):
+    with open(os.path.join(root, 'tests', name), 'rt', encoding='utf-8') as f:
+        source = f.read()
+    # tests/10.nox: nested loops with 10 iterations each
+    return source.replace('< 10', f'< {10 * scale}')
+
+
+programs = {
+    'nested loops (tests/10.nox)': lambda scale: (scaled('10.nox', scale), ''),
+    'prime search (tests/15.nox)': lambda scale: (scaled('15.nox', scale), f'{50 * scale}\n'),
+    'prime search (tests/20.nox)': lambda scale: (scaled('20.nox', scale), f'{50 * scale}\n'),
+}
+
+
+def run(execute, program, inp):
+    out = io.StringIO()
+    original = sys.stdin
+    sys.stdin = io.StringIO(inp)
+    try:
+        with contextlib.redirect_stdout(out):
+            assert execute(bc.State(program), program) == 0
+    finally:
+        sys.stdin = original
+    return out.getvalue()
+
+
+def main(scale=20):
+    for name, make in programs.items():
+        source, inp = make(scale)
+        program = bc.compile(syntax.parse(source))
+        t_execute, expected = timeit(run, bc.execute, program, inp)
+        t_threaded, output = timeit(run, bc.threaded.execute, program, inp)
+        assert output == expected
+        # the first run translates and compiles, the others use the cache
+        t_compile, _ = timeit(bc.transpiler.compile, program, repeat=1)
+        t_transpiled, output = timeit(run, bc.transpiler.execute, program, inp)
+        assert output == expected
+        print(f'{name:<28} execute {t_execute:.3f}s, threaded {t_threaded:.3f}s, '
+              f'speedup {t_execute / t_threaded:.2f}x, transpiled {t_transpiled:.3f}s '
+              f'(compiled in {t_compile:.3f}s), speedup {t_execute / t_transpiled:.2f}x')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
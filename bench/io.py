@@ -0,0 +1,99 @@
+'''Measures stdin/stdout throughput of the Python interpreter, with and
+without fast_io, and of the x64 binary and vm.c
+
+The native legs build with driver.py, so nasm and a C compiler have to be in
+PATH.
+
+Usage: python -m bench.io [n_ints] [n_ints for the interpreter]
+'''
+import os
+import sys
+import random
+import tempfile
+import subprocess
+
+import syntax
+import bc
+import x64
+import driver
+from bench.common import root, timeit
+
+
+# echoes n integers, every one is read and printed
+source = '''
+n = input()
+for i = 0, i < n, i = i + 1 {
+    print(input())
+}
+'''
+
+# the interpreter runs in a child process, so it reads and writes real pipes
+interpreter = '''
+import sys
+sys.path.insert(0, sys.argv[3])
+import bc
+with open(sys.argv[1], 'rt') as f:
+    program = bc.parse(f.read())
+bc.execute(bc.State(program, fast_io=sys.argv[2] == 'fast'), program)
+'''
+
+
+def run(args, inp):
+    status = subprocess.run(args, input=inp, capture_output=True, check=True)
+    return status.stdout
+
+
+def make_input(n):
+    rng = random.Random(0)
+    ints = [rng.randint(-2**40, 2**40) for _ in range(n)]
+    inp = f'{n}\n'.encode() + ''.join(f'{i}\n' for i in ints).encode()
+    return inp, inp[inp.index(b'\n') + 1:]
+
+
+def measure(name, n, args):
+    inp, expected = make_input(n)
+    elapsed, output = timeit(run, args, inp)
+    assert output == expected, name
+    mib = (len(inp) + len(output)) / 2**20
+    print(f'{name:<18} {n} ints in {elapsed:.3f}s: {n / elapsed / 1e6:.2f}M ints/s, '
+          f'{mib / elapsed:.1f} MiB/s')
+
+
+def main(n=1_000_000, n_interpreter=100_000):
+    program = bc.compile(syntax.parse(source))
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        text = os.path.join(tmp, 'echo.noxtbc')
+        with open(text, 'wt') as f:
+            f.write(str(program))
+
+        for mode in 'print', 'fast':
+            args = [sys.executable, '-c', interpreter, text, mode, root]
+            measure(f'bc.execute {mode}', n_interpreter, args)
+
+        os.chdir(tmp)
+        try:
+            rt = driver.compile(driver.runtime())
+            vm_source = os.path.join(root, 'vm.c')
+            driver.build(vm_source, [rt], with_runtime=False)
+            vm = os.path.join(tmp, 'vm' + driver.exe_ext)
+            os.replace(driver.executable(vm_source), vm)
+
+            asm_file = os.path.join(tmp, 'echo.s')
+            with open(asm_file, 'wt') as f:
+                x64.compile(program, f)
+            driver.build(asm_file, [rt], with_runtime=False)
+
+            bytecode = os.path.join(tmp, 'echo.noxbc')
+            with open(bytecode, 'wb') as f:
+                f.write(program.serialize())
+
+            measure('x64', n, [driver.executable(asm_file)])
+            measure('vm.c', n, [vm, bytecode])
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,64 @@
+'''Compares the Python interpreters with the x64 binary and vm.c
+
+Builds with driver.py, so nasm and a C compiler have to be in PATH.
+
+Usage: python -m bench.native [scale]
+'''
+import os
+import sys
+import tempfile
+import subprocess
+
+import syntax
+import bc
+import x64
+import driver
+from bench.common import root, timeit
+from bench.interpreter import programs, run
+
+
+def run_binary(inp, *args):
+    status = subprocess.run(args, input=inp.encode(), capture_output=True, check=True)
+    return status.stdout.decode()
+
+
+def main(scale=20):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            rt = driver.compile(driver.runtime())
+            vm_source = os.path.join(root, 'vm.c')
+            driver.build(vm_source, [rt], with_runtime=False)
+            vm = driver.executable(vm_source)
+
+            for i, (name, make) in enumerate(programs.items()):
+                source, inp = make(scale)
+                program = bc.compile(syntax.parse(source))
+
+                asm_file = os.path.join(tmp, f'program{i}.s')
+                with open(asm_file, 'wt') as f:
+                    x64.compile(program, f)
+                driver.build(asm_file, [rt], with_runtime=False)
+                binary = driver.executable(asm_file)
+
+                bytecode = os.path.join(tmp, f'program{i}.noxbc')
+                with open(bytecode, 'wb') as f:
+                    f.write(program.serialize())
+
+                t_execute, expected = timeit(run, bc.execute, program, inp)
+                t_threaded, output = timeit(run, bc.threaded.execute, program, inp)
+                assert output == expected
+                t_binary, output = timeit(run_binary, inp, binary)
+                assert output == expected
+                t_vm, output = timeit(run_binary, inp, vm, bytecode)
+                assert output == expected
+                print(f'{name:<28} execute {t_execute:.3f}s, threaded {t_threaded:.3f}s, '
+                      f'vm.c {t_vm:.3f}s ({t_execute / t_vm:.0f}x), '
+                      f'x64 {t_binary:.3f}s ({t_execute / t_binary:.0f}x)')
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,53 @@
+'''Compares instruction counts (static and executed) across optimization levels
+
+Usage: python -m bench.optimizer [scale]
+'''
+import os
+import sys
+import glob
+
+import syntax
+import bc
+from bench.common import root
+from bench.interpreter import programs
+from bench.peephole import count
+
+levels = (0, 1, 2)
+
+
+def compare(name, source, inp):
+    ast = syntax.parse(source)
+    static = []
+    executed = []
+    for level in levels:
+        program = bc.compile(ast, level)
+        static.append(len(program.instructions))
+        executed.append(sum(count(program, inp).values()))
+
+    print(f'{name:<28} static ' + ' -> '.join(f'{n:>6}' for n in static) +
+          '   executed ' + ' -> '.join(f'{n:>8}' for n in executed))
+    return static, executed
+
+
+def main(scale=20):
+    print(f'{"":<28} levels {levels}')
+    for name, make in programs.items():
+        compare(name, *make(scale))
+
+    total_static = [0] * len(levels)
+    total_executed = [0] * len(levels)
+    for file in sorted(glob.glob(os.path.join(root, 'tests', '*.nox'))):
+        with open(file, 'rt', encoding='utf-8') as f:
+            source = f.read()
+        with open(file.replace('.nox', '.in'), 'rt', encoding='utf-8') as f:
+            inp = f.read()
+        static, executed = compare(os.path.basename(file), source, inp)
+        total_static = [a + b for a, b in zip(total_static, static)]
+        total_executed = [a + b for a, b in zip(total_executed, executed)]
+
+    print(f'{"tests/*.nox":<28} static ' + ' -> '.join(f'{n:>6}' for n in total_static) +
+          '   executed ' + ' -> '.join(f'{n:>8}' for n in total_executed))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,31 @@
+'''Measures x64.compile with 1 to N worker processes on a large synthetic
+program, the listing is the same for every number of workers
+
+Usage: python -m bench.parallel [n_lines] [max_workers]
+'''
+import os
+import sys
+
+import syntax
+import bc
+import x64
+from bench.common import synthetic_program, timeit
+
+
+def main(n_lines=40_000, max_workers=None):
+    max_workers = max_workers or os.cpu_count() or 1
+    program = bc.compile(syntax.parse(synthetic_program(n_lines)))
+    print(f'{n_lines} lines, {len(program.instructions)} instructions, '
+          f'{len(program.functions)} functions, {os.cpu_count()} CPUs')
+
+    serial = None
+    for workers in range(1, max_workers + 1):
+        elapsed, listing = timeit(x64.compile, program, None, workers)
+        if serial is None:
+            serial, expected = elapsed, listing
+        assert listing == expected
+        print(f'{workers:>3} workers: {elapsed:.3f}s, speedup {serial / elapsed:.2f}x')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
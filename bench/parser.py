@@ -0,0 +1,44 @@
+'''Compares Earley and LALR parsing of nox sources
+
+Usage: python -m bench.parser [n_lines]
+'''
+import sys
+import time
+
+from lark import Lark
+
+import syntax
+from bench.common import corpus, synthetic_program, timeit
+
+
+def main(n_lines=100_000):
+    start = time.perf_counter()
+    earley = Lark(syntax.language_grammar)
+    print(f'earley: grammar analysis {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    lalr = Lark(syntax.language_grammar, parser='lalr')
+    print(f'lalr:   grammar analysis {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    Lark(syntax.language_grammar, parser='lalr', cache=True)
+    print(f'lalr:   cached load      {time.perf_counter() - start:.3f}s')
+
+    sources = corpus()
+    parse_all = lambda parser: [parser.parse(s) for s in sources]
+    t_earley, trees = timeit(parse_all, earley)
+    t_lalr, lalr_trees = timeit(parse_all, lalr)
+    assert trees == lalr_trees
+    print(f'tests/*.nox ({len(sources)} files): earley {t_earley:.3f}s, lalr {t_lalr:.3f}s, '
+          f'speedup {t_earley / t_lalr:.1f}x')
+
+    program = synthetic_program(n_lines)
+    t_lalr, tree = timeit(lalr.parse, program, repeat=1)
+    t_earley, earley_tree = timeit(earley.parse, program, repeat=1)
+    assert tree == earley_tree
+    print(f'synthetic ({n_lines} lines): earley {t_earley:.3f}s, lalr {t_lalr:.3f}s, '
+          f'speedup {t_earley / t_lalr:.1f}x')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,68 @@
+'''Counts executed instructions with and without superinstructions
+
+Usage: python -m bench.peephole [scale]
+'''
+import io
+import sys
+import glob
+import os
+import contextlib
+
+from collections import Counter
+
+import syntax
+import bc
+from bench.common import root
+from bench.interpreter import programs
+
+
+def count(program, inp):
+    counter = Counter()
+
+    def counted(op, handler):
+        def wrapper(state, *args):
+            counter[op] += 1
+            handler(state, *args)
+        return wrapper
+
+    handlers = {op: counted(op, handler) for op, handler in bc.runtime.HANDLERS.items()}
+    original = sys.stdin
+    sys.stdin = io.StringIO(inp)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            bc.execute(bc.State(program), program, handlers)
+    finally:
+        sys.stdin = original
+    return counter
+
+
+def compare(name, source, inp):
+    ast = syntax.parse(source)
+    before = count(bc.compile(ast, level=0), inp)
+    after = count(bc.compile(ast, level=1), inp)
+    n_before = sum(before.values())
+    n_after = sum(after.values())
+    fused = ', '.join(f'{op}={n}' for op, n in after.most_common() if op.value >= bc.Op.INC_LOCAL.value)
+    print(f'{name:<28} {n_before:>10} -> {n_after:>10} ({n_after / n_before:.0%})  {fused}')
+    return n_before, n_after
+
+
+def main(scale=20):
+    for name, make in programs.items():
+        compare(name, *make(scale))
+
+    total_before = total_after = 0
+    for file in sorted(glob.glob(os.path.join(root, 'tests', '*.nox'))):
+        with open(file, 'rt', encoding='utf-8') as f:
+            source = f.read()
+        with open(file.replace('.nox', '.in'), 'rt', encoding='utf-8') as f:
+            inp = f.read()
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_before, n_after = compare(file, source, inp)
+        total_before += n_before
+        total_after += n_after
+    print(f'{"tests/*.nox":<28} {total_before:>10} -> {total_after:>10} ({total_after / total_before:.0%})')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,45 @@
+// Runs a command and writes its peak RSS (ru_maxrss) to a file, for
+// bench/suite.py. Linux keeps the peak of the process that execs, so the peak
+// of a child started from Python counts the memory of Python: the command is
+// forked from this small process instead.
+//
+// Usage: rss OUT command [arg ...]
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <sys/resource.h>
+#include <sys/wait.h>
+
+int main(int argc, char** argv) {
+  if (argc < 3) {
+    fputs("Usage: rss OUT command [arg ...]\n", stderr);
+    return 2;
+  }
+
+  pid_t pid = fork();
+  if (pid < 0) {
+    perror("fork");
+    return 2;
+  }
+  if (pid == 0) {
+    execvp(argv[2], argv + 2);
+    perror("exec");
+    _exit(127);
+  }
+
+  int status;
+  struct rusage usage;
+  if (wait4(pid, &status, 0, &usage) < 0) {
+    perror("wait4");
+    return 2;
+  }
+
+  FILE* out = fopen(argv[1], "w");
+  if (!out) {
+    perror("fopen");
+    return 2;
+  }
+  fprintf(out, "%ld\n", usage.ru_maxrss);
+  fclose(out);
+  return WIFEXITED(status) ? WEXITSTATUS(status) : 128 + WTERMSIG(status);
+}
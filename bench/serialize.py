@@ -0,0 +1,65 @@
+'''Measures Program.serialize and Program.deserialize on programs with up to
+a million instructions, against the serializer that concatenated bytes
+
+Usage: python -m bench.serialize [n_instructions]
+'''
+import sys
+
+import syntax
+import bc
+from bc.instruction import Op, Instruction, JUMPS, symbolic, list_functions
+from bench.common import timeit, synthetic_program
+
+
+def concatenated(program):
+    # the version 1 serializer before it wrote into a preallocated buffer
+    data = bytes(program.serialize(1)[:32])
+    for instruction in program.instructions:
+        data += instruction.bytecode()
+    return data
+
+
+def replicate(program, copies):
+    '''A program with copies of the instructions of program, every copy jumps
+    and calls within itself and the first one is the entry'''
+    n = len(program.instructions)
+    instructions = []
+    for k in range(copies):
+        for instruction in program.instructions:
+            args = instruction.args
+            if instruction.op in JUMPS or instruction.op is Op.CALL:
+                args = (args[0] + k * n,)
+            instructions.append(Instruction(instruction.op, *args))
+    source = symbolic(instructions, program.entry, {}, program.globals)
+    return bc.Program(source, instructions, program.globals, list_functions(source), program.entry)
+
+
+def main(n=1_000_000):
+    base = bc.compile(syntax.parse(synthetic_program(2000)))
+    sizes = [n // 100, n // 10, n]
+    for size in sizes:
+        program = replicate(base, max(1, size // len(base.instructions)))
+        count = len(program.instructions)
+        line = f'{count:>9} instructions:'
+
+        for version in 1, 2:
+            t_write, data = timeit(program.serialize, version)
+            t_read, loaded = timeit(bc.Program.deserialize, data)
+            assert loaded.serialize(version) == data
+            line += (f' v{version} {len(data) / 2**20:.1f} MiB, serialize {t_write:.3f}s, '
+                     f'deserialize {t_read:.3f}s,')
+
+        # quadratic, only measured while it finishes in reasonable time
+        if count <= 200_000:
+            t_old, data = timeit(concatenated, program, repeat=1)
+            assert data == program.serialize(1)
+            line += f' concatenated v1 {t_old:.3f}s'
+        print(line)
+
+    # the loaded program runs
+    loaded = bc.Program.deserialize(base.serialize())
+    assert bc.execute(bc.State(loaded), loaded) == 0
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
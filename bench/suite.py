@@ -0,0 +1,244 @@
+'''Times the workloads of bench/workloads on bc.execute, vm.c and the x64
+binary, and compares them with a baseline
+
+Every workload reads its size from stdin, the Python interpreter runs smaller
+sizes than the native backends. Every run is a child process, the results are
+the best wall time of --repeat runs (for bc.execute without loading the
+program), the bytecode instructions run per second, counted by vm.c built with
+PROFILE, and the peak RSS, read by bench/rss.c (POSIX only). A workload on a backend is slower when
+its instructions per second are more than --threshold below the baseline, and
+the suite then exits with 1. The baseline is from the machine it was saved on.
+
+Builds with driver.py, so nasm and a C compiler have to be in PATH.
+
+Usage: python -m bench.suite [--save] [--baseline FILE] [--output FILE]
+                             [--threshold FRACTION] [--repeat N] [workload ...]
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+import syntax
+import bc
+import x64
+import driver
+from bench.common import root
+
+
+def echo_input(n):
+    rng = random.Random(0)
+    return f'{n}\n' + ''.join(f'{rng.randint(-2**40, 2**40)}\n' for _ in range(n))
+
+
+def size_input(n):
+    return f'{n}\n'
+
+
+# name: input for a size, size for bc.execute, size for vm.c and x64
+workloads = {
+    'nested': (size_input, 400, 8000),
+    'primes': (size_input, 1500, 30000),
+    'recursion': (size_input, 23, 34),
+    'lists': (size_input, 10000, 500000),
+    'echo': (echo_input, 200000, 2000000),
+}
+
+backends = 'bc.execute', 'vm.c', 'x64'
+
+# the interpreter reports its own time, without the start and the parse
+interpreter = '''
+import sys
+import time
+sys.path.insert(0, sys.argv[2])
+import bc
+with open(sys.argv[1], 'rt') as f:
+    program = bc.parse(f.read())
+start = time.perf_counter()
+bc.execute(bc.State(program, fast_io=True), program)
+sys.stderr.write(repr(time.perf_counter() - start))
+'''
+
+
+def build_rss():
+    '''bench/rss.c built with the C library, None on Windows'''
+    if os.name == 'nt':
+        return None
+    rss = os.path.abspath('rss')
+    subprocess.run([driver.compiler, '-O2', os.path.join(root, 'bench', 'rss.c'), '-o', rss], check=True)
+    return rss
+
+
+def run(args, inp, rss=None):
+    '''Wall time, stdout, stderr and peak RSS in bytes (None without rss) of
+    a child process'''
+    with tempfile.TemporaryFile() as stdin, tempfile.TemporaryFile() as stdout, \
+            tempfile.TemporaryFile() as stderr:
+        stdin.write(inp.encode())
+        stdin.seek(0)
+        if rss is not None:
+            args = [rss, 'rss.out', *args]
+        start = time.perf_counter()
+        subprocess.run(args, stdin=stdin, stdout=stdout, stderr=stderr, check=True)
+        elapsed = time.perf_counter() - start
+        peak_rss = None
+        if rss is not None:
+            with open('rss.out', 'rt') as f:
+                peak_rss = int(f.read())
+            # kilobytes on Linux, bytes on macOS
+            if sys.platform != 'darwin':
+                peak_rss *= 1024
+        stdout.seek(0)
+        stderr.seek(0)
+        return elapsed, stdout.read(), stderr.read(), peak_rss
+
+
+class Workload:
+    '''A workload built for every backend in the working directory'''
+
+    def __init__(self, name, rt, vm, profile_vm, rss):
+        self.name = name
+        self.make_input, self.small, self.large = workloads[name]
+        with open(os.path.join(root, 'bench', 'workloads', f'{name}.nox'), 'rt', encoding='utf-8') as f:
+            program = bc.compile(syntax.parse(f.read()))
+
+        self.text = f'{name}.noxtbc'
+        with open(self.text, 'wt') as f:
+            f.write(str(program))
+        self.bytecode = f'{name}.noxbc'
+        with open(self.bytecode, 'wb') as f:
+            f.write(program.serialize())
+        asm_file = os.path.abspath(f'{name}.s')
+        with open(asm_file, 'wt') as f:
+            x64.compile(program, f)
+        driver.build(asm_file, [rt], with_runtime=False)
+        self.binary = driver.executable(asm_file)
+        self.vm = vm
+        self.profile_vm = profile_vm
+        self.rss = rss
+
+    def command(self, backend):
+        if backend == 'bc.execute':
+            return [sys.executable, '-c', interpreter, self.text, root]
+        if backend == 'vm.c':
+            return [self.vm, self.bytecode]
+        return [self.binary]
+
+    def measure(self, backend, repeat):
+        n = self.small if backend == 'bc.execute' else self.large
+        inp = self.make_input(n)
+        _, expected, profile, _ = run([self.profile_vm, self.bytecode], inp)
+        instructions = json.loads(profile)['instructions']
+
+        best, peak_rss = None, None
+        for _ in range(repeat):
+            elapsed, output, err, rss = run(self.command(backend), inp, self.rss)
+            assert output == expected, (self.name, backend)
+            if backend == 'bc.execute':
+                elapsed = float(err)
+            best = elapsed if best is None else min(best, elapsed)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+        return {
+            'n': n,
+            'time': best,
+            'instructions': instructions,
+            'ips': instructions / best,
+            'peak_rss': peak_rss,
+        }
+
+
+def build_vms():
+    '''vm.c and vm.c built with PROFILE, in the working directory'''
+    rt = os.path.abspath(driver.compile(driver.runtime()))
+    vm_source = os.path.join(root, 'vm.c')
+    vm = os.path.abspath('vm' + driver.exe_ext)
+    profile_vm = os.path.abspath('vm_profile' + driver.exe_ext)
+    for definitions, out in (None, vm), (['PROFILE'], profile_vm):
+        obj = driver.compile(vm_source, definitions)
+        driver.link([obj, rt], out)
+        os.remove(obj)
+    return rt, vm, profile_vm
+
+
+def compare(results, baseline, threshold):
+    '''Changes of the instructions per second from the baseline, by workload
+    and backend, and the ones slower than threshold'''
+    changes, slower = {}, []
+    for name, by_backend in results.items():
+        for backend, result in by_backend.items():
+            base = baseline.get(name, {}).get(backend)
+            if base is None:
+                continue
+            change = result['ips'] / base['ips'] - 1
+            changes[name, backend] = change
+            if change < -threshold:
+                slower.append((name, backend))
+    return changes, slower
+
+
+def report(results, changes):
+    print(f'{"workload":<10} {"backend":<10} {"n":>8} {"time":>9} {"Minstr/s":>9} '
+          f'{"peak RSS":>10} {"vs baseline":>12}')
+    for name, by_backend in results.items():
+        for backend, result in by_backend.items():
+            rss = '-' if result['peak_rss'] is None else f'{result["peak_rss"] / 2**20:.1f} MiB'
+            change = changes.get((name, backend))
+            change = '-' if change is None else f'{100 * change:+.1f}%'
+            print(f'{name:<10} {backend:<10} {result["n"]:>8} {result["time"]:>8.3f}s '
+                  f'{result["ips"] / 1e6:>9.1f} {rss:>10} {change:>12}')
+
+
+def main(names=(), baseline_file=None, output=None, save=False, threshold=0.1, repeat=3):
+    baseline_file = baseline_file or os.path.join(root, 'bench', 'baseline.json')
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            rt, vm, profile_vm = build_vms()
+            rss = build_rss()
+            for name in names or workloads:
+                workload = Workload(name, rt, vm, profile_vm, rss)
+                results[name] = {backend: workload.measure(backend, repeat) for backend in backends}
+        finally:
+            os.chdir(cwd)
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'rt', encoding='utf-8') as f:
+            baseline = json.load(f)['workloads']
+    changes, slower = compare(results, baseline, threshold)
+    report(results, changes)
+
+    data = {'workloads': results}
+    if output:
+        with open(output, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+    if save:
+        with open(baseline_file, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+    for name, backend in slower:
+        print(f'{name} on {backend} is {-100 * changes[name, backend]:.1f}% slower than the baseline')
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cross-backend benchmark suite')
+    parser.add_argument('workloads', nargs='*', metavar='workload',
+                        help=f'workloads to run (default: all of {", ".join(workloads)})')
+    parser.add_argument('--baseline', help='baseline JSON (default: bench/baseline.json)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--save', action='store_true', help='write the results to the baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown from the baseline that fails the suite (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every workload (default: %(default)s)')
+    args = parser.parse_args()
+    unknown = set(args.workloads) - workloads.keys()
+    if unknown:
+        parser.error(f'unknown workloads: {", ".join(sorted(unknown))}')
+    sys.exit(main(args.workloads, args.baseline, args.output, args.save, args.threshold, args.repeat))
@@ -1,7 +1,14 @@
-import sys
 import os
+import re
+import sys
+import glob
+import json
+import pickle
+import hashlib
 import subprocess
 import shutil
+import argparse
+from collections import Counter
 
 import syntax
 import bc
@@ -28,70 +35,350 @@ def find_winsdk():
     sdk = os.path.join(base, latest_sdk)
     return sdk
 
-compiler = shutil.which('cl')
+if os.name == 'nt':
+    compiler = shutil.which('cl')
+    linker = shutil.which('link')
+    obj_format = 'win64'
+    obj_ext = '.obj'
+    exe_ext = '.exe'
+else:
+    compiler = shutil.which('cc')
+    linker = compiler
+    obj_format = 'elf64'
+    obj_ext = '.o'
+    exe_ext = ''
 assembler = shutil.which('nasm')
-linker = shutil.which('link')
-
-def compile(program, definitions=None):
-    assert compiler, 'cl not in PATH'
-    args = '/nologo', '/GS-', '/O2', '/Oi-', '/c'
-    if definitions is not None:
-        args += tuple(f'/D{d}' for d in definitions)
-    subprocess.run([compiler, *args, program], check=True)
-    return os.path.join(os.getcwd(), os.path.basename(program).replace('.c', '.obj'))
-
-def assemble(program):
-    assert os.name == 'nt', 'Assembly compilation for {os.name} is not implemented'
+
+# what the products of every stage are built with, besides their input
+def compiler_version():
+    '''Hash of the Python sources of the compiler'''
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    sources = [os.path.join(current_dir, name) for name in ('syntax.py', 'x64.py', 'driver.py')]
+    sources += glob.glob(os.path.join(current_dir, 'bc', '*.py'))
+    h = hashlib.sha256()
+    for source in sorted(sources):
+        with open(source, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def tool_version(tool):
+    '''The path, size and modification time of an executable'''
+    stat = os.stat(tool)
+    return f'{tool} {stat.st_size} {stat.st_mtime_ns}'
+
+def c_sources(path, seen=None):
+    '''Contents of a C file and of the files it includes with quotes'''
+    if seen is None:
+        seen = set()
+    path = os.path.realpath(path)
+    if path in seen:
+        return []
+    seen.add(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    sources = [data]
+    for include in re.findall(rb'^\s*#\s*include\s+"([^"]+)"', data, re.MULTILINE):
+        included = os.path.join(os.path.dirname(path), include.decode())
+        if os.path.exists(included):
+            sources += c_sources(included, seen)
+    return sources
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'nox')
+DEFAULT_CACHE_SIZE = 256 << 20
+
+class Cache:
+    '''Products of the build stages on disk, by the hash of everything they
+    are built from. Past max_size bytes the least recently used are removed
+    by save_stats, once per run, a hit updates the modification time of the
+    entry. Hits and misses are counted by stage, and added up in stats.json
+    by save_stats.'''
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = Counter()
+        self.misses = Counter()
+        self.version = compiler_version()
+
+    def key(self, stage, *parts):
+        h = hashlib.sha256()
+        for part in (stage, self.version, *parts):
+            if isinstance(part, str):
+                part = part.encode()
+            # the length keeps the parts apart
+            h.update(len(part).to_bytes(8, 'little'))
+            h.update(part)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, stage, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses[stage] += 1
+            return None
+        self.hits[stage] += 1
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, so an entry is never read half written
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def cached(self, stage, parts, build):
+        '''Returns the bytes build returns for the parts, calling it on a miss'''
+        key = self.key(stage, *parts)
+        data = self.get(stage, key)
+        if data is None:
+            data = build()
+            self.put(key, data)
+        return data
+
+    def entries(self):
+        '''(modification time, size, path) of every entry'''
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '??', '*')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def stats(self):
+        '''The hits and misses so far with the ones in stats.json, and the
+        entries and bytes in the cache'''
+        stats = self.load_stats()
+        for stage in self.hits.keys() | self.misses.keys():
+            counts = stats.setdefault(stage, {'hits': 0, 'misses': 0})
+            counts['hits'] += self.hits[stage]
+            counts['misses'] += self.misses[stage]
+        entries = self.entries()
+        return {
+            'stages': stats,
+            'entries': len(entries),
+            'size': sum(entry[1] for entry in entries),
+            'max_size': self.max_size,
+        }
+
+    def load_stats(self):
+        try:
+            with open(os.path.join(self.directory, 'stats.json'), 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_stats(self):
+        stats = self.stats()['stages']
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'stats.json')
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wt', encoding='utf-8') as f:
+            json.dump(stats, f, indent=1)
+        os.replace(temporary, path)
+        self.hits.clear()
+        self.misses.clear()
+        self.evict()
+
+def cached_file(cache, stage, parts, out, build):
+    '''Writes the product of build() to out, from the cache when it's there'''
+    if cache is None:
+        build()
+        return
+
+    def built():
+        build()
+        with open(out, 'rb') as f:
+            return f.read()
+
+    data = cache.cached(stage, parts, built)
+    with open(out, 'wb') as f:
+        f.write(data)
+
+def executable(program):
+    return os.path.splitext(program)[0] + exe_ext
+
+def compile(program, definitions=None, cache=None):
+    assert compiler, 'C compiler is not in PATH'
+    obj = os.path.join(os.getcwd(), os.path.basename(program).replace('.c', obj_ext))
+    if os.name == 'nt':
+        args = '/nologo', '/GS-', '/O2', '/Oi-', '/c'
+        if definitions is not None:
+            args += tuple(f'/D{d}' for d in definitions)
+        command = [compiler, *args, program]
+    else:
+        # the runtime provides its own memcpy, puts, ... and no libc is linked
+        args = ('-O2', '-c', '-ffreestanding', '-fno-builtin', '-fno-stack-protector',
+                '-fno-pie', '-fno-tree-loop-distribute-patterns')
+        if definitions is not None:
+            args += tuple(f'-D{d}' for d in definitions)
+        command = [compiler, *args, program, '-o', obj]
+    parts = (tool_version(compiler), *args, *c_sources(program)) if cache else ()
+    cached_file(cache, 'c object', parts, obj, lambda: subprocess.run(command, check=True))
+    return obj
+
+def assemble(program, cache=None):
     assert assembler, 'nasm is not in PATH'
-    subprocess.run([assembler, '-f', 'win64', program], check=True)
-    return program.replace('.s', '.obj').replace('.asm', '.obj')
+    obj = program.replace('.s', obj_ext).replace('.asm', obj_ext)
+    if cache:
+        with open(program, 'rb') as f:
+            parts = tool_version(assembler), obj_format, f.read()
+    else:
+        parts = ()
+    cached_file(cache, 'asm object', parts, obj,
+                lambda: subprocess.run([assembler, '-f', obj_format, program], check=True))
+    return obj
 
-def build(program, objects=None, with_runtime=True, definitions=None):
+def link(objects, out):
     assert linker, 'linker is not in PATH'
+    if os.name == 'nt':
+        kernel32 = os.path.join(find_winsdk(), 'um', 'x64', 'kernel32.lib')
+        args = '/nologo', '/nodefaultlib', '/subsystem:console', '/entry:main'
+        subprocess.run([linker, *args, *objects, kernel32, f'/out:{out}'], check=True)
+    else:
+        args = '-nostdlib', '-static', '-no-pie'
+        subprocess.run([linker, *args, *objects, '-o', out], check=True)
+
+def build(program, objects=None, with_runtime=True, definitions=None, cache=None):
     if objects is None:
         objects = []
 
     if program.endswith('.s'):
-        obj = assemble(program)
+        obj = assemble(program, cache)
     elif program.endswith('.c'):
-        obj = compile(program, definitions=definitions)
+        obj = compile(program, definitions=definitions, cache=cache)
 
     objects.append(obj)
     if with_runtime:
-        rt = compile(runtime(), definitions=definitions)
+        rt = compile(runtime(), definitions=definitions, cache=cache)
         objects.append(rt)
 
-    kernel32 = os.path.join(find_winsdk(), 'um', 'x64', 'kernel32.lib')
-    args = '/nologo', '/nodefaultlib', '/subsystem:console', '/entry:main'
-    out = program.replace('.s', '.exe').replace('.c', '.exe')
-    subprocess.run([linker, *args, *objects, kernel32, f'/out:{out}'], check=True)
+    link(objects, executable(program))
     if with_runtime:
         os.remove(rt)
     os.remove(obj)
 
-def main(file):
+def profile(file, program, data=None, top=10):
+    '''Prints the report of a profile of program to stderr. Without data the
+    program is run with bc.execute and its profile is written next to file'''
+    if data is None:
+        counts = bc.profile.Profile()
+        code = bc.execute(bc.State(program, fast_io=True), program, profile=counts)
+        data = counts.to_json()
+        with open(os.path.splitext(file)[0] + '.profile.json', 'wt', encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
+    else:
+        code = 0
+    print(bc.profile.report(program, data, top), file=sys.stderr)
+    return code
+
+def compile_source(source, level, cache=None):
+    '''The program of a .nox file, cached pickled: loading it is several
+    times faster than parsing the source or the bytecode text'''
+    if cache is None:
+        return bc.compile(syntax.parse(source), level)
+    data = cache.cached('bytecode', (source, str(level)),
+                        lambda: pickle.dumps(bc.compile(syntax.parse(source), level), pickle.HIGHEST_PROTOCOL))
+    return pickle.loads(data)
+
+def compile_x64(program, cache=None, workers=1):
+    '''The assembly listing of the program, cached by its bytecode text and
+    the target OS, whose calling convention it follows. The listing doesn't
+    depend on the number of workers.'''
+    if cache is None:
+        return x64.compile(program, workers=workers)
+    return cache.cached('asm', (os.name, str(program)), lambda: x64.compile(program, workers=workers).encode()).decode()
+
+def main(file, level=1, target=None, profile_json=None, top=10, cache=None, workers=1):
     if file.endswith('.s') or file.endswith('.c'):
-        build(file)
+        build(file, cache=cache)
         return
 
-    with open(file, 'rt', encoding='utf-8') as f:
-        program = f.read()
-
-    if file.endswith('.nox'):
-        program = syntax.parse(program)
-        program = bc.compile(program)
-    elif file.endswith('.noxtbc'):
-        program = bc.parse(program)
-        # data = program.serialize()
-        # with open(file.replace('.noxtbc', '.noxbc'), 'wb') as f:
-        #     f.write(data)
-        # return
-        # TODO: implement --target option
-        program = x64.compile(program)
+    if file.endswith('.noxbc'):
+        with open(file, 'rb') as f:
+            program = bc.Program.deserialize(f.read())
+        target = target or 'x64'
     else:
-        raise Exception(f'Unsupported file type: {file}')
+        with open(file, 'rt', encoding='utf-8') as f:
+            program = f.read()
+
+        if file.endswith('.nox'):
+            program = compile_source(program, level, cache)
+        elif file.endswith('.noxtbc'):
+            program = bc.parse(program, level)
+            target = target or 'x64'
+        else:
+            raise Exception(f'Unsupported file type: {file}')
+
+    if profile_json is not None:
+        data = None
+        if profile_json:
+            with open(profile_json, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        return profile(file, program, data, top)
+
+    if target == 'noxbc':
+        with open(os.path.splitext(file)[0] + '.noxbc', 'wb') as f:
+            f.write(program.serialize())
+        return
+    if target == 'x64':
+        program = compile_x64(program, cache, workers)
 
     print(program)
 
 if __name__ == '__main__':
-    main(*sys.argv[1:])
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('-O', dest='level', type=int, default=1, choices=(0, 1, 2),
+                        help='optimization level (default: %(default)s)')
+    parser.add_argument('--target', choices=('text', 'x64', 'noxbc'),
+                        help='print the bytecode as text or x64 assembly, or write a .noxbc file next '
+                             'to the input (default: text for .nox files, x64 otherwise)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='processes compiling the functions to x64 (default: %(default)s)')
+    parser.add_argument('--profile', nargs='?', const='', metavar='JSON',
+                        help='run the program with bc.execute, write its profile to a .profile.json file next '
+                             'to the input and print the hottest opcodes, functions and loops to stderr; with '
+                             'the JSON a vm built with -DPROFILE writes to stderr, print its report instead')
+    parser.add_argument('--top', type=int, default=10,
+                        help='entries of every table of the profile report (default: %(default)s)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='directory of the build cache (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE >> 20, metavar='MIB',
+                        help='size of the build cache, the least recently used entries are removed past '
+                             'it (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='build every stage without the cache')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='print the hits and misses of the build cache by stage to stderr')
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else Cache(args.cache_dir, args.cache_size << 20)
+    try:
+        code = main(args.file, args.level, args.target, args.profile, args.top, cache, args.jobs)
+    finally:
+        if cache is not None:
+            cache.save_stats()
+            if args.cache_stats:
+                print(json.dumps(cache.stats(), indent=1), file=sys.stderr)
+    sys.exit(code)
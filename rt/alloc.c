@@ -0,0 +1,167 @@
+#include "mem.h"
+
+#include "buffered.h"
+#include "intrinsics.h"
+#include "utils.h"
+
+
+// Small blocks are carved from arenas with a bump pointer and recycled
+// through a free list per size class. Larger blocks get their own mapping.
+// Every block is preceded by a header, so dealloc and realloc find its class.
+
+typedef struct {
+  Int size_class;
+  // requested size of the block
+  Int size;
+} BlockHeader;
+
+typedef struct FreeBlock {
+  struct FreeBlock* next;
+} FreeBlock;
+
+static const Int ARENA_SIZE = 1 << 20;
+static const Int LARGE = -1;
+
+// 16 byte steps for list headers and short lists, then powers of two which
+// is how list capacities grow
+enum { N_SIZE_CLASSES = 13 };
+static const Int SIZE_CLASSES[N_SIZE_CLASSES] = {
+  16, 32, 48, 64, 80, 96, 112, 128, 256, 512, 1024, 2048, 4096
+};
+
+static FreeBlock* FREE_BLOCKS[N_SIZE_CLASSES];
+static Byte* ARENA;
+static Int ARENA_LEFT;
+
+static AllocStats STATS;
+
+static Int size_class(Int n) {
+  if (n <= 128) {
+    return n ? (n - 1) / 16 : 0;
+  }
+  Int i = 8;
+  while (i < N_SIZE_CLASSES && SIZE_CLASSES[i] < n) {
+    ++i;
+  }
+  return i < N_SIZE_CLASSES ? i : LARGE;
+}
+
+static void count_alloc(Int n) {
+  ++STATS.allocations;
+  STATS.live_bytes += n;
+  if (STATS.live_bytes > STATS.peak_bytes) {
+    STATS.peak_bytes = STATS.live_bytes;
+  }
+}
+
+static Byte* alloc_small(Int size_class) {
+  FreeBlock* block = FREE_BLOCKS[size_class];
+  if (block) {
+    FREE_BLOCKS[size_class] = block->next;
+    return (Byte*)block;
+  }
+
+  Int size = sizeof(BlockHeader) + SIZE_CLASSES[size_class];
+  if (size > ARENA_LEFT) {
+    // the rest of the old arena is left unused
+    Byte* arena = map_memory(ARENA_SIZE);
+    if (!arena) {
+      return NULL;
+    }
+    STATS.mapped_bytes += ARENA_SIZE;
+    ARENA = arena;
+    ARENA_LEFT = ARENA_SIZE;
+  }
+
+  Byte* p = ARENA + sizeof(BlockHeader);
+  ARENA += size;
+  ARENA_LEFT -= size;
+  return p;
+}
+
+static Byte* alloc(Int n) {
+  Int c = size_class(n);
+  Byte* p;
+  if (c == LARGE) {
+    Byte* mapping = map_memory(sizeof(BlockHeader) + n);
+    if (!mapping) {
+      return NULL;
+    }
+    STATS.mapped_bytes += sizeof(BlockHeader) + n;
+    p = mapping + sizeof(BlockHeader);
+  }
+  else {
+    p = alloc_small(c);
+    if (!p) {
+      return NULL;
+    }
+  }
+
+  BlockHeader* header = (BlockHeader*)p - 1;
+  header->size_class = c;
+  header->size = n;
+  count_alloc(n);
+  return p;
+}
+
+static void dealloc(Byte* p) {
+  if (!p) {
+    return;
+  }
+
+  BlockHeader* header = (BlockHeader*)p - 1;
+  ++STATS.frees;
+  STATS.live_bytes -= header->size;
+  if (header->size_class == LARGE) {
+    STATS.mapped_bytes -= sizeof(BlockHeader) + header->size;
+    unmap_memory((Byte*)header, sizeof(BlockHeader) + header->size);
+    return;
+  }
+
+  FreeBlock* block = (FreeBlock*)p;
+  block->next = FREE_BLOCKS[header->size_class];
+  FREE_BLOCKS[header->size_class] = block;
+}
+
+static Byte* realloc(Byte* p, Int n) {
+  if (!p) {
+    return alloc(n);
+  }
+
+  BlockHeader* header = (BlockHeader*)p - 1;
+  if (header->size_class != LARGE && n <= SIZE_CLASSES[header->size_class]) {
+    STATS.live_bytes += n - header->size;
+    header->size = n;
+    if (STATS.live_bytes > STATS.peak_bytes) {
+      STATS.peak_bytes = STATS.live_bytes;
+    }
+    return p;
+  }
+
+  Byte* result = alloc(n);
+  if (result) {
+    memcpy(result, p, header->size < n ? header->size : n);
+    dealloc(p);
+  }
+  return result;
+}
+
+static void write_stat(Handle file, const Byte* name, Int val) {
+  Byte buffer[64];
+  Int n = 0;
+  while (name[n]) {
+    buffer[n] = name[n];
+    ++n;
+  }
+  n += to_chars(buffer + n, sizeof(buffer) - n - 1, val);
+  buffer[n++] = '\n';
+  write_file(file, buffer, n);
+}
+
+static void print_alloc_stats(Handle file) {
+  write_stat(file, "allocations:  ", STATS.allocations);
+  write_stat(file, "frees:        ", STATS.frees);
+  write_stat(file, "live bytes:   ", STATS.live_bytes);
+  write_stat(file, "peak bytes:   ", STATS.peak_bytes);
+  write_stat(file, "mapped bytes: ", STATS.mapped_bytes);
+}
@@ -0,0 +1,156 @@
+#include "buffered.h"
+
+#include "io.h"
+#include "syscalls.h"
+#include "intrinsics.h"
+#include "utils.h"
+
+
+typedef struct {
+  Handle file;
+  Byte data[1 << 16];
+  // data[begin:end] is not consumed yet
+  Int begin;
+  Int end;
+} IoBuffer;
+
+static IoBuffer STDIN_BUFFER;
+static IoBuffer STDOUT_BUFFER;
+
+// Interactive output is flushed at every newline and before reading stdin
+static Bool LINE_BUFFERED;
+static Bool END_OF_INPUT;
+
+static void setup_io(Handle in, Handle out) {
+  STDIN_BUFFER.file = in;
+  STDIN_BUFFER.begin = STDIN_BUFFER.end = 0;
+  STDOUT_BUFFER.file = out;
+  STDOUT_BUFFER.begin = STDOUT_BUFFER.end = 0;
+  LINE_BUFFERED = is_interactive(out);
+  END_OF_INPUT = false;
+}
+
+static void flush_output(void) {
+  IoBuffer* out = &STDOUT_BUFFER;
+  if (out->end > 0) {
+    Int n = out->end;
+    out->end = 0;
+    if (!write_file(out->file, out->data, n)) {
+      // nothing can be reported when stdout is broken
+      sys_exit(-1);
+    }
+  }
+}
+
+static void write_output(const Byte* data, Int n) {
+  IoBuffer* out = &STDOUT_BUFFER;
+  if (n > sizeof(out->data) - out->end) {
+    flush_output();
+    if (n > sizeof(out->data)) {
+      if (!write_file(out->file, data, n)) {
+        sys_exit(-1);
+      }
+      return;
+    }
+  }
+
+  memcpy(out->data + out->end, (Byte*)data, n);
+  out->end += n;
+
+  if (LINE_BUFFERED) {
+    for (Int i = 0; i < n; ++i) {
+      if (data[i] == '\n') {
+        flush_output();
+        break;
+      }
+    }
+  }
+}
+
+static Bool fill_input(void) {
+  IoBuffer* in = &STDIN_BUFFER;
+  if (LINE_BUFFERED) {
+    flush_output();
+  }
+
+  // the unconsumed tail is moved to the front only when more input is needed
+  Int left = in->end - in->begin;
+  memcpy(in->data, in->data + in->begin, left);
+  in->begin = 0;
+  in->end = left;
+
+  Int read = read_file(in->file, in->data + in->end, sizeof(in->data) - in->end);
+  if (read < 0) {
+    return false;
+  }
+
+  END_OF_INPUT = read == 0;
+  in->end += read;
+  return true;
+}
+
+static Bool is_space(Byte c) {
+  return c == ' ' || c == '\n' || c == '\r';
+}
+
+static Bool read_int(Int* val) {
+  IoBuffer* in = &STDIN_BUFFER;
+  for (;;) {
+    while (in->begin < in->end && is_space(in->data[in->begin])) {
+      ++in->begin;
+    }
+
+    Int n = in->end - in->begin;
+    if (n > 0) {
+      Int parsed = 0;
+      *val = from_chars(in->data + in->begin, n, &parsed);
+      // a number running up to the end of the data may continue in the next read
+      if (parsed > 0 && (parsed < n || END_OF_INPUT)) {
+        in->begin += parsed;
+        return true;
+      }
+
+      // only a lone '-' can still become a number
+      if (parsed <= 0 && n > 1) {
+        return false;
+      }
+    }
+
+    if (END_OF_INPUT || n == sizeof(in->data)) {
+      return false;
+    }
+
+    if (!fill_input()) {
+      panic("sys_input() failed: io error\n");
+    }
+  }
+}
+
+// IO functions
+extern void puts(const Byte* s) {
+  Int len = 0;
+  const Byte* p = s;
+  while (*p++) ++len;
+  write_output(s, len);
+}
+
+// syscalls
+extern Int sys_input(void) {
+  Int val = 0;
+  if (!read_int(&val)) {
+    panic("sys_input() failed: invalid integer\n");
+  }
+  return val;
+}
+
+extern void sys_print(Int val) {
+  Byte buffer[32];
+  Int len = to_chars(buffer, sizeof(buffer), val);
+  if (len < 0) {
+    panic("sys_print() failed: int conversion\n");
+  }
+
+  buffer[len] = '\n';
+  ++len;
+  write_output(buffer, len);
+}
\ No newline at end of file
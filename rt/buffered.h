@@ -0,0 +1,18 @@
+#pragma once
+
+#include "types.h"
+
+
+// provided by the platform runtime
+
+// returns the number of bytes read, 0 at the end of file and -1 on error
+static Int  read_file(Handle file, Byte* data, Int n);
+static Bool write_file(Handle file, const Byte* data, Int n);
+static Bool is_interactive(Handle file);
+
+// buffered stdin and stdout on top of them
+
+static void setup_io(Handle in, Handle out);
+static void flush_output(void);
+static void write_output(const Byte* data, Int n);
+static Bool read_int(Int* val);
\ No newline at end of file
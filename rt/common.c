@@ -1,3 +1,19 @@
 #include "intrinsics.c"
 #include "utils.c"
-#include "list.c"
\ No newline at end of file
+#include "alloc.c"
+#include "list.c"
+#include "buffered.c"
+
+#include "mem.h"
+
+extern Byte* heap_alloc(Int n) {
+  return alloc(n);
+}
+
+extern Byte* heap_realloc(Byte* memory, Int n) {
+  return realloc(memory, n);
+}
+
+extern void heap_free(Byte* memory) {
+  dealloc(memory);
+}
\ No newline at end of file
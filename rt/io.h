@@ -3,8 +3,11 @@
 #include "types.h"
 
 extern void   puts(const Byte* s);
+// unbuffered
+extern void   write_error(const Byte* data, Int n);
 extern Handle open(const Byte* filename);
 extern void   close(Handle file);
 extern Int    file_size(Handle file);
 extern Byte*  mmap(Handle file);
-extern void   munmap(Byte* map);
\ No newline at end of file
+extern void   munmap(Byte* map);
+extern Byte*  command_line(void);
\ No newline at end of file
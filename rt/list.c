@@ -5,7 +5,17 @@
 #include "utils.h"
 
 
+// Lists and bytes held by the lists that are not freed yet, the bytes are the
+// list headers and the capacity of their data
+static Int LIVE_LISTS;
+static Int LIVE_BYTES;
+
+// the first push makes room for a few values, most lists get more than one
+static const Int MIN_CAPACITY = 4;
+
 extern List* sys_list(void) {
+  ++LIVE_LISTS;
+  LIVE_BYTES += sizeof(List);
   List* list = (List*)alloc(sizeof(List));
   list->refs = 0;
   list->data = NULL;
@@ -19,6 +29,7 @@ extern List* sys_list_from_data(Int* data, Int n) {
   list->data = (Int*)alloc(n * sizeof(Int));
   list->size = n;
   list->capacity = n;
+  LIVE_BYTES += n * sizeof(Int);
   memcpy((Byte*)list->data, (Byte*)data, n * sizeof(Int));
   return list;
 }
@@ -41,15 +52,16 @@ extern void sys_list_set(List* list, Int i, Int val) {
 
 extern void sys_push(List* list, Int val) {
   if (list->size == list->capacity) {
+    // an empty slice has data but no capacity
+    Int new_cap = list->capacity ? list->capacity * 2 : MIN_CAPACITY;
     if (!list->data) {
-      list->data = (Int*)alloc(sizeof(Int));
-      list->capacity = 1;
+      list->data = (Int*)alloc(new_cap * sizeof(Int));
     }
     else {
-      Int new_cap = list->size * 2;
       list->data = (Int*)realloc((Byte*)list->data, new_cap * sizeof(Int));
-      list->capacity = new_cap;
     }
+    LIVE_BYTES += (new_cap - list->capacity) * sizeof(Int);
+    list->capacity = new_cap;
   }
 
   list->data[list->size++] = val;
@@ -95,13 +107,26 @@ extern List* sys_slice(List* list, Int left, Int right) {
   return sys_list_from_data(start, size);
 }
 
+// list variables are 0 until the first assignment
 extern void sys_list_ref(List* list) {
-  ++list->refs;
+  if (list) {
+    ++list->refs;
+  }
 }
 
 extern void sys_list_unref(List* list) {
-  if (!--list->refs) {
+  if (list && !--list->refs) {
+    --LIVE_LISTS;
+    LIVE_BYTES -= sizeof(List) + list->capacity * sizeof(Int);
     dealloc((Byte*)list->data);
     dealloc((Byte*)list);
   }
 }
+
+extern Int sys_live_lists(void) {
+  return LIVE_LISTS;
+}
+
+extern Int sys_live_bytes(void) {
+  return LIVE_BYTES;
+}
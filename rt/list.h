@@ -21,4 +21,6 @@ extern Int    sys_len(List* list);
 extern void   sys_clear(List* list);
 extern List*  sys_slice(List* list, Int left, Int right);
 extern void   sys_list_ref(List* list);
-extern void   sys_list_unref(List* list);
\ No newline at end of file
+extern void   sys_list_unref(List* list);
+extern Int    sys_live_lists(void);
+extern Int    sys_live_bytes(void);
\ No newline at end of file
@@ -5,4 +5,27 @@
 
 static Byte* alloc(Int n);
 static Byte* realloc(Byte* memory, Int n);
-static void dealloc(Byte* memory);
\ No newline at end of file
+static void dealloc(Byte* memory);
+
+// for code outside of the runtime
+extern Byte* heap_alloc(Int n);
+extern Byte* heap_realloc(Byte* memory, Int n);
+extern void  heap_free(Byte* memory);
+
+// pages for the allocator, provided by the platform runtime
+static Byte* map_memory(Int n);
+static void  unmap_memory(Byte* memory, Int n);
+
+typedef struct {
+  Int allocations;
+  Int frees;
+  // requested bytes of the blocks that are not freed
+  Int live_bytes;
+  Int peak_bytes;
+  // bytes taken from the operating system
+  Int mapped_bytes;
+} AllocStats;
+
+// the platform runtimes print them to stderr at exit when built with
+// ALLOC_STATS
+static void print_alloc_stats(Handle file);
@@ -5,14 +5,14 @@
 #include "common.c"
 
 #define WINAPI __stdcall
-extern Handle WINAPI GetProcessHeap(void);
-static const Int NO_SYNC = 0x01;
-extern Handle WINAPI HeapCreate(Int options, Int size, Int max_size);
-extern Byte* WINAPI HeapAlloc(Handle heap, Int flags, Int size);
-extern Byte* WINAPI HeapReAlloc(Handle heap, Int flags, Byte* p, Int size);
-extern Bool  WINAPI HeapFree(Handle heap, Int flags, Byte* p);
+static const Int MEM_COMMIT  = 0x1000;
+static const Int MEM_RESERVE = 0x2000;
+static const Int MEM_RELEASE = 0x8000;
+extern Byte* WINAPI VirtualAlloc(Byte* address, Int size, Int type, Int protect);
+extern Bool  WINAPI VirtualFree(Byte* address, Int size, Int type);
 static const Int GET_STDIN  = -10;
 static const Int GET_STDOUT = -11;
+static const Int GET_STDERR = -12;
 extern Handle WINAPI GetStdHandle(Int type);
 static const Int ACCESS_READ   = 0x80000000L;
 static const Int ACCESS_WRITE  = 0x40000000L;
@@ -21,71 +21,61 @@ static const Int NO_ATTRIBUTES = 0x80;
 extern Handle WINAPI CreateFileA(const Byte* filename, Int access, Int share, void* security, Int create, Int attributes, Handle template);
 extern Bool   WINAPI ReadFile(Handle file, Byte* buffer, Int n, Int* read, void* overlapped);
 extern Bool   WINAPI WriteFile(Handle file, const Byte* buffer, Int n, Int* written, void* overlapped);
+extern Bool   WINAPI GetConsoleMode(Handle console, Int* mode);
+extern Int    WINAPI GetLastError(void);
 extern Bool   WINAPI GetFileSizeEx(Handle file, Int* size);
 static const Int PAGE_READWRITE = 4;
+static const Int PAGE_WRITECOPY = 8;
 extern Handle WINAPI CreateFileMappingA(Handle file, void* security, Int protect, Int maxsize_high, Int maxsize_low, const Byte* name);
-static const Int MAP_ALL_ACCESS = 0x1 | 0x2 | 0x4 | 0x8 | 0x10 | 0xF0000;
+static const Int FILE_MAP_COPY  = 1;
 extern Byte*  WINAPI MapViewOfFile(Handle file, Int access, Int offset_high, Int offset_low, Int size);
 extern Bool   WINAPI UnmapViewOfFile(Byte* addtess);
 extern Bool   WINAPI CloseHandle(Handle handle);
 extern void   WINAPI ExitProcess(Int code);
-
-static Handle HEAP;
-
-static Handle STDIN;
-typedef struct {
-  Byte data[1024];
-  Int n;
-} IoBuffer;
-
-static IoBuffer STDIN_BUFFER;
-
-static Handle STDOUT;
+extern Byte*  WINAPI GetCommandLineA(void);
 
 extern void sys_setup(void) {
-  HEAP   = HeapCreate(NO_SYNC, 0, 0);
-  STDIN  = GetStdHandle(GET_STDIN);
-  STDOUT = GetStdHandle(GET_STDOUT);
-  STDIN_BUFFER.n = 0;
+  setup_io(GetStdHandle(GET_STDIN), GetStdHandle(GET_STDOUT));
 }
 
-static Bool fill_buffer(Handle* file, IoBuffer* buffer) {
+static Int read_file(Handle file, Byte* data, Int n) {
   static const Int ERROR_BROKEN_PIPE = 0x6d;
 
   Int read = 0;
-  Bool success = ReadFile(file, buffer->data + buffer->n, sizeof(buffer->data) - buffer->n, &read, NULL);
-  if (!success) {
-    success = GetLastError() == ERROR_BROKEN_PIPE;
+  if (!ReadFile(file, data, n, &read, NULL)) {
+    // the writing end of the pipe is closed
+    return GetLastError() == ERROR_BROKEN_PIPE ? 0 : -1;
   }
+  return read;
+}
 
-  if (success) {
-    buffer->n += read;
+static Bool write_file(Handle file, const Byte* data, Int n) {
+  while (n > 0) {
+    Int written = 0;
+    if (!WriteFile(file, data, n, &written, NULL)) {
+      return false;
+    }
+    data += written;
+    n -= written;
   }
-
-  return success;
+  return true;
 }
 
-// Memory allocation
-static Byte* alloc(Int n) {
-  return HeapAlloc(HEAP, 0, n);
+static Bool is_interactive(Handle file) {
+  Int mode = 0;
+  return GetConsoleMode(file, &mode);
 }
 
-static Byte* realloc(Byte* p, Int n) {
-  return HeapReAlloc(HEAP, 0, p, n);
+// Memory for the allocator
+static Byte* map_memory(Int n) {
+  return VirtualAlloc(NULL, n, MEM_COMMIT | MEM_RESERVE, PAGE_READWRITE);
 }
 
-static void dealloc(Byte* p) {
-  HeapFree(HEAP, 0, p);
+static void unmap_memory(Byte* memory, Int n) {
+  VirtualFree(memory, 0, MEM_RELEASE);
 }
 
 // IO functions
-extern void puts(const Byte* s) {
-  Int len = 0;
-  const Byte* p = s;
-  while (*p++) ++len;
-  WriteFile(STDOUT, s, len, NULL, NULL);
-}
-
 extern Handle open(const Byte* filename) {
   Handle file = CreateFileA(filename, ACCESS_READ | ACCESS_WRITE, 0, NULL, OPEN_EXISTING, NO_ATTRIBUTES, NULL);
   if ((Int)file == -1) {
@@ -107,12 +97,13 @@ extern Int file_size(Handle file) {
 }
 
 extern Byte* mmap(Handle file) {
-  Handle mapping = CreateFileMappingA(file, NULL, PAGE_READWRITE, 0, 0, NULL);
+  // copy on write like MAP_PRIVATE, the loader may patch the code
+  Handle mapping = CreateFileMappingA(file, NULL, PAGE_WRITECOPY, 0, 0, NULL);
   if (!mapping) {
     return NULL;
   }
 
-  Byte* view = MapViewOfFile(mapping, MAP_ALL_ACCESS, 0, 0, 0);
+  Byte* view = MapViewOfFile(mapping, FILE_MAP_COPY, 0, 0, 0);
   CloseHandle(mapping);
   return view;
 }
@@ -121,46 +112,19 @@ extern void munmap(Byte* map) {
   UnmapViewOfFile(map);
 }
 
-// syscalls
-extern Int sys_input(void) {
-  if (!fill_buffer(STDIN, &STDIN_BUFFER)) {
-    panic("sys_input() failed: io error\n");
-  }
-
-  Int parsed = 0;
-  Int val = from_chars(STDIN_BUFFER.data, STDIN_BUFFER.n, &parsed);
-  if (parsed <= 0) {
-    panic("sys_input() failed: invalid integer\n");
-  }
-
-  for (Int i = 0; i < STDIN_BUFFER.n - parsed; ++i) {
-    STDIN_BUFFER.data[i] = STDIN_BUFFER.data[i + parsed];
-  }
-  STDIN_BUFFER.n -= parsed;
-  return val;
+extern void write_error(const Byte* data, Int n) {
+  write_file(GetStdHandle(GET_STDERR), data, n);
 }
 
-extern void sys_print(Int val) {
-  Byte buffer[32];
-  Int len = to_chars(buffer, sizeof(buffer), val);
-  if (len < 0) {
-    panic("sys_print() failed: int conversion\n");
-  }
-
-  buffer[len] = '\n';
-  ++len;
-
-  Int written = 0;
-  Bool success = WriteFile(STDOUT, buffer, len, &written, NULL);
-  if (!success) {
-    panic("sys_print() failed: io error\n");
-  }
-
-  if (written != len) {
-    panic("sys_print() failed: short write\n");
-  }
+extern Byte* command_line(void) {
+  return GetCommandLineA();
 }
 
+// syscalls
 extern void sys_exit(Int code) {
+  flush_output();
+#ifdef ALLOC_STATS
+  print_alloc_stats(GetStdHandle(GET_STDERR));
+#endif
   ExitProcess(code);
 }
\ No newline at end of file
@@ -0,0 +1,177 @@
+#include "types.h"
+#include "syscalls.h"
+#include "io.h"
+
+#include "common.c"
+
+// Linux x86-64 system calls, the runtime doesn't use libc
+static const Int NR_READ     = 0;
+static const Int NR_WRITE    = 1;
+static const Int NR_OPEN     = 2;
+static const Int NR_CLOSE    = 3;
+static const Int NR_LSEEK    = 8;
+static const Int NR_MMAP     = 9;
+static const Int NR_MUNMAP   = 11;
+static const Int NR_IOCTL    = 16;
+static const Int NR_EXIT     = 231;
+static const Int O_RDWR      = 2;
+static const Int SEEK_END    = 2;
+static const Int PROT_READ   = 1;
+static const Int PROT_WRITE  = 2;
+static const Int MAP_PRIVATE = 0x02;
+static const Int MAP_ANONYMOUS = 0x20;
+static const Int TCGETS      = 0x5401;
+static const Int EINTR       = 4;
+
+static Int linux_syscall(Int n, Int a, Int b, Int c, Int d, Int e, Int f) {
+  register Int r10 __asm__("r10") = d;
+  register Int r8 __asm__("r8") = e;
+  register Int r9 __asm__("r9") = f;
+  Int ret;
+  __asm__ volatile (
+    "syscall"
+    : "=a"(ret)
+    : "a"(n), "D"(a), "S"(b), "d"(c), "r"(r10), "r"(r8), "r"(r9)
+    : "rcx", "r11", "memory"
+  );
+  return ret;
+}
+
+// The process starts at _start with argc at the top of the stack followed by
+// argv, main is called with the stack aligned the way the ABI expects.
+__asm__(
+  ".globl _start\n"
+  "_start:\n"
+  "    xor %ebp, %ebp\n"
+  "    mov %rsp, %rdi\n"
+  "    and $-16, %rsp\n"
+  "    call start\n"
+  "    hlt\n"
+);
+
+extern int main(void);
+
+static Int ARGC;
+static Byte** ARGV;
+
+__attribute__((used)) static void start(Int* stack) {
+  ARGC = stack[0];
+  ARGV = (Byte**)(stack + 1);
+  sys_exit(main());
+}
+
+extern void sys_setup(void) {
+  setup_io((Handle)0, (Handle)1);
+}
+
+static Int read_file(Handle file, Byte* data, Int n) {
+  Int read;
+  do {
+    read = linux_syscall(NR_READ, (Int)file, (Int)data, n, 0, 0, 0);
+  } while (read == -EINTR);
+  return read < 0 ? -1 : read;
+}
+
+static Bool write_file(Handle file, const Byte* data, Int n) {
+  while (n > 0) {
+    Int written = linux_syscall(NR_WRITE, (Int)file, (Int)data, n, 0, 0, 0);
+    if (written == -EINTR) {
+      continue;
+    }
+    if (written < 0) {
+      return false;
+    }
+    data += written;
+    n -= written;
+  }
+  return true;
+}
+
+static Bool is_interactive(Handle file) {
+  // only a terminal answers TCGETS
+  Byte termios[64];
+  return linux_syscall(NR_IOCTL, (Int)file, TCGETS, (Int)termios, 0, 0, 0) == 0;
+}
+
+// Memory for the allocator
+static Byte* map_memory(Int n) {
+  Int p = linux_syscall(NR_MMAP, 0, n, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+  return p < 0 ? NULL : (Byte*)p;
+}
+
+static void unmap_memory(Byte* memory, Int n) {
+  linux_syscall(NR_MUNMAP, (Int)memory, n, 0, 0, 0, 0);
+}
+
+// IO functions
+extern Handle open(const Byte* filename) {
+  Int file = linux_syscall(NR_OPEN, (Int)filename, O_RDWR, 0, 0, 0, 0);
+  if (file < 0) {
+    return NULL;
+  }
+  // fd 0 is stdin, so a file never gets a NULL handle
+  return (Handle)file;
+}
+
+extern void close(Handle file) {
+  linux_syscall(NR_CLOSE, (Int)file, 0, 0, 0, 0, 0);
+}
+
+extern Int file_size(Handle file) {
+  Int size = linux_syscall(NR_LSEEK, (Int)file, 0, SEEK_END, 0, 0, 0);
+  if (size < 0) {
+    return -1;
+  }
+  return size;
+}
+
+// munmap needs the size of the mapping, only one file is mapped at a time
+static Int MAPPED_SIZE;
+
+extern Byte* mmap(Handle file) {
+  Int size = file_size(file);
+  if (size <= 0) {
+    return NULL;
+  }
+
+  Int view = linux_syscall(NR_MMAP, 0, size, PROT_READ | PROT_WRITE, MAP_PRIVATE, (Int)file, 0);
+  if (view < 0) {
+    return NULL;
+  }
+
+  MAPPED_SIZE = size;
+  return (Byte*)view;
+}
+
+extern void munmap(Byte* map) {
+  linux_syscall(NR_MUNMAP, (Int)map, MAPPED_SIZE, 0, 0, 0, 0);
+}
+
+extern void write_error(const Byte* data, Int n) {
+  write_file((Handle)2, data, n);
+}
+
+extern Byte* command_line(void) {
+  static Byte buffer[4096];
+  Int n = 0;
+  for (Int i = 0; i < ARGC; ++i) {
+    for (Byte* arg = ARGV[i]; *arg && n < sizeof(buffer) - 2; ++arg) {
+      buffer[n++] = *arg;
+    }
+    if (i + 1 < ARGC && n < sizeof(buffer) - 1) {
+      buffer[n++] = ' ';
+    }
+  }
+  buffer[n] = 0;
+  return buffer;
+}
+
+// syscalls
+extern void sys_exit(Int code) {
+  flush_output();
+#ifdef ALLOC_STATS
+  print_alloc_stats((Handle)2);
+#endif
+  linux_syscall(NR_EXIT, code, 0, 0, 0, 0, 0);
+  __builtin_unreachable();
+}
@@ -15,6 +15,8 @@ enum {
   SYS_LIST_SLICE = 26,
   SYS_LIST_REF = 27,
   SYS_LIST_UNREF = 28,
+  SYS_LIVE_LISTS = 29,
+  SYS_LIVE_BYTES = 30,
 
   SYS_PRINT = 100,
   SYS_INPUT = 101,
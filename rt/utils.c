@@ -40,7 +40,7 @@ static Int to_chars(Byte* s, Int len, Int val) {
 
 static Int from_chars(const Byte* buffer, Int len, Int* parsed) {
   Int i = 0;
-  while (buffer[i] == ' ' || buffer[i] == '\n' || buffer[i] == '\r') {
+  while (i < len && (buffer[i] == ' ' || buffer[i] == '\n' || buffer[i] == '\r')) {
     ++i;
   }
 
@@ -9,14 +9,15 @@ language_grammar = '''
     global    : "global" VAR ("," VAR)*
     function  : "fn" VAR "(" args  ")" ["->" typename] block
     args      : [VAR ("," VAR)*]
-    typename  : "int" | "list" | "str"
+    !typename : "int" | "list" | "str"
     ?block    : "{" statement* "}"
     ?statement: assign | assign_at | if_else | while | do_while | for | return | pass | call
     if_else   : "if" expr block ("else" "if" expr block)* ["else" block]
     while     : "while" expr block
     do_while  : "do" block "while" expr
     for       : "for" statement "," expr "," statement block
-    assign_at : expr "[" expr "]" ASSIGN expr
+    assign_at : place "[" expr "]" ASSIGN expr
+    ?place    : var_expr | call | place "[" expr "]" -> list_at
     assign    : VAR ASSIGN expr
     return    : "return" expr
     pass      : "pass"
@@ -64,8 +65,9 @@ language_grammar = '''
     %ignore CPP_COMMENT
 '''
 
-# TODO: update grammar to use lalr parser
-parser = Lark(language_grammar)
+# parse tables are cached on disk (keyed by grammar hash), so importing
+# this module does not rebuild them every time
+parser = Lark(language_grammar, parser='lalr', cache=True)
 parse = parser.parse
 
 if __name__ == '__main__':
@@ -5,6 +5,8 @@ import io
 import contextlib
 import subprocess
 import re
+import json
+import struct
 
 import pytest
 
@@ -38,10 +40,21 @@ files = sorted(files, key=natural_sort_key)
 rt = None
 vm = None
 
+def runtime():
+    global rt
+    if rt is None:
+        rt = driver.compile(driver.runtime())
+    return rt
+
+def c_vm():
+    global vm
+    if vm is None:
+        driver.build('vm.c', [runtime()], with_runtime=False)
+        vm = os.path.abspath(driver.executable('vm.c'))
+    return vm
+
 @pytest.mark.parametrize('file', files)
 def test_program(file):
-    global vm, rt
-
     program, inp, expected_output = read_files(file)
     program = syntax.parse(program)
     program = bc.compile(program)
@@ -60,27 +73,304 @@ def test_program(file):
     assert len(state.stack) == 0, str(stack)
     assert expected_output == out.getvalue()
 
+    # test closure-compiled python implementation
+    out = io.StringIO()
+    state = bc.State(program)
+    with contextlib.redirect_stdout(out), use_as_stdin(inp):
+        assert bc.threaded.execute(state, program) == 0
+
+    assert len(state.stack) == 0, str(state.stack)
+    assert expected_output == out.getvalue()
+
     # test compiled x64 binary
-    asm = x64.compile(program)
     asm_file = file.replace('.nox', '.s')
     with open(asm_file, 'wt') as f:
-        f.write(asm)
-
-    if rt is None:
-        rt = driver.compile(driver.runtime())
+        x64.compile(program, f)
 
-    driver.build(asm_file, [rt], with_runtime=False)
-    binary = file.replace('.nox', '.exe')
+    driver.build(asm_file, [runtime()], with_runtime=False)
+    binary = driver.executable(file)
     status = subprocess.run([binary], input=inp.encode(), capture_output=True, timeout=0.5, check=True)
     assert expected_output == status.stdout.decode()
 
-    # test vm in written C
+    # test vm in written C, with both versions of the file format
     bytecode = file.replace('.nox', '.noxbc')
-    with open(bytecode, 'wb') as f:
-        f.write(program.serialize())
+    for version in 1, 2:
+        data = program.serialize(version)
+        assert bc.Program.deserialize(data).serialize(version) == data
+        with open(bytecode, 'wb') as f:
+            f.write(data)
 
-    if vm is None:
-        driver.build('vm.c', [rt], with_runtime=False, definitions=['RT_CHECKS_ON'])
-        vm = 'vm.exe'
-    status = subprocess.run([vm, bytecode], input=inp.encode(), capture_output=True, timeout=0.5, check=True)
-    assert expected_output == status.stdout.decode()
\ No newline at end of file
+        status = subprocess.run([c_vm(), bytecode], input=inp.encode(), capture_output=True, timeout=0.5, check=True)
+        assert expected_output == status.stdout.decode()
+
+
+def test_vm_limits(tmp_path):
+    source, inp, expected_output = read_files(os.path.join(current_dir, 'tests', '44.nox'))
+    program = bc.compile(syntax.parse(source))
+    bytecode = tmp_path / '44.noxbc'
+    bytecode.write_bytes(program.serialize())
+
+    status = subprocess.run([c_vm(), '--call-limit', '1000', bytecode], input=inp.encode(), capture_output=True, timeout=0.5)
+    assert status.returncode != 0
+    assert 'Stack overflow' in status.stdout.decode()
+
+    status = subprocess.run([c_vm(), '--stack-limit', '100', bytecode], input=inp.encode(), capture_output=True, timeout=0.5)
+    assert status.returncode != 0
+
+    args = [c_vm(), '--call-limit', '30000', '--stack-limit', '1000000', bytecode]
+    status = subprocess.run(args, input=inp.encode(), capture_output=True, timeout=0.5, check=True)
+    assert expected_output == status.stdout.decode()
+
+    # a command line longer than the buffer it is joined into
+    status = subprocess.run([c_vm(), bytecode, *['x'] * 3000], input=inp.encode(), capture_output=True, timeout=0.5)
+    assert status.returncode != 0
+    assert 'Usage' in status.stdout.decode()
+
+
+verified_source = '''
+fn f(x) -> int {
+    return x + 1
+}
+n = input()
+for i = 0, i < n, i = i + 1 {
+    print(f(i))
+}
+'''
+
+# replaced instruction of the level 0 program, which verifies
+@pytest.mark.parametrize('i, instruction', [
+    (1, bc.Instruction(bc.Op.LOAD, 2)),
+    (15, bc.Instruction(bc.Op.GLOAD, 0)),
+    (11, bc.Instruction(bc.Op.JMP, 2)),
+    (22, bc.Instruction(bc.Op.JNZ, 26)),
+    (13, bc.Instruction(bc.Op.CALL, 1)),
+    (13, bc.Instruction(bc.Op.CALL, 6)),
+    (14, bc.Instruction(bc.Op.SYSCALL, 7)),
+    (0, bc.Instruction(bc.Op.ENTER, False, 1, 0)),
+    (18, bc.Instruction(bc.Op.LOAD, 1)),
+    (16, bc.Instruction(bc.Op.ADD)),
+    (25, bc.Instruction(bc.Op.RET)),
+])
+def test_verify(i, instruction, tmp_path, monkeypatch):
+    program = bc.compile(syntax.parse(verified_source), level=0)
+    program.instructions[i] = instruction
+    with pytest.raises(bc.VerifyError):
+        program.verify()
+    with pytest.raises(bc.VerifyError):
+        bc.Program.deserialize(program.serialize())
+
+    # version 2 keeps the returns value bit of ENTER, version 1 infers it
+    monkeypatch.setattr(bc.Program, 'verify', lambda self: (0, 0))
+    data = program.serialize(version=2)
+    monkeypatch.undo()
+    with pytest.raises(bc.VerifyError):
+        bc.Program.deserialize(data)
+
+    bytecode = tmp_path / 'invalid.noxbc'
+    bytecode.write_bytes(data)
+    status = subprocess.run([c_vm(), bytecode], input=b'3\n', capture_output=True, timeout=0.5)
+    assert status.returncode != 0
+    assert 'Invalid bytecode' in status.stdout.decode()
+
+
+def test_vm_format(tmp_path):
+    program = bc.compile(syntax.parse(verified_source))
+    data = program.serialize(version=2)
+    bytecode = tmp_path / 'program.noxbc'
+    for corrupted, message in (
+        (data[:6] + b'\x03\x00' + data[8:], 'Unsupported bytecode version'),
+        (data[:-1], 'Invalid or corrupted file (size)'),
+        (data[:len(data) - 2] + b'\x3F' + data[-1:], 'Invalid bytecode'),
+    ):
+        bytecode.write_bytes(corrupted)
+        status = subprocess.run([c_vm(), bytecode], input=b'3\n', capture_output=True, timeout=0.5)
+        assert status.returncode != 0
+        assert message in status.stdout.decode()
+
+
+def test_deserialize_corrupted():
+    program = bc.compile(syntax.parse(verified_source))
+    data = program.serialize(version=2)
+    # the counts are checked against the size before they are allocated
+    huge_globals = data[:8] + struct.pack('<I', 0x7fffffff) + data[12:]
+    for corrupted in data[:-1], data + b'\0', huge_globals, data[:len(data) - 2] + b'\x3F' + data[-1:]:
+        with pytest.raises((ValueError, bc.VerifyError)):
+            bc.Program.deserialize(corrupted)
+
+    data = program.serialize(version=1)
+    for corrupted in data[:-1], data[:8] + struct.pack('<I', 0x7fffffff) + data[12:]:
+        with pytest.raises(ValueError):
+            bc.Program.deserialize(corrupted)
+
+
+def test_legacy_v1(tmp_path):
+    # a version 1 file as the first vm.c read it: ENTER without the returns
+    # value bit and a 16 byte header
+    program = bc.compile(syntax.parse(verified_source), level=0)
+    legacy = b'.noxbc--' + struct.pack('<II', len(program.globals), program.entry)
+    for instruction in program.instructions:
+        opcode, operand = struct.unpack('<B7xq', instruction.bytecode())
+        if instruction.op is bc.Op.ENTER:
+            operand &= ~(1 << 31)
+        legacy += struct.pack('<B7xq', opcode, operand)
+    assert program.serialize(version=1) == legacy
+
+    loaded = bc.Program.deserialize(legacy)
+    assert loaded.instructions == program.instructions
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), use_as_stdin('3\n'):
+        assert bc.execute(bc.State(loaded), loaded) == 0
+    assert out.getvalue() == '1\n2\n3\n'
+
+    bytecode = tmp_path / 'legacy.noxbc'
+    bytecode.write_bytes(legacy)
+    status = subprocess.run([c_vm(), bytecode], input=b'3\n', capture_output=True, timeout=0.5, check=True)
+    assert status.stdout.decode() == '1\n2\n3\n'
+
+
+@pytest.mark.parametrize('level', [0, 1, 2])
+@pytest.mark.parametrize('file', files)
+def test_optimization_level(file, level):
+    source, inp, expected_output = read_files(file)
+    ast = syntax.parse(source)
+    compiled = bc.compile(ast, level)
+    # textual bytecode goes through the same optimizations
+    parsed = bc.parse(str(bc.compile(ast, level=0)), level)
+    assert [i.op for i in compiled.instructions] == [i.op for i in parsed.instructions]
+
+    loaded = bc.Program.deserialize(compiled.serialize())
+    compact = bc.Program.build(compiled.source, compact=True)
+    assert compact.serialize() == compiled.serialize()
+    for program in compiled, parsed, loaded, compact:
+        out = io.StringIO()
+        state = bc.State(program)
+        with contextlib.redirect_stdout(out), use_as_stdin(inp):
+            assert bc.execute(state, program) == 0
+
+        assert len(state.stack) == 0, str(state.stack)
+        assert expected_output == out.getvalue()
+
+
+
+@pytest.mark.parametrize('execute', [bc.execute, bc.threaded.execute, bc.transpiler.execute])
+@pytest.mark.parametrize('file', files)
+def test_fast_io(file, execute):
+    source, inp, expected_output = read_files(file)
+    program = bc.compile(syntax.parse(source))
+    out = io.StringIO()
+    state = bc.State(program, fast_io=True)
+    with contextlib.redirect_stdout(out), use_as_stdin(inp):
+        assert execute(state, program) == 0
+
+    assert expected_output == out.getvalue()
+
+
+@pytest.mark.parametrize('file', files)
+def test_transpiler_dispatch(file, monkeypatch):
+    # the fallback for control flow that isn't structured
+    def unstructured(self):
+        raise bc.transpiler.Unstructured()
+    monkeypatch.setattr(bc.transpiler.Function, 'structured', unstructured)
+
+    source, inp, expected_output = read_files(file)
+    program = bc.compile(syntax.parse(source))
+    out = io.StringIO()
+    state = bc.State(program)
+    with contextlib.redirect_stdout(out), use_as_stdin(inp):
+        assert bc.transpiler.execute(state, program) == 0
+
+    assert len(state.stack) == 0
+    assert expected_output == out.getvalue()
+
+
+@pytest.mark.parametrize('file', files)
+def test_cfg(file):
+    source, _, _ = read_files(file)
+    program = bc.compile(syntax.parse(source))
+    graphs = bc.cfg.build(program)
+    for graph in graphs.values():
+        for block in graph.blocks:
+            for successor in block.successors:
+                assert block.index in graph.blocks[successor].predecessors
+        for loop in graph.loops:
+            assert all(graph.dominates(loop.header, block) for block in loop.blocks)
+
+    assert bc.cfg.lower(graphs) == program
+    # lowering shares the instructions of the source, building leaves them as is
+    assert bc.Program.build(program.source) == program
+
+
+profile_vm = None
+
+def c_profile_vm():
+    global profile_vm
+    if profile_vm is None:
+        obj = driver.compile('vm.c', definitions=['PROFILE'])
+        profile_vm = os.path.abspath('vm_profile' + driver.exe_ext)
+        driver.link([obj, runtime()], profile_vm)
+        os.remove(obj)
+    return profile_vm
+
+
+@pytest.mark.parametrize('file', files)
+def test_profile(file, tmp_path):
+    source, inp, expected_output = read_files(file)
+    program = bc.compile(syntax.parse(source))
+    profile = bc.profile.Profile()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), use_as_stdin(inp):
+        assert bc.execute(bc.State(program), program, profile=profile) == 0
+    assert expected_output == out.getvalue()
+    assert profile.to_json()['instructions'] == sum(profile.opcodes.values())
+
+    # the vm writes the same profile to stderr
+    bytecode = tmp_path / 'program.noxbc'
+    bytecode.write_bytes(program.serialize())
+    status = subprocess.run([c_profile_vm(), bytecode], input=inp.encode(), capture_output=True, timeout=5, check=True)
+    assert expected_output == status.stdout.decode()
+    assert json.loads(status.stderr) == profile.to_json()
+    assert bc.profile.report(program, profile.to_json())
+
+
+def test_cache(tmp_path):
+    cache = driver.Cache(str(tmp_path / 'cache'))
+    source, inp, expected_output = read_files(files[0])
+    program = driver.compile_source(source, 1, cache)
+    assert driver.compile_source(source, 1, cache) == program == bc.compile(syntax.parse(source))
+    asm = driver.compile_x64(program, cache)
+    assert driver.compile_x64(program, cache) == asm == x64.compile(program)
+
+    asm_file = str(tmp_path / 'program.s')
+    with open(asm_file, 'wt') as f:
+        f.write(asm)
+    for _ in range(2):
+        driver.build(asm_file, cache=cache)
+        status = subprocess.run([driver.executable(asm_file)], input=inp.encode(), capture_output=True, timeout=0.5, check=True)
+        assert expected_output == status.stdout.decode()
+
+    stages = {'bytecode': 1, 'asm': 1, 'asm object': 1, 'c object': 1}
+    assert cache.hits == stages and cache.misses == stages
+    driver.compile_source(source, 2, cache)
+    assert cache.misses['bytecode'] == 2
+    cache.save_stats()
+    assert cache.stats()['stages']['asm'] == {'hits': 1, 'misses': 1}
+
+    # the least recently used entries are removed first
+    entries = sorted(cache.entries(), key=lambda entry: entry[2])
+    for i, (_, _, path) in enumerate(entries):
+        os.utime(path, ns=(i, i))
+    cache.max_size = sum(size for _, size, _ in entries) - 1
+    empty = cache.path(cache.key('empty'))
+    cache.put(cache.key('empty'), b'')
+    assert len(cache.entries()) == len(entries) + 1
+    # once per run, with the stats
+    cache.save_stats()
+    assert sorted(path for _, _, path in cache.entries()) == sorted([path for _, _, path in entries[1:]] + [empty])
+
+
+@pytest.mark.parametrize('file', files)
+def test_x64_parallel(file):
+    source, _, _ = read_files(file)
+    program = bc.compile(syntax.parse(source))
+    # the functions are compiled in processes, the listing stays the same
+    assert x64.compile(program, workers=3) == x64.compile(program)
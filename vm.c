@@ -1,23 +1,6 @@
 #include "rt/syscalls.h"
 #include "rt/io.h"
-
-#define _STR(x) #x
-#define STR(x) _STR(x)
-#define FILE_LINE __FILE__ ":" STR(__LINE__)
-
-#ifdef RT_CHECKS_ON
-#define RT_CHECK(cond)                                           \
-  do {                                                           \
-    if (!(cond)) {                                               \
-      puts("Failed to execute instruction at ip=");              \
-      sys_print(ip);                                             \
-      puts("Condition at " FILE_LINE  " is false: " #cond "\n"); \
-      return -1;                                                 \
-    }                                                            \
-  } while (0)
-#else
-#define RT_CHECK(cond)
-#endif
+#include "rt/mem.h"
 
 enum Op {
   LOAD    = 0x00,
@@ -45,7 +28,16 @@ enum Op {
   SYSCALL = 0x16,
   RET     = 0x17,
   ENTER   = 0x18,
-  LEAVE   = 0x20
+  LEAVE   = 0x19,
+  // superinstructions
+  INC_LOCAL       = 0x1A,
+  LIST_PUSH_CONST = 0x1B,
+  JLT     = 0x1C,
+  JLE     = 0x1D,
+  JGT     = 0x1E,
+  JGE     = 0x1F,
+  JEQ     = 0x20,
+  JNE     = 0x21
 };
 
 typedef struct {
@@ -58,23 +50,422 @@ typedef struct {
 
 static_assert(sizeof(Instruction) == 16);
 
-#define MAX_STACK_DEPTH 256
-// assuming less than 16 args+locals per function on average
-#define MAX_MEM MAX_STACK_DEPTH * 16
+// Computed goto is a GNU extension, SWITCH_DISPATCH forces the portable switch.
+// In threaded mode the loader translates instructions to handler addresses, so
+// an instruction is dispatched with a single indirect jump from its handler.
+#if defined(__GNUC__) && !defined(SWITCH_DISPATCH)
+#define THREADED_DISPATCH
+#endif
+
+#ifdef THREADED_DISPATCH
+typedef struct {
+  void* handler;
+  Int   arg;
+} Code;
+
+#define DISPATCH NEXT();
+#define CASE(op) op##_HANDLER:
+#define CASE_DEFAULT UNKNOWN_HANDLER:
+#define NEXT()                    \
+  do {                            \
+    STEP();                       \
+    instruction = code + ip;      \
+    goto *instruction->handler;   \
+  } while (0)
+#else
+typedef Instruction Code;
+
+#define DISPATCH while (ip < n) switch (STEP(), (instruction = code + ip)->opcode)
+#define CASE(op) case op:
+#define CASE_DEFAULT default:
+#define NEXT() continue
+#endif
+
+// The stacks start with room for a few frames and grow from the runtime
+// allocator at ENTER. The header of the bytecode gives the deepest operand
+// stack and the largest frame of any function, so the frame being entered
+// can't run out of room before the next call.
 typedef struct {
-  Int stack[MAX_STACK_DEPTH];
-  Int callstack[MAX_STACK_DEPTH];
-  Int stackframe[MAX_STACK_DEPTH];
-  Int memory[MAX_MEM];
+  Int* stack;
+  // return addresses and frame sizes
+  Int* callstack;
+  Int* stackframe;
+  // globals followed by the args and locals of every frame
+  Int* memory;
+  Int stack_capacity;
+  Int frames_capacity;
+  Int memory_capacity;
 } State;
 
-static State STATE;
+// in words, except max_frames
+typedef struct {
+  Int max_stack;
+  Int max_frames;
+  Int max_memory;
+} Limits;
+
+static Limits LIMITS = {
+  .max_stack = 1 << 26,
+  .max_frames = 1 << 20,
+  .max_memory = 1 << 26,
+};
+
+static const Int INITIAL_FRAMES = 16;
+
+static Bool reserve(Int** data, Int* capacity, Int needed, Int limit) {
+  if (needed <= *capacity) {
+    return true;
+  }
+  if (needed > limit) {
+    return false;
+  }
+
+  Int new_capacity = *capacity * 2;
+  if (new_capacity < needed) {
+    new_capacity = needed;
+  }
+  if (new_capacity > limit) {
+    new_capacity = limit;
+  }
+
+  Int* p = (Int*)heap_realloc((Byte*)*data, new_capacity * sizeof(Int));
+  if (!p) {
+    return false;
+  }
+  *data = p;
+  *capacity = new_capacity;
+  return true;
+}
+
+static Bool reserve_frames(State* state, Int frames, Int memory, Int stack) {
+  Int frames_capacity = state->frames_capacity;
+  return reserve(&state->callstack, &frames_capacity, frames, LIMITS.max_frames) &&
+         reserve(&state->stackframe, &state->frames_capacity, frames, LIMITS.max_frames) &&
+         reserve(&state->memory, &state->memory_capacity, memory, LIMITS.max_memory) &&
+         reserve(&state->stack, &state->stack_capacity, stack, LIMITS.max_stack);
+}
+
+static void free_state(State* state) {
+  heap_free((Byte*)state->stack);
+  heap_free((Byte*)state->callstack);
+  heap_free((Byte*)state->stackframe);
+  heap_free((Byte*)state->memory);
+}
+
+// Built with PROFILE, the vm counts the instructions it runs before each one
+// and writes the counts to stderr as JSON when the program ends, in the format
+// of bc/profile.py. Otherwise STEP() is nothing.
+#ifdef PROFILE
+#define STEP() profile_step(&profile, instructions, ip)
+
+enum { N_OPCODES = JNE + 1 };
+
+static const Byte* const OP_NAMES[N_OPCODES] = {
+  [LOAD] = "load", [STORE] = "store", [GLOAD] = "gload", [GSTORE] = "gstore",
+  [CONST] = "const", [ADD] = "add", [SUB] = "sub", [MUL] = "mul", [DIV] = "div",
+  [MOD] = "mod", [AND] = "and", [OR] = "or", [LT] = "lt", [LE] = "le", [GT] = "gt",
+  [GE] = "ge", [EQ] = "eq", [NE] = "ne", [JMP] = "jmp", [JZ] = "jz", [JNZ] = "jnz",
+  [CALL] = "call", [SYSCALL] = "syscall", [RET] = "ret", [ENTER] = "enter",
+  [LEAVE] = "leave", [INC_LOCAL] = "inc_local", [LIST_PUSH_CONST] = "list_push_const",
+  [JLT] = "jlt", [JLE] = "jle", [JGT] = "jgt", [JGE] = "jge", [JEQ] = "jeq", [JNE] = "jne",
+};
+
+typedef struct {
+  // index of the ENTER
+  Int start;
+  // instructions run before it
+  Int entered_at;
+} ProfileFrame;
+
+typedef struct {
+  Int executed;
+  Int opcodes[N_OPCODES];
+  Int pairs[N_OPCODES][N_OPCODES];
+  // by instruction index: calls and inclusive instructions of the function
+  // starting there, active frames of it and taken backward jumps to it
+  Int* calls;
+  Int* inclusive;
+  Int* active;
+  Int* loops;
+  ProfileFrame* frames;
+  Int n_frames;
+  Int frames_capacity;
+  // -1 before the first instruction
+  Int previous;
+} Profile;
+
+static Bool is_jump(Byte opcode);
+
+static Int* zeroed(Int n) {
+  Int* p = (Int*)heap_alloc(n * sizeof(Int));
+  for (Int i = 0; p && i < n; ++i) {
+    p[i] = 0;
+  }
+  return p;
+}
 
-static Int run_code(Instruction* instructions, Int n, Int entrypoint, Int globals) {
-  Int* STACK = STATE.stack;
-  Int* CALLSTACK = STATE.callstack;
-  Int* STACKFRAME = STATE.stackframe;
-  Int* MEMORY = STATE.memory;
+static Bool profile_init(Profile* profile, Int n) {
+  // assigned field by field, a compound literal this large becomes a call
+  // to memset, which the runtime doesn't have
+  profile->executed = 0;
+  for (Int a = 0; a < N_OPCODES; ++a) {
+    profile->opcodes[a] = 0;
+    for (Int b = 0; b < N_OPCODES; ++b) {
+      profile->pairs[a][b] = 0;
+    }
+  }
+  profile->frames = NULL;
+  profile->n_frames = 0;
+  profile->frames_capacity = 0;
+  profile->previous = -1;
+  profile->calls = zeroed(n);
+  profile->inclusive = zeroed(n);
+  profile->active = zeroed(n);
+  profile->loops = zeroed(n);
+  return profile->calls && profile->inclusive && profile->active && profile->loops;
+}
+
+static void profile_free(Profile* profile) {
+  heap_free((Byte*)profile->calls);
+  heap_free((Byte*)profile->inclusive);
+  heap_free((Byte*)profile->active);
+  heap_free((Byte*)profile->loops);
+  heap_free((Byte*)profile->frames);
+}
+
+static void profile_return(Profile* profile) {
+  ProfileFrame frame = profile->frames[--profile->n_frames];
+  // a recursive function is counted once, by its outermost frame
+  if (--profile->active[frame.start] == 0) {
+    profile->inclusive[frame.start] += profile->executed - frame.entered_at;
+  }
+}
+
+static void profile_step(Profile* profile, const Instruction* instructions, Int ip) {
+  Byte opcode = instructions[ip].opcode;
+  ++profile->executed;
+  ++profile->opcodes[opcode];
+  if (profile->previous >= 0) {
+    Byte previous = instructions[profile->previous].opcode;
+    ++profile->pairs[previous][opcode];
+    if (is_jump(previous) && ip <= profile->previous) {
+      ++profile->loops[ip];
+    }
+  }
+  profile->previous = ip;
+
+  if (opcode == ENTER) {
+    if (profile->n_frames == profile->frames_capacity) {
+      Int capacity = profile->frames_capacity ? 2 * profile->frames_capacity : INITIAL_FRAMES;
+      ProfileFrame* frames = (ProfileFrame*)heap_realloc(
+          (Byte*)profile->frames, capacity * sizeof(ProfileFrame));
+      if (!frames) {
+        puts("Failed to allocate profile frames\n");
+        sys_exit(-1);
+      }
+      profile->frames = frames;
+      profile->frames_capacity = capacity;
+    }
+    profile->frames[profile->n_frames++] = (ProfileFrame){ip, profile->executed - 1};
+    ++profile->active[ip];
+    ++profile->calls[ip];
+  }
+  else if (opcode == RET) {
+    profile_return(profile);
+  }
+}
+
+typedef struct {
+  Byte data[4096];
+  Int n;
+} Writer;
+
+static void write_flush(Writer* w) {
+  write_error(w->data, w->n);
+  w->n = 0;
+}
+
+static void write_str(Writer* w, const Byte* s) {
+  for (; *s; ++s) {
+    if (w->n == sizeof(w->data)) {
+      write_flush(w);
+    }
+    w->data[w->n++] = *s;
+  }
+}
+
+static void write_int(Writer* w, Int val) {
+  // the counts are not negative
+  Byte digits[24];
+  Int n = sizeof(digits) - 1;
+  digits[n] = 0;
+  do {
+    digits[--n] = '0' + val % 10;
+    val /= 10;
+  } while (val);
+  write_str(w, digits + n);
+}
+
+static void write_entry(Writer* w, Bool* first, Int key) {
+  write_str(w, *first ? "\"" : ", \"");
+  write_int(w, key);
+  write_str(w, "\": ");
+  *first = false;
+}
+
+static void write_profile(Profile* profile, Int n) {
+  // functions still running at the exit end there
+  while (profile->n_frames) {
+    profile_return(profile);
+  }
+
+  Writer w;
+  w.n = 0;
+  Bool first = true;
+  write_str(&w, "{\"instructions\": ");
+  write_int(&w, profile->executed);
+  write_str(&w, ", \"opcodes\": {");
+  for (Int op = 0; op < N_OPCODES; ++op) {
+    if (profile->opcodes[op]) {
+      write_str(&w, first ? "\"" : ", \"");
+      write_str(&w, OP_NAMES[op]);
+      write_str(&w, "\": ");
+      write_int(&w, profile->opcodes[op]);
+      first = false;
+    }
+  }
+  write_str(&w, "}, \"pairs\": {");
+  first = true;
+  for (Int a = 0; a < N_OPCODES; ++a) {
+    for (Int b = 0; b < N_OPCODES; ++b) {
+      if (profile->pairs[a][b]) {
+        write_str(&w, first ? "\"" : ", \"");
+        write_str(&w, OP_NAMES[a]);
+        write_str(&w, " ");
+        write_str(&w, OP_NAMES[b]);
+        write_str(&w, "\": ");
+        write_int(&w, profile->pairs[a][b]);
+        first = false;
+      }
+    }
+  }
+  write_str(&w, "}, \"functions\": {");
+  first = true;
+  for (Int i = 0; i < n; ++i) {
+    if (profile->calls[i]) {
+      write_entry(&w, &first, i);
+      write_str(&w, "{\"calls\": ");
+      write_int(&w, profile->calls[i]);
+      write_str(&w, ", \"instructions\": ");
+      write_int(&w, profile->inclusive[i]);
+      write_str(&w, "}");
+    }
+  }
+  write_str(&w, "}, \"loops\": {");
+  first = true;
+  for (Int i = 0; i < n; ++i) {
+    if (profile->loops[i]) {
+      write_entry(&w, &first, i);
+      write_int(&w, profile->loops[i]);
+    }
+  }
+  write_str(&w, "}}\n");
+  write_flush(&w);
+}
+#else
+#define STEP() ((void)0)
+#endif
+
+static Int run_code(Instruction* instructions, Int n, Int entrypoint, Int globals, Int max_depth, Int max_frame) {
+#ifdef THREADED_DISPATCH
+  static void* const HANDLERS[] = {
+    [LOAD]    = &&LOAD_HANDLER,
+    [STORE]   = &&STORE_HANDLER,
+    [GLOAD]   = &&GLOAD_HANDLER,
+    [GSTORE]  = &&GSTORE_HANDLER,
+    [CONST]   = &&CONST_HANDLER,
+    [ADD]     = &&ADD_HANDLER,
+    [SUB]     = &&SUB_HANDLER,
+    [MUL]     = &&MUL_HANDLER,
+    [DIV]     = &&DIV_HANDLER,
+    [MOD]     = &&MOD_HANDLER,
+    [AND]     = &&AND_HANDLER,
+    [OR]      = &&OR_HANDLER,
+    [LT]      = &&LT_HANDLER,
+    [LE]      = &&LE_HANDLER,
+    [GT]      = &&GT_HANDLER,
+    [GE]      = &&GE_HANDLER,
+    [EQ]      = &&EQ_HANDLER,
+    [NE]      = &&NE_HANDLER,
+    [JMP]     = &&JMP_HANDLER,
+    [JZ]      = &&JZ_HANDLER,
+    [JNZ]     = &&JNZ_HANDLER,
+    [CALL]    = &&CALL_HANDLER,
+    [SYSCALL] = &&SYSCALL_HANDLER,
+    [RET]     = &&RET_HANDLER,
+    [ENTER]   = &&ENTER_HANDLER,
+    [LEAVE]   = &&LEAVE_HANDLER,
+    [INC_LOCAL]       = &&INC_LOCAL_HANDLER,
+    [LIST_PUSH_CONST] = &&LIST_PUSH_CONST_HANDLER,
+    [JLT]     = &&JLT_HANDLER,
+    [JLE]     = &&JLE_HANDLER,
+    [JGT]     = &&JGT_HANDLER,
+    [JGE]     = &&JGE_HANDLER,
+    [JEQ]     = &&JEQ_HANDLER,
+    [JNE]     = &&JNE_HANDLER,
+  };
+
+  // one more entry past the end catches running off the code
+  Code* code = (Code*)heap_alloc((n + 1) * sizeof(Code));
+  if (!code) {
+    puts("Failed to allocate threaded code\n");
+    return -1;
+  }
+
+  for (Int i = 0; i < n; ++i) {
+    Byte opcode = instructions[i].opcode;
+    void* handler = opcode < sizeof(HANDLERS) / sizeof(HANDLERS[0]) ? HANDLERS[opcode] : NULL;
+    code[i].handler = handler ? handler : &&UNKNOWN_HANDLER;
+    code[i].arg = instructions[i].arg;
+  }
+  code[n].handler = &&END_HANDLER;
+  code[n].arg = 0;
+#else
+  Code* code = instructions;
+#endif
+
+  State state = {0};
+  if (!reserve_frames(&state, INITIAL_FRAMES, globals + 1 + max_frame * INITIAL_FRAMES,
+                      max_depth * INITIAL_FRAMES)) {
+    puts("Failed to allocate stacks\n");
+#ifdef THREADED_DISPATCH
+    heap_free((Byte*)code);
+#endif
+    return -1;
+  }
+  // globals are 0 until their first store, the heap may hand out a block
+  // freed by verify
+  for (Int i = 0; i <= globals; ++i) {
+    state.memory[i] = 0;
+  }
+
+#ifdef PROFILE
+  Profile profile;
+  if (!profile_init(&profile, n)) {
+    puts("Failed to allocate the profile\n");
+    profile_free(&profile);
+    free_state(&state);
+#ifdef THREADED_DISPATCH
+    heap_free((Byte*)code);
+#endif
+    return -1;
+  }
+#endif
+
+  Int* STACK = state.stack;
+  Int* CALLSTACK = state.callstack;
+  Int* STACKFRAME = state.stackframe;
+  Int* MEMORY = state.memory;
 
   Int ip = entrypoint;
   Int stack = 0;
@@ -83,307 +474,397 @@ static Int run_code(Instruction* instructions, Int n, Int entrypoint, Int global
   Int mem = globals;
 
   List* list;
-  Int r, l, idx, val;
-
-  while (ip < n) {
-    Instruction* instruction = instructions + ip;
-    // puts("IP: ");
-    // sys_print(ip);
-    // puts("OP: ");
-    // sys_print(instruction->opcode);
-    // puts("MEM: ");
-    // sys_print(mem);
-    // puts("STACK: ");
-    // sys_print(stack);
-    switch (instruction->opcode) {
-      case LOAD:
-        RT_CHECK(stack < MAX_STACK_DEPTH);
-        RT_CHECK(stackframe > 0);
-        RT_CHECK(instruction->arg < STACKFRAME[stackframe-1]);
+  Int r, l, idx, val, ret;
+  Code* instruction;
+
+  DISPATCH {
+      CASE(LOAD)
         STACK[stack++] = MEMORY[mem - instruction->arg];
         ++ip;
-        break;
-      case STORE:
-        RT_CHECK(stack > 0);
-        RT_CHECK(stackframe > 0);
-        RT_CHECK(instruction->arg < STACKFRAME[stackframe-1]);
+        NEXT();
+      CASE(STORE)
         MEMORY[mem - instruction->arg] = STACK[--stack];
         ++ip;
-        break;
-      case GLOAD:
-        RT_CHECK(stack < MAX_STACK_DEPTH);
-        RT_CHECK(instruction->arg < globals);
+        NEXT();
+      CASE(GLOAD)
         STACK[stack++] = MEMORY[instruction->arg];
         ++ip;
-        break;
-      case GSTORE:
-        RT_CHECK(stack > 0);
-        RT_CHECK(instruction->arg < globals);
+        NEXT();
+      CASE(GSTORE)
         MEMORY[instruction->arg] = STACK[--stack];
         ++ip;
-        break;
-      case CONST:
-        RT_CHECK(stack < MAX_STACK_DEPTH);
+        NEXT();
+      CASE(CONST)
         STACK[stack++] = instruction->arg;
         ++ip;
-        break;
-      case ADD:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(ADD)
         r = STACK[--stack];
         STACK[stack-1] += r;
         ++ip;
-        break;
-      case SUB:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(SUB)
         r = STACK[--stack];
         STACK[stack-1] -= r;
         ++ip;
-        break;
-      case MUL:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(MUL)
         r = STACK[--stack];
         STACK[stack-1] *= r;
         ++ip;
-        break;
-      case DIV:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(DIV)
         r = STACK[--stack];
         STACK[stack-1] /= r;
         ++ip;
-        break;
-      case MOD:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(MOD)
         r = STACK[--stack];
         STACK[stack-1] %= r;
         ++ip;
-        break;
-      case AND:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(AND)
         r = STACK[--stack];
         l = STACK[stack-1];
         STACK[stack-1] = l && r;
         ++ip;
-        break;
-      case OR:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(OR)
         r = STACK[--stack];
         l = STACK[stack-1];
         STACK[stack-1] = l || r;
         ++ip;
-        break;
-      case LT:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(LT)
         r = STACK[--stack];
         l = STACK[stack-1];
         STACK[stack-1] = l < r;
         ++ip;
-        break;
-      case LE:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(LE)
         r = STACK[--stack];
         l = STACK[stack-1];
         STACK[stack-1] = l <= r;
         ++ip;
-        break;
-      case GT:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(GT)
         r = STACK[--stack];
         l = STACK[stack-1];
         STACK[stack-1] = l > r;
         ++ip;
-        break;
-      case GE:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(GE)
         r = STACK[--stack];
         l = STACK[stack-1];
         STACK[stack-1] = l >= r;
         ++ip;
-        break;
-      case EQ:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(EQ)
         r = STACK[--stack];
         l = STACK[stack-1];
         STACK[stack-1] = l == r;
         ++ip;
-        break;
-      case NE:
-        RT_CHECK(stack > 1);
+        NEXT();
+      CASE(NE)
         r = STACK[--stack];
         l = STACK[stack-1];
         STACK[stack-1] = l != r;
         ++ip;
-        break;
-      case JMP:
-        RT_CHECK(instruction->arg < n);
+        NEXT();
+      CASE(JMP)
         ip = instruction->arg;
-        break;
-      case JZ:
-        RT_CHECK(instruction->arg < n);
+        NEXT();
+      CASE(JZ)
         r = STACK[--stack];
         ip = !r ? instruction->arg : (ip + 1);
-        break;
-      case JNZ:
-        RT_CHECK(instruction->arg < n);
+        NEXT();
+      CASE(JNZ)
         r = STACK[--stack];
         ip = r ? instruction->arg : (ip + 1);
-        break;
-      case CALL:
-        RT_CHECK(instruction->arg < n);
-        RT_CHECK(instructions[instruction->arg].opcode == ENTER);
-        RT_CHECK(callstack < MAX_STACK_DEPTH);
+        NEXT();
+#define CMP_JUMP(op)                                 \
+        r = STACK[--stack];                          \
+        l = STACK[--stack];                          \
+        ip = (l op r) ? instruction->arg : (ip + 1); \
+        NEXT();
+
+      CASE(JLT) CMP_JUMP(<)
+      CASE(JLE) CMP_JUMP(<=)
+      CASE(JGT) CMP_JUMP(>)
+      CASE(JGE) CMP_JUMP(>=)
+      CASE(JEQ) CMP_JUMP(==)
+      CASE(JNE) CMP_JUMP(!=)
+#undef CMP_JUMP
+      CASE(INC_LOCAL)
+        // local index in the low 32 bits, signed immediate in the high ones
+        idx = instruction->arg & 0xFFFFFFFF;
+        MEMORY[mem - idx] += instruction->arg >> 32;
+        ++ip;
+        NEXT();
+      CASE(LIST_PUSH_CONST)
+        idx = instruction->arg & 0xFFFFFFFF;
+        sys_push((List*)MEMORY[mem - idx], instruction->arg >> 32);
+        ++ip;
+        NEXT();
+      CASE(CALL)
         CALLSTACK[callstack++] = ip + 1;
         ip = instruction->arg;
-        break;
-      case SYSCALL:
+        NEXT();
+      CASE(SYSCALL)
         switch (instruction->arg) {
           case SYS_LIST:
-            RT_CHECK(stack < MAX_STACK_DEPTH);
             STACK[stack++] = (Int)sys_list();
             break;
           case SYS_LIST_GET:
-            RT_CHECK(stack > 1);
             list = (List*)STACK[--stack];
             idx = STACK[--stack];
             STACK[stack++] = sys_list_get(list, idx);
             break;
           case SYS_LIST_SET:
-            RT_CHECK(stack > 2);
             list = (List*)STACK[--stack];
             idx = STACK[--stack];
             sys_list_set(list, idx, STACK[--stack]);
             break;
           case SYS_LIST_PUSH:
-            RT_CHECK(stack > 1);
             list = (List*)STACK[--stack];
             val = STACK[--stack];
             sys_push(list, val);
             break;
           case SYS_LIST_LEN:
-            RT_CHECK(stack > 0);
             list = (List*)STACK[--stack];
             STACK[stack++] = sys_len(list);
             break;
           case SYS_LIST_CLEAR:
-            RT_CHECK(stack > 0);
             list = (List*)STACK[--stack];
             sys_clear(list);
             break;
           case SYS_LIST_SLICE:
-            RT_CHECK(stack > 2);
             list = (List*)STACK[--stack];
             l = STACK[--stack];
             r = STACK[--stack];
             STACK[stack++] = (Int)sys_slice(list, l, r);
             break;
           case SYS_LIST_REF:
-            RT_CHECK(stack > 0);
             list = (List*)STACK[--stack];
             sys_list_ref(list);
             break;
           case SYS_LIST_UNREF:
-            RT_CHECK(stack > 0);
             list = (List*)STACK[--stack];
             sys_list_unref(list);
             break;
+          case SYS_LIVE_LISTS:
+            STACK[stack++] = sys_live_lists();
+            break;
+          case SYS_LIVE_BYTES:
+            STACK[stack++] = sys_live_bytes();
+            break;
           case SYS_INPUT:
-            RT_CHECK(stack < MAX_STACK_DEPTH);
             STACK[stack++] = sys_input();
             break;
           case SYS_PRINT:
-            RT_CHECK(stack > 0);
             sys_print(STACK[--stack]);
             break;
           case SYS_EXIT:
-            RT_CHECK(stack > 0);
-            return STACK[--stack];
+            ret = STACK[--stack];
+            goto done;
           default:
             puts("Unknown syscall ");
             sys_print(instruction->arg);
-            return -1;
+            ret = -1;
+            goto done;
         }
         ++ip;
-        break;
-      case RET:
-        RT_CHECK(callstack > 0);
-        RT_CHECK(stackframe > 0);
+        NEXT();
+      CASE(RET)
         ip = CALLSTACK[--callstack];
         mem -= STACKFRAME[--stackframe];
-        break;
-      case ENTER:
-        RT_CHECK(stackframe < MAX_STACK_DEPTH);
-        // n args
-        r = instruction->arg & 0xFFFFFFFF;
+        NEXT();
+      CASE(ENTER)
+        // n args, bit 31 tells whether the function returns a value
+        r = instruction->arg & 0x7FFFFFFF;
         // n locals
         l = instruction->arg >> 32;
+        if (stackframe == state.frames_capacity || mem + r + l >= state.memory_capacity ||
+            stack + max_depth > state.stack_capacity) {
+          if (!reserve_frames(&state, stackframe + 1, mem + r + l + 1, stack + max_depth)) {
+            puts("Stack overflow, the limits are set with --call-limit and --stack-limit\n");
+            ret = -1;
+            goto done;
+          }
+          STACK = state.stack;
+          CALLSTACK = state.callstack;
+          STACKFRAME = state.stackframe;
+          MEMORY = state.memory;
+        }
         STACKFRAME[stackframe++] = r + l;
         mem += r + l;
 
-        RT_CHECK(r <= stack);
-        RT_CHECK(mem < MAX_MEM);
         for (Int i = 0; i < r; ++i) {
           MEMORY[mem - i] = STACK[--stack];
         }
+        // list variables are 0 until their first store, the memory may hold
+        // a returned frame
+        for (Int i = r; i < r + l; ++i) {
+          MEMORY[mem - i] = 0;
+        }
         ++ip;
-        break;
-      case LEAVE:
+        NEXT();
+      CASE(LEAVE)
         puts("Reached LEAVE instruction\n");
-        return -1;
-      default:
+        ret = -1;
+        goto done;
+      CASE_DEFAULT
         puts("Unknown opcode ");
-        sys_print(instruction->opcode);
-        return -1;
-    }
+        sys_print(instructions[ip].opcode);
+        ret = -1;
+        goto done;
   }
 
-  return -1;
-}
+#ifdef THREADED_DISPATCH
+END_HANDLER:
+#endif
+  ret = -1;
 
-#ifdef _WIN32
-#define WINAPI __stdcall
-extern Byte* WINAPI GetCommandLineA();
-#define cli_args() GetCommandLineA()
-#else
-#error "No runtime for platform"
+done:
+#ifdef PROFILE
+  write_profile(&profile, n);
+  profile_free(&profile);
+#endif
+#ifdef THREADED_DISPATCH
+  heap_free((Byte*)code);
 #endif
+  free_state(&state);
+  return ret;
+}
 
-static Byte* parse_args(void) {
-  Byte* args = cli_args();
-  while (*args && *args != ' ') {
-    ++args;
+static Byte* next_arg(Byte** args) {
+  Byte* arg = *args;
+  while (*arg == ' ') {
+    ++arg;
   }
-
-  if (!*args) {
+  if (!*arg) {
     return NULL;
   }
 
+  Byte* end = arg;
+  while (*end && *end != ' ') {
+    ++end;
+  }
+  // the command line is split in place
+  *args = *end ? end + 1 : end;
+  *end = 0;
+  return arg;
+}
 
-  while (*args && *args == ' ') {
-    ++args;
+static Bool equals(const Byte* a, const Byte* b) {
+  while (*a && *a == *b) {
+    ++a;
+    ++b;
   }
+  return *a == *b;
+}
 
-  Byte* filename = args;
-  while (*args && *args != ' ') {
-    ++args;
+static Bool parse_limit(Byte* arg, Int* limit) {
+  if (!arg || !*arg) {
+    return false;
   }
 
-  if (*args) {
-    // We should have only one argument
-    return NULL;
+  Int val = 0;
+  for (; *arg; ++arg) {
+    if (*arg < '0' || *arg > '9' || val > (1LL << 40)) {
+      return false;
+    }
+    val = val * 10 + (*arg - '0');
+  }
+  *limit = val;
+  return val > 0;
+}
+
+// vm [--call-limit frames] [--stack-limit words] <filename>
+static Byte* parse_args(void) {
+  Byte* args = command_line();
+  // the name of the program
+  next_arg(&args);
+
+  Byte* filename = NULL;
+  for (Byte* arg = next_arg(&args); arg; arg = next_arg(&args)) {
+    if (equals(arg, "--call-limit")) {
+      if (!parse_limit(next_arg(&args), &LIMITS.max_frames)) {
+        return NULL;
+      }
+    }
+    else if (equals(arg, "--stack-limit")) {
+      if (!parse_limit(next_arg(&args), &LIMITS.max_stack)) {
+        return NULL;
+      }
+      LIMITS.max_memory = LIMITS.max_stack;
+    }
+    else if (filename) {
+      // We should have only one file
+      return NULL;
+    }
+    else {
+      filename = arg;
+    }
   }
 
   return filename;
 }
 
+// Files start with MAGIC and a 2 byte tag, see Program.serialize in
+// bc/instruction.py for the layout of both versions. Version 1 files are used
+// as they are mapped, with the bits of ENTER whether a function returns a value
+// set by infer_returns, version 2 files are decoded into instructions.
 static const Byte MAGIC[] = {
-    '.', 'n', 'o', 'x', 'b', 'c', '-', '-'
+    '.', 'n', 'o', 'x', 'b', 'c'
 };
+static const Byte MAGIC_V1[] = {'-', '-'};
 
-#define HEADER_SIZE (sizeof(MAGIC) + sizeof(Int))
-static_assert(HEADER_SIZE == sizeof(Instruction));
+#define TAG_SIZE 2
 
-static Bool check_magic(Byte* data) {
-  for (Int i = 0; i < sizeof(MAGIC); ++i) {
-    if (data[i] != MAGIC[i]) {
+// magic, globals and entrypoint
+#define V1_HEADER_SIZE (sizeof(MAGIC) + TAG_SIZE + 2 * 4)
+static_assert(V1_HEADER_SIZE % sizeof(Instruction) == 0);
+
+// offsets of the 4 byte fields of the version 2 header
+enum {
+  V2_GLOBALS      = 8,
+  V2_ENTRY        = 12,
+  V2_MAX_DEPTH    = 16,
+  V2_MAX_FRAME    = 20,
+  V2_INSTRUCTIONS = 24,
+  V2_CODE_SIZE    = 28,
+  V2_CONSTANTS    = 32,
+  V2_FUNCTIONS    = 36,
+  V2_NAMES_SIZE   = 40,
+  V2_HEADER_SIZE  = 48
+};
+
+// how the operand of a version 2 instruction follows its opcode, in the top
+// two bits of the opcode byte
+enum {
+  ARG_NONE  = 0,
+  ARG_I8    = 1,
+  ARG_I32   = 2,
+  ARG_CONST = 3
+};
+
+typedef struct {
+  Instruction* instructions;
+  Int n;
+  Int entrypoint;
+  Int globals;
+  // from the header of version 2, version 1 takes them from verify
+  Bool has_limits;
+  Int max_depth;
+  Int max_frame;
+  // decoded instructions are freed after the run
+  Bool decoded;
+} Bytecode;
+
+static Bool check_magic(const Byte* data, const Byte* magic, Int size) {
+  for (Int i = 0; i < size; ++i) {
+    if (data[i] != magic[i]) {
       return false;
     }
   }
@@ -391,6 +872,438 @@ static Bool check_magic(Byte* data) {
   return true;
 }
 
+// little endian, sign extended when is_signed
+static Int read_int(const Byte* data, Int size, Bool is_signed) {
+  Int val = 0;
+  for (Int i = size - 1; i >= 0; --i) {
+    val = val << 8 | data[i];
+  }
+  if (is_signed && size < sizeof(Int)) {
+    Int shift = 8 * (sizeof(Int) - size);
+    val = (Int)((unsigned long long)val << shift) >> shift;
+  }
+  return val;
+}
+
+// returns what is invalid or NULL
+static const Byte* load_v1(const Byte* data, Int size, Bytecode* bytecode) {
+  if (size < V1_HEADER_SIZE || (size - V1_HEADER_SIZE) % sizeof(Instruction) != 0) {
+    return "size";
+  }
+
+  const Byte* header = data + sizeof(MAGIC) + TAG_SIZE;
+  bytecode->globals = read_int(header, 4, false);
+  bytecode->entrypoint = read_int(header + 4, 4, false);
+  bytecode->instructions = (Instruction*)(data + V1_HEADER_SIZE);
+  bytecode->n = (size - V1_HEADER_SIZE) / sizeof(Instruction);
+  // every global is used by an instruction
+  if (bytecode->globals > bytecode->n) {
+    return "globals";
+  }
+  return NULL;
+}
+
+static const Byte* load_v2(const Byte* data, Int size, Bytecode* bytecode) {
+  if (size < V2_HEADER_SIZE) {
+    return "size";
+  }
+
+  bytecode->globals = read_int(data + V2_GLOBALS, 4, false);
+  bytecode->entrypoint = read_int(data + V2_ENTRY, 4, false);
+  bytecode->has_limits = true;
+  bytecode->max_depth = read_int(data + V2_MAX_DEPTH, 4, false);
+  bytecode->max_frame = read_int(data + V2_MAX_FRAME, 4, false);
+  bytecode->n = read_int(data + V2_INSTRUCTIONS, 4, false);
+  Int code_size = read_int(data + V2_CODE_SIZE, 4, false);
+  Int n_constants = read_int(data + V2_CONSTANTS, 4, false);
+  Int n_functions = read_int(data + V2_FUNCTIONS, 4, false);
+  Int names_size = read_int(data + V2_NAMES_SIZE, 4, false);
+
+  const Byte* constants = data + V2_HEADER_SIZE;
+  const Byte* functions = constants + 8 * n_constants;
+  const Byte* code = functions + 8 * n_functions + names_size;
+  const Byte* end = code + code_size;
+  // every instruction takes at least a byte, every global is used by one
+  if (end != data + size || bytecode->n > code_size || bytecode->globals > bytecode->n) {
+    return "size";
+  }
+
+  Instruction* instructions = (Instruction*)heap_alloc(bytecode->n * sizeof(Instruction));
+  if (!instructions) {
+    return "out of memory";
+  }
+  bytecode->instructions = instructions;
+  bytecode->decoded = true;
+
+  for (Int i = 0; i < bytecode->n; ++i) {
+    if (code == end) {
+      return "code";
+    }
+    Byte width = *code >> 6;
+    instructions[i].opcode = *code++ & 0x3F;
+    Int operand_size = width == ARG_NONE ? 0 : width == ARG_I8 ? 1 : 4;
+    if (end - code < operand_size) {
+      return "code";
+    }
+
+    if (width == ARG_CONST) {
+      Int index = read_int(code, 4, false);
+      if (index >= n_constants) {
+        return "constant pool";
+      }
+      instructions[i].arg = read_int(constants + 8 * index, 8, true);
+    }
+    else {
+      instructions[i].arg = read_int(code, operand_size, true);
+    }
+    code += operand_size;
+  }
+  if (code != end) {
+    return "code";
+  }
+
+  for (Int i = 0; i < n_functions; ++i) {
+    Int start = read_int(functions + 8 * i, 4, false);
+    Int name = read_int(functions + 8 * i + 4, 4, false);
+    if (start >= bytecode->n || instructions[start].opcode != ENTER || name >= names_size) {
+      return "function table";
+    }
+  }
+  return NULL;
+}
+
+// Load time verification, the checks of Program.verify in bc/instruction.py.
+// Code that passes can't leave its stacks, frame, globals or function, so
+// run_code doesn't check the instructions it executes.
+typedef struct {
+  const Byte* error;
+  // the failing instruction
+  Int at;
+  Int max_depth;
+  Int max_frame;
+} Verification;
+
+typedef struct {
+  Int pops;
+  Int pushes;
+} Effect;
+
+static Bool syscall_effect(Int number, Effect* effect) {
+  switch (number) {
+    case SYS_LIST:
+    case SYS_LIVE_LISTS:
+    case SYS_LIVE_BYTES:
+    case SYS_INPUT:
+      *effect = (Effect){0, 1};
+      return true;
+    case SYS_LIST_LEN:
+      *effect = (Effect){1, 1};
+      return true;
+    case SYS_LIST_CLEAR:
+    case SYS_LIST_REF:
+    case SYS_LIST_UNREF:
+    case SYS_PRINT:
+    case SYS_EXIT:
+      *effect = (Effect){1, 0};
+      return true;
+    case SYS_LIST_GET:
+      *effect = (Effect){2, 1};
+      return true;
+    case SYS_LIST_PUSH:
+      *effect = (Effect){2, 0};
+      return true;
+    case SYS_LIST_SET:
+      *effect = (Effect){3, 0};
+      return true;
+    case SYS_LIST_SLICE:
+      *effect = (Effect){3, 1};
+      return true;
+    default:
+      return false;
+  }
+}
+
+static Bool is_jump(Byte opcode) {
+  return opcode == JMP || opcode == JZ || opcode == JNZ || (opcode >= JLT && opcode <= JNE);
+}
+
+// values an instruction pops from and pushes to the operand stack, false for
+// an unknown syscall. The target of a CALL has to be an ENTER.
+static Bool stack_effect(const Instruction* instructions, const Instruction* instruction, Effect* effect) {
+  Int arg;
+  switch (instruction->opcode) {
+    case LOAD:
+    case GLOAD:
+    case CONST:
+      *effect = (Effect){0, 1};
+      return true;
+    case STORE:
+    case GSTORE:
+    case JZ:
+    case JNZ:
+      *effect = (Effect){1, 0};
+      return true;
+    case JLT:
+    case JLE:
+    case JGT:
+    case JGE:
+    case JEQ:
+    case JNE:
+      *effect = (Effect){2, 0};
+      return true;
+    case CALL:
+      arg = instructions[instruction->arg].arg;
+      *effect = (Effect){arg & 0x7FFFFFFF, (arg >> 31) & 1};
+      return true;
+    case SYSCALL:
+      return syscall_effect(instruction->arg, effect);
+    case INC_LOCAL:
+    case LIST_PUSH_CONST:
+    case JMP:
+    case RET:
+    case ENTER:
+    case LEAVE:
+      *effect = (Effect){0, 0};
+      return true;
+    default:
+      // binary operators
+      *effect = (Effect){2, 1};
+      return true;
+  }
+}
+
+// Version 1 files don't tell whether a function returns a value (bit 31 of
+// ENTER), it's the stack height at its RET, see infer_returns in
+// bc/instruction.py. Sets the bits in place, verify checks the result.
+static Bool infer_returns(Instruction* instructions, Int n) {
+  // by the ENTER, -1 until it is known whether the function returns a value
+  Int* returns = (Int*)heap_alloc(n * sizeof(Int));
+  Int* heights = (Int*)heap_alloc(n * sizeof(Int));
+  Int* worklist = (Int*)heap_alloc(n * sizeof(Int));
+  Bool ok = returns && heights && worklist;
+  if (!ok) {
+    goto done;
+  }
+
+  for (Int i = 0; i < n; ++i) {
+    if (instructions[i].opcode == ENTER) {
+      instructions[i].arg &= ~((Int)1 << 31);
+      returns[i] = -1;
+    }
+  }
+
+  Bool changed = true;
+  while (changed) {
+    changed = false;
+    for (Int start = 0; start < n; ++start) {
+      if (instructions[start].opcode != ENTER || returns[start] >= 0) {
+        continue;
+      }
+      Int end = start + 1;
+      while (end < n && instructions[end - 1].opcode != LEAVE) {
+        ++end;
+      }
+      for (Int i = start; i < end; ++i) {
+        heights[i] = -1;
+      }
+
+      Int result = -1;
+      Bool blocked = false;
+      Int pending = 0;
+      if (start + 1 < end) {
+        heights[start + 1] = 0;
+        worklist[pending++] = start + 1;
+      }
+      while (pending) {
+        Int i = worklist[--pending];
+        const Instruction* instruction = instructions + i;
+        Int height = heights[i];
+        Effect effect;
+        if (instruction->opcode == RET) {
+          result = height;
+          break;
+        }
+        if (instruction->opcode == LEAVE || instruction->opcode > JNE) {
+          continue;
+        }
+        if (instruction->opcode == CALL) {
+          Int target = instruction->arg;
+          if (target < 0 || target >= n || instructions[target].opcode != ENTER) {
+            continue;
+          }
+          if (returns[target] < 0) {
+            blocked = true;
+            continue;
+          }
+        }
+        if (!stack_effect(instructions, instruction, &effect) || height < effect.pops) {
+          continue;
+        }
+        height += effect.pushes - effect.pops;
+
+        Int successors[2];
+        Int n_successors = 0;
+        if (is_jump(instruction->opcode) && instruction->arg > start && instruction->arg < end) {
+          successors[n_successors++] = instruction->arg;
+        }
+        if (instruction->opcode != JMP && i + 1 < end) {
+          successors[n_successors++] = i + 1;
+        }
+        for (Int j = 0; j < n_successors; ++j) {
+          if (heights[successors[j]] < 0) {
+            heights[successors[j]] = height;
+            worklist[pending++] = successors[j];
+          }
+        }
+      }
+
+      if (result >= 0 || !blocked) {
+        returns[start] = result == 1;
+        if (returns[start]) {
+          instructions[start].arg |= (Int)1 << 31;
+        }
+        changed = true;
+      }
+    }
+  }
+
+done:
+  heap_free((Byte*)returns);
+  heap_free((Byte*)heights);
+  heap_free((Byte*)worklist);
+  return ok;
+}
+
+#define VERIFY(cond, i, message) \
+  do {                           \
+    if (!(cond)) {               \
+      result.error = message;    \
+      result.at = i;             \
+      goto done;                 \
+    }                            \
+  } while (0)
+
+static Verification verify(Instruction* instructions, Int n, Int entrypoint, Int globals) {
+  Verification result = {0};
+  // operand stack height before every instruction, -1 until it is reached
+  Int* heights = (Int*)heap_alloc(n * sizeof(Int));
+  Int* worklist = (Int*)heap_alloc(n * sizeof(Int));
+  if (!heights || !worklist) {
+    result.error = "out of memory";
+    goto done;
+  }
+
+  // functions run from ENTER to LEAVE and don't nest
+  Int start = -1;
+  for (Int i = 0; i < n; ++i) {
+    Byte opcode = instructions[i].opcode;
+    VERIFY(opcode <= JNE, i, "unknown opcode");
+    if (opcode == ENTER) {
+      VERIFY(start < 0, i, "function without LEAVE");
+      Int n_locals = instructions[i].arg >> 32;
+      VERIFY(n_locals >= 0, i, "invalid frame");
+      start = i;
+    }
+    else if (opcode == LEAVE) {
+      VERIFY(start >= 0, i, "LEAVE outside of a function");
+      start = -1;
+    }
+    else {
+      VERIFY(start >= 0, i, "instruction outside of a function");
+    }
+    heights[i] = -1;
+  }
+  VERIFY(start < 0, start, "function without LEAVE");
+  VERIFY(entrypoint >= 0 && entrypoint < n && instructions[entrypoint].opcode == ENTER &&
+         (instructions[entrypoint].arg & 0x7FFFFFFF) == 0, entrypoint, "invalid entrypoint");
+
+  for (start = 0; start < n; ++start) {
+    if (instructions[start].opcode != ENTER) {
+      continue;
+    }
+    Int end = start + 1;
+    while (instructions[end - 1].opcode != LEAVE) {
+      ++end;
+    }
+
+    Int arg = instructions[start].arg;
+    Int returns_value = (arg >> 31) & 1;
+    Int frame = (arg & 0x7FFFFFFF) + (arg >> 32);
+    if (frame > result.max_frame) {
+      result.max_frame = frame;
+    }
+
+    Int pending = 0;
+    heights[start + 1] = 0;
+    worklist[pending++] = start + 1;
+    while (pending) {
+      Int i = worklist[--pending];
+      Instruction* instruction = instructions + i;
+      Int height = heights[i];
+      Int local = instruction->arg;
+      Effect effect = {0, 0};
+
+      switch (instruction->opcode) {
+        case INC_LOCAL:
+        case LIST_PUSH_CONST:
+          local &= 0xFFFFFFFF;
+          // fallthrough
+        case LOAD:
+        case STORE:
+          VERIFY(local >= 0 && local < frame, i, "local out of the frame");
+          break;
+        case GLOAD:
+        case GSTORE:
+          VERIFY(instruction->arg >= 0 && instruction->arg < globals, i, "unknown global");
+          break;
+        case CALL:
+          VERIFY(instruction->arg >= 0 && instruction->arg < n &&
+                 instructions[instruction->arg].opcode == ENTER, i, "call of a non-function");
+          VERIFY(instruction->arg != entrypoint, i, "call of the entrypoint");
+          break;
+        case RET:
+          VERIFY(start != entrypoint, i, "return from the entrypoint");
+          VERIFY(height == returns_value, i, "unbalanced stack at return");
+          break;
+      }
+      VERIFY(stack_effect(instructions, instruction, &effect), i, "unknown syscall");
+
+      VERIFY(height >= effect.pops, i, "stack underflow");
+      height += effect.pushes - effect.pops;
+      if (height > result.max_depth) {
+        result.max_depth = height;
+      }
+
+      Int successors[2];
+      Int n_successors = 0;
+      if (is_jump(instruction->opcode)) {
+        VERIFY(instruction->arg > start && instruction->arg < end, i, "jump out of the function");
+        successors[n_successors++] = instruction->arg;
+      }
+      if (instruction->opcode != JMP && instruction->opcode != RET && instruction->opcode != LEAVE) {
+        successors[n_successors++] = i + 1;
+      }
+      for (Int j = 0; j < n_successors; ++j) {
+        Int successor = successors[j];
+        if (heights[successor] < 0) {
+          heights[successor] = height;
+          worklist[pending++] = successor;
+        }
+        else {
+          VERIFY(heights[successor] == height, successor, "different stack heights");
+        }
+      }
+    }
+  }
+
+done:
+  heap_free((Byte*)heights);
+  heap_free((Byte*)worklist);
+  return result;
+}
+
+#undef VERIFY
+
 static Int run(const Byte* filename) {
   Handle file = open(filename);
   if (!file) {
@@ -410,27 +1323,68 @@ static Int run(const Byte* filename) {
     return -1;
   }
 
-  if (size < HEADER_SIZE || !check_magic(code)) {
+  if (size < sizeof(MAGIC) + TAG_SIZE || !check_magic(code, MAGIC, sizeof(MAGIC))) {
     puts("Invalid or corrupted file (magic)\n");
     return -1;
   }
 
-  if ((size - HEADER_SIZE) % sizeof(Instruction) != 0) {
-    puts("Invalid or corrupted file (size)\n");
+  Bytecode bytecode = {0};
+  const Byte* tag = code + sizeof(MAGIC);
+  const Byte* error;
+  if (check_magic(tag, MAGIC_V1, TAG_SIZE)) {
+    error = load_v1(code, size, &bytecode);
+  }
+  else if (read_int(tag, TAG_SIZE, false) == 2) {
+    error = load_v2(code, size, &bytecode);
+  }
+  else {
+    puts("Unsupported bytecode version\n");
+    return -1;
+  }
+
+  if (!error && bytecode.entrypoint >= bytecode.n) {
+    error = "entrypoint";
+  }
+  if (error) {
+    puts("Invalid or corrupted file (");
+    puts(error);
+    puts(")\n");
     return -1;
   }
 
-  Int entrypoint = *(Int*)(code + sizeof(MAGIC));
-  Int globals = entrypoint & 0xFFFFFFFF;
-  entrypoint >>= 32;
-  Instruction* instructions = (Instruction*)(code + HEADER_SIZE);
-  Int n = size / sizeof(Instruction);
-  if (entrypoint >= n) {
-    puts("Invalid or corrupted file (entrypoint)\n");
+  Instruction* instructions = bytecode.instructions;
+  Int n = bytecode.n;
+  Int entrypoint = bytecode.entrypoint;
+  Int globals = bytecode.globals;
+
+  // the file is mapped copy on write, the bits don't go back to it
+  if (!bytecode.has_limits && !infer_returns(instructions, n)) {
+    puts("Failed to allocate the inference of returns\n");
     return -1;
   }
 
-  Int ret = run_code(instructions, n, entrypoint, globals);
+  Verification verification = verify(instructions, n, entrypoint, globals);
+  if (verification.error) {
+    puts("Invalid bytecode at ip=");
+    sys_print(verification.at);
+    puts(verification.error);
+    puts("\n");
+    return -1;
+  }
+
+  // a version 2 header records the limits the compiler verified
+  Int max_depth = bytecode.has_limits ? bytecode.max_depth : verification.max_depth;
+  Int max_frame = bytecode.has_limits ? bytecode.max_frame : verification.max_frame;
+  if (max_depth != verification.max_depth || max_frame != verification.max_frame ||
+      max_depth > LIMITS.max_stack || max_frame > LIMITS.max_memory) {
+    puts("Invalid or corrupted file (stack limits)\n");
+    return -1;
+  }
+
+  Int ret = run_code(instructions, n, entrypoint, globals, max_depth, max_frame);
+  if (bytecode.decoded) {
+    heap_free((Byte*)instructions);
+  }
   munmap(code);
   close(file);
   return ret;
@@ -441,7 +1395,7 @@ int main(void) {
 
   Byte* filename = parse_args();
   if (!filename) {
-    puts("Usage: vm <filename>\n");
+    puts("Usage: vm [--call-limit frames] [--stack-limit words] <filename>\n");
     sys_exit(-1);
   }
 
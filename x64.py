@@ -1,11 +1,12 @@
 import os
-import sys
+import io
+import concurrent.futures
 
 from dataclasses import dataclass, field, replace
 from enum import Enum, auto
 
 import bc
-from bc import Op, Instruction, Label, Program, Fn, syscall
+from bc import Op, Instruction, Label, Program, Fn, syscall, cfg
 
 
 def try_find(xs, val):
@@ -39,7 +40,7 @@ class Reg(Enum):
         s = str(self)
         if s[1].isdigit():
             return s + 'b'
-        elif s[1] in 'abcd':
+        elif s[2] == 'x':
             return s[1] + 'l'
         else:
             return s[1:] + 'l'
@@ -60,12 +61,30 @@ if os.name == 'nt':
     # win64 calling convention
     # see https://docs.microsoft.com/en-us/cpp/build/x64-calling-convention
     shadow_space = 32
+    red_zone = 0
     args_regs = [Reg.RCX, Reg.RDX, Reg.R8, Reg.R9]
     volatile_regs = [Reg.RAX] + args_regs + [Reg.R10, Reg.R11]
-    # TODO: use a set of regs as storage for local variables?
+    callee_saved_regs = [Reg.RBX, Reg.RSI, Reg.RDI, Reg.R12, Reg.R13, Reg.R14, Reg.R15]
+    # variables (args are moved out of args_regs in the prologue) are kept in
+    # callee-saved regs, the rest of stack_regs is left for the expression stack
+    variables_regs = [Reg.R12, Reg.R13, Reg.R14, Reg.R15, Reg.RBX]
+    stack_regs = set(Reg) - set(args_regs) - set(special_regs)
+elif os.name == 'posix':
+    # System V AMD64 ABI
+    # see https://gitlab.com/x86-psABIs/x86-64-ABI
+    shadow_space = 0
+    # leaf functions may keep their stack frame below rsp
+    red_zone = 128
+    args_regs = [Reg.RDI, Reg.RSI, Reg.RDX, Reg.RCX, Reg.R8, Reg.R9]
+    volatile_regs = [Reg.RAX] + args_regs + [Reg.R10, Reg.R11]
+    callee_saved_regs = [Reg.RBX, Reg.R12, Reg.R13, Reg.R14, Reg.R15]
+    variables_regs = [Reg.R12, Reg.R13, Reg.R14, Reg.R15]
     stack_regs = set(Reg) - set(args_regs) - set(special_regs)
 else:
-    assert False, 'Compiler does not support target {os.name}'
+    assert False, f'Compiler does not support target {os.name}'
+
+# rsp has to be aligned at every call
+stack_alignment = 16
 
 @dataclass
 class StackLocation:
@@ -76,10 +95,61 @@ class StackLocation:
         offset = abs(self.offset) * word_size
         return f'qword [{Reg.RBP}{sign}{offset}]'
 
+@dataclass
+class GlobalLocation:
+    name: str
+
+    def __str__(self):
+        return f'[rel {self.name}]'
+
+@dataclass
+class MemoryLocation:
+    base: Reg
+    index: Reg = None
+    offset: int = 0
+
+    def __str__(self):
+        index = f'+{self.index}*{word_size}' if self.index is not None else ''
+        offset = f'+{self.offset}' if self.offset else ''
+        return f'qword [{self.base}{index}{offset}]'
+
+
+# field offsets of List from rt/list.h
+list_data = 1 * word_size
+list_size = 2 * word_size
+
+
+# The listing is kept as a list of lines and instructions (op plus operand
+# objects), so it can be inspected and rewritten before it is printed.
+
+@dataclass
+class Asm:
+    __slots__ = ('op', 'operands')
+
+    op: str
+    operands: tuple
+
+    def __str__(self):
+        return f'    {self.op:<7} {", ".join(str(operand) for operand in self.operands)}'
+
+@dataclass
+class Line:
+    __slots__ = ('text')
+
+    text: str
+
+    def __str__(self):
+        return self.text
+
 
-base_listing = 'global main\n\n' + \
-                'extern sys_setup\n' + \
-    '\n'.join(f'extern sys_{syscall.name}' for _, syscall in syscall.enumerate()) + '\n\n'
+def base_listing():
+    return [
+        Line('global main'),
+        Line(''),
+        Line('extern sys_setup'),
+        *(Line(f'extern sys_{syscall.name}') for _, syscall in syscall.enumerate()),
+        Line(''),
+    ]
 
 
 def binop(op):
@@ -87,10 +157,10 @@ def binop(op):
         r = self.pop()
         l = self.pop()
         if type(l) is not Reg:
-            self.asm(f'mov {tmp_reg}, {l}')
-        self.asm(f'{op} {l if type(l) is Reg else tmp_reg}, {r}')
+            self.asm('mov', tmp_reg, l)
+        self.asm(op, l if type(l) is Reg else tmp_reg, r)
         if type(l) is not Reg:
-            self.asm(f'mov {l}, {tmp_reg}')
+            self.asm('mov', l, tmp_reg)
         self.push(l)
 
     return handler
@@ -99,10 +169,10 @@ def divmod_op(result):
     def handler(self):
         r = self.pop()
         l = self.pop()
-        self.asm(f'mov {Reg.RAX}, {l}')
-        self.asm(f'cqo')
-        self.asm(f'idiv {r}')
-        self.asm(f'mov {l}, {result}')
+        self.asm('mov', Reg.RAX, l)
+        self.asm('cqo')
+        self.asm('idiv', r)
+        self.asm('mov', l, result)
         self.push(l)
     return handler
 
@@ -112,14 +182,14 @@ def comparison(op):
         l = self.pop()
         dst = l
         if type(l) is not Reg:
-            self.asm(f'mov {tmp_reg}, {l}')
+            self.asm('mov', tmp_reg, l)
             dst = tmp_reg
 
-        self.asm(f'cmp {dst}, {r}')
-        self.asm(f'{op} {dst.r8()}')
-        self.asm(f'and {dst}, 0x1')
+        self.asm('cmp', dst, r)
+        self.asm(op, dst.r8())
+        self.asm('and', dst, '0x1')
         if type(l) is not Reg:
-            self.asm(f'mov {l}, {tmp_reg}')
+            self.asm('mov', l, tmp_reg)
         self.push(l)
     return handler
 
@@ -127,10 +197,21 @@ def cjump(op):
     def handler(self, label):
         val = self.pop()
         if type(val) is not Reg:
-            self.asm(f'mov {tmp_reg}, {val}')
+            self.asm('mov', tmp_reg, val)
             val = tmp_reg
-        self.asm(f'test {val}, {val}')
-        self.asm(f'{op} {label}')
+        self.asm('test', val, val)
+        self.asm(op, label)
+    return handler
+
+def cmp_jump(op):
+    def handler(self, label):
+        r = self.pop()
+        l = self.pop()
+        if type(l) is not Reg:
+            self.asm('mov', tmp_reg, l)
+            l = tmp_reg
+        self.asm('cmp', l, r)
+        self.asm(op, label)
     return handler
 
 def logical_binop(op):
@@ -139,53 +220,159 @@ def logical_binop(op):
         l = self.pop()
         for val in r, l:
             if type(val) is not Reg:
-                self.asm(f'mov {tmp_reg}, {val}')
+                self.asm('mov', tmp_reg, val)
                 reg = tmp_reg
             else:
                 reg = val
-            self.asm(f'test {reg}, {reg}')
-            self.asm(f'setne {reg.r8()}')
+            self.asm('test', reg, reg)
+            self.asm('setne', reg.r8())
             if type(val) is not Reg:
-                self.asm(f'mov {val}, {tmp_reg}')
+                self.asm('mov', val, tmp_reg)
 
         dst = l
         if type(l) is not Reg:
             dst = tmp_reg
 
-        self.asm(f'{op} {dst}, {r}')
-        self.asm(f'and {dst}, 0x1')
+        self.asm(op, dst, r)
+        self.asm('and', dst, '0x1')
         if type(l) is not Reg:
-            self.asm(f'mov {l}, {tmp_reg}')
+            self.asm('mov', l, tmp_reg)
 
         self.push(l)
     return handler
 
+
+def stack_pool(regs):
+    '''Orders the regs of the expression stack so callee-saved regs are taken
+    first (regs are taken from the end), values in them don't have to be
+    saved around calls'''
+    return sorted(regs, key=lambda reg: (reg not in volatile_regs, -reg.value))
+
+
+LOCAL_OPS = (Op.LOAD, Op.STORE, Op.INC_LOCAL, Op.LIST_PUSH_CONST)
+
+def live_intervals(graph):
+    '''Returns (first, last) position of every variable of the function and the
+    number of times it is used, weighted by the loop depth of the use.
+
+    Args and locals read before they are stored are live from the entry of
+    the function. A variable used anywhere in a loop is kept live for the
+    whole loop, since its value may be carried over the back edge.'''
+    fn = graph.fn
+    entry = graph.live_at_entry() | set(fn.args)
+    intervals = {}
+    weights = {}
+    extents = []
+    position = 0
+    for block in graph.blocks:
+        weight = 10 ** graph.loop_depth(block.index)
+        start = position
+        for instruction in block.instructions:
+            if instruction.op in LOCAL_OPS:
+                var = instruction.args[0]
+                first, _ = intervals.get(var, (0 if var in entry else position, position))
+                intervals[var] = (first, position)
+                weights[var] = weights.get(var, 0) + weight
+            position += 1
+        extents.append((start, position - 1))
+
+    # inner loops first, so an interval grown by one is seen by the loops around it
+    for loop in graph.loops:
+        start = min(extents[b][0] for b in loop.blocks)
+        end = max(extents[b][1] for b in loop.blocks)
+        for var, (first, last) in intervals.items():
+            if first <= end and last >= start:
+                intervals[var] = (min(first, start), max(last, end))
+
+    return intervals, weights
+
+
+def allocate_variables(graph, regs):
+    '''Linear scan over the live intervals of the variables. When regs run out
+    the variable with the smallest weight is spilled to the stack frame.
+
+    Returns the location of every variable and the number of stack slots used.'''
+    intervals, weights = live_intervals(graph)
+    free = list(reversed(regs))
+    active = []
+    locations = {}
+    spilled = []
+    for var in sorted(intervals, key=lambda var: intervals[var]):
+        first, _ = intervals[var]
+        for other in [v for v in active if intervals[v][1] < first]:
+            active.remove(other)
+            free.append(locations[other])
+
+        if free:
+            locations[var] = free.pop()
+            active.append(var)
+            continue
+
+        victim = min(active, key=lambda v: weights[v])
+        if weights[victim] < weights[var]:
+            active.remove(victim)
+            locations[var] = locations[victim]
+            active.append(var)
+            spilled.append(victim)
+        else:
+            spilled.append(var)
+
+    for i, var in enumerate(spilled):
+        locations[var] = StackLocation(-1 - i)
+    return locations, len(spilled)
+
+
 @dataclass
 class Compiler:
     program: Program
     max_stack_depth: int = field(default=None)
     current: str = field(default=None)
-
-    regs: list = field(default_factory=lambda: sorted(stack_regs, key=lambda x: x.value, reverse=True))
+    # location of every variable of the current function
+    variables: dict = field(default_factory=dict)
+    # number of stack slots taken by spilled variables
+    n_slots: int = field(default=0)
+    # regs written by the current function
+    used: set = field(default_factory=set)
+    # position of the listing where callee-saved regs are stored
+    prologue: int = field(default=None)
+    # the current function doesn't call other functions
+    leaf: bool = field(default=True)
+
+    regs: list = field(default_factory=lambda: stack_pool(stack_regs))
     stack: list = field(default_factory=list)
-    listing: str = field(default=base_listing)
+    listing: list = field(default_factory=base_listing)
+    # out of line code of the current function, emitted after its epilogue
+    stubs: list = field(default_factory=list)
 
-    def compile(self):
+    def compile(self, workers=1):
         if len(self.program.globals):
             self.line('section .data')
             for var in self.program.globals:
-                self.asm(f'{var:<8} dq 0')
+                self.line(f'    {var:<7} dq 0')
             self.line('')
 
         fns = sorted(self.program.functions.values(), key=lambda f: f.start)
         self.line('section .text')
-        for f in fns:
-            self.compile_function(f)
+        if workers > 1 and len(fns) > 1:
+            self.listing += compile_parallel(self.program, fns, workers)
+        else:
+            for f in fns:
+                self.compile_function(f)
         return self.listing
 
+    def emit(self, file):
+        for line in self.listing:
+            file.write(f'{line}\n')
+
     def compile_function(self, fn):
         self.current = fn.name
-        self.max_stack_depth = len(fn.locals)
+        graph = cfg.Graph.build(self.program.source, fn)
+        self.variables, self.n_slots = allocate_variables(graph, variables_regs)
+        self.uninitialized = sorted(graph.live_at_entry() - set(fn.args))
+        self.max_stack_depth = self.n_slots
+        self.used = {loc for loc in self.variables.values() if type(loc) is Reg}
+        self.regs = stack_pool(stack_regs - self.used)
+        self.leaf = True
         self.line(fn.name + ':')
         for i in range(fn.start, fn.end):
             instruction = self.program.source[i]
@@ -198,96 +385,206 @@ class Compiler:
                 handler(*instruction.args)
 
     def compile_call(self, fn, shadow_space=0):
-        arg_regs_in_use = len(self.program.functions[self.current].args)
         n_args = len(fn.args)
         assert n_args <= len(args_regs), 'Too many args (pass through stack is not implemented yet)'
 
-        regs_to_save = [r for r in self.stack[:-n_args] if type(r) is Reg] + args_regs[:arg_regs_in_use]
+        # variables and values in callee-saved regs survive the call, only the
+        # values below the args that sit in volatile regs have to be saved
+        live = self.stack[:len(self.stack) - n_args]
+        regs_to_save = [r for r in live if r in volatile_regs]
         for reg in regs_to_save:
-            self.asm(f'push {reg}')
+            self.asm('push', reg)
 
         args = [self.pop() for _ in range(n_args)]
         for dst, src in zip(args_regs, args):
-            self.asm(f'mov {dst}, {src}')
+            self.asm('mov', dst, src)
 
-        if shadow_space:
-            self.asm(f'sub rsp, {shadow_space}')
+        # the stack frame keeps rsp aligned, pushes may not
+        padding = len(regs_to_save) * word_size % stack_alignment
+        if shadow_space + padding:
+            self.asm('sub', Reg.RSP, shadow_space + padding)
 
-        self.asm(f'call {fn.name}')
-        if shadow_space:
-            self.asm(f'add rsp, {shadow_space}')
+        self.asm('call', fn.name)
+        self.leaf = False
+        if shadow_space + padding:
+            self.asm('add', Reg.RSP, shadow_space + padding)
 
         if fn.returns_value:
             dst = self.allocate()
-            self.asm(f'mov {dst}, {Reg.RAX}')
+            self.asm('mov', dst, Reg.RAX)
 
         for reg in reversed(regs_to_save):
-            self.asm(f'pop {reg}')
+            self.asm('pop', reg)
 
     def call(self, label):
         self.compile_call(self.program.functions[label.name])
 
     def syscall(self, n):
         s = syscall.by_number(n)
-        self.compile_call(replace(s, name='sys_' + s.name), shadow_space=shadow_space)
+        inline = getattr(self, f'inline_{s.name}', None)
+        if inline is not None:
+            inline()
+        else:
+            self.compile_call(replace(s, name='sys_' + s.name), shadow_space=shadow_space)
+
+    # List accesses are inlined against the layout of List (rt/list.h), an
+    # index out of range jumps to a stub which calls the runtime to panic.
+    # Besides tmp_reg, rcx and rdx are free outside of compile_call.
+
+    def list_operands(self, *scratch):
+        operands = [self.pop() for _ in scratch]
+        return [
+            operand if type(operand) is Reg else self.move(reg, operand)
+            for operand, reg in zip(operands, scratch)
+        ]
+
+    def move(self, dst, src):
+        self.asm('mov', dst, src)
+        return dst
+
+    def bounds_check(self, fn, base, i, *rest):
+        stub = f'{self.current}.oob_{len(self.stubs)}'
+        # negative indices are above the size when compared as unsigned
+        self.asm('cmp', i, MemoryLocation(base, offset=list_size))
+        self.asm('jae', stub)
+
+        self.stubs.append(Line(f'{stub}:'))
+        # operands may sit in args regs, move them through the stack
+        operands = (base, i, *rest)
+        for src in operands:
+            self.stubs.append(Asm('push', (src,)))
+        for dst in reversed(args_regs[:len(operands)]):
+            self.stubs.append(Asm('pop', (dst,)))
+        if shadow_space:
+            self.stubs.append(Asm('sub', (Reg.RSP, shadow_space)))
+        self.stubs.append(Asm('call', (f'sys_{fn}',)))
+
+    def inline_list_get(self):
+        base, i = self.list_operands(tmp_reg, Reg.RDX)
+        self.bounds_check('list_get', base, i)
+        self.asm('mov', tmp_reg, MemoryLocation(base, offset=list_data))
+        dst = self.allocate()
+        if type(dst) is Reg:
+            self.asm('mov', dst, MemoryLocation(tmp_reg, i))
+        else:
+            self.asm('mov', tmp_reg, MemoryLocation(tmp_reg, i))
+            self.asm('mov', dst, tmp_reg)
+
+    def inline_list_set(self):
+        base, i, val = self.list_operands(tmp_reg, Reg.RDX, Reg.RCX)
+        self.bounds_check('list_set', base, i, val)
+        self.asm('mov', tmp_reg, MemoryLocation(base, offset=list_data))
+        self.asm('mov', MemoryLocation(tmp_reg, i), val)
+
+    def inline_len(self):
+        base, = self.list_operands(tmp_reg)
+        dst = self.allocate()
+        if type(dst) is Reg:
+            self.asm('mov', dst, MemoryLocation(base, offset=list_size))
+        else:
+            self.asm('mov', tmp_reg, MemoryLocation(base, offset=list_size))
+            self.asm('mov', dst, tmp_reg)
 
     def enter(self, fn_tag, *args):
         fn = self.program.functions[self.current]
+
+        # prologue
+        self.asm('push', Reg.RBP)
+        self.asm('mov', Reg.RBP, Reg.RSP)
+        self.asm('sub', Reg.RSP, f'{fn.name}_stackframe')
+        self.prologue = len(self.listing)
+
         if fn.name == 'main':
             # setup the runtime at the start of program
-            self.asm('call sys_setup')
+            self.compile_call(syscall.syscall('sys_setup', returns_value=False), shadow_space=shadow_space)
 
-        # prologue
-        self.asm(f'push {Reg.RBP}')
-        self.asm(f'mov {Reg.RBP}, {Reg.RSP}')
-        self.asm(f'sub {Reg.RSP}, {fn.name}_stackframe')
+        for i, var in enumerate(fn.args):
+            if var not in self.variables:
+                continue
+            if i < len(args_regs):
+                src = args_regs[i]
+            else:
+                # TODO: figure out what offset we should actually use
+                src = StackLocation(i + 2) # 1 for rbp, 1 for rip
+            dst = self.variables[var]
+            if type(dst) is Reg or type(src) is Reg:
+                self.asm('mov', dst, src)
+            else:
+                self.asm('mov', tmp_reg, src)
+                self.asm('mov', dst, tmp_reg)
+
+        # ENTER zeroes the locals, only the ones read before a store can tell
+        for var in self.uninitialized:
+            dst = self.variables[var]
+            if type(dst) is Reg:
+                self.asm('xor', dst, dst)
+            else:
+                self.asm('mov', dst, 0)
 
     def leave(self):
         fn = self.program.functions[self.current]
-        n_locals = len(fn.locals)
+        # only now the regs used by the function are known, store them below
+        # the rest of the stack frame
+        saved = [reg for reg in callee_saved_regs if reg in self.used]
+        slots = [StackLocation(-1 - self.max_stack_depth - i) for i in range(len(saved))]
+        self.max_stack_depth += len(saved)
+        self.listing[self.prologue:self.prologue] = [Asm('mov', (slot, reg)) for reg, slot in zip(saved, slots)]
+
+        frame = self.max_stack_depth * word_size
+        frame += -frame % stack_alignment
+        # a function without calls doesn't have to move rsp below its frame
+        in_red_zone = self.leaf and frame <= red_zone
+        if in_red_zone:
+            del self.listing[self.prologue - 1]
+
         self.line(f'{fn.name}_epilogue:')
-        self.asm(f'add {Reg.RSP}, {fn.name}_stackframe')
-        self.asm(f'pop {Reg.RBP}')
-        self.asm(f'ret')
-        self.line(f'{fn.name}_stackframe EQU {self.max_stack_depth * word_size}')
+        for reg, slot in zip(saved, slots):
+            self.asm('mov', reg, slot)
+        if not in_red_zone:
+            self.asm('add', Reg.RSP, f'{fn.name}_stackframe')
+        self.asm('pop', Reg.RBP)
+        self.asm('ret')
+        self.listing += self.stubs
+        self.stubs = []
+        self.line(f'{fn.name}_stackframe EQU {frame}')
 
     def load(self, var):
         loc = self.location(var)
         dst = self.allocate()
         if type(loc) is Reg or type(dst) is Reg:
-            self.asm(f'mov {dst}, {loc}')
+            self.asm('mov', dst, loc)
         else:
-            self.asm(f'mov {tmp_reg}, {loc}')
-            self.asm(f'mov {dst}, {tmp_reg}')
+            self.asm('mov', tmp_reg, loc)
+            self.asm('mov', dst, tmp_reg)
 
     def store(self, var):
         top = self.pop()
         loc = self.location(var)
         if type(loc) is Reg or type(top) is Reg:
-            self.asm(f'mov {loc}, {top}')
+            self.asm('mov', loc, top)
         else:
-            self.asm(f'mov {tmp_reg}, {top}')
-            self.asm(f'mov {loc}, {tmp_reg}')
+            self.asm('mov', tmp_reg, top)
+            self.asm('mov', loc, tmp_reg)
 
     def gload(self, var):
         dst = self.allocate()
         if type(dst) is Reg:
-            self.asm(f'mov {dst}, [rel {var}]')
+            self.asm('mov', dst, GlobalLocation(var))
         else:
-            self.asm(f'mov {tmp_reg}, [rel {var}]')
-            self.asm(f'mov {dst}, {tmp_reg}')
+            self.asm('mov', tmp_reg, GlobalLocation(var))
+            self.asm('mov', dst, tmp_reg)
 
     def gstore(self, var):
         top = self.pop()
         if type(top) is Reg:
-            self.asm(f'mov [rel {var}], {top}')
+            self.asm('mov', GlobalLocation(var), top)
         else:
-            self.asm(f'mov {tmp_reg}, {top}')
-            self.asm(f'mov [rel {var}], {tmp_reg}')
+            self.asm('mov', tmp_reg, top)
+            self.asm('mov', GlobalLocation(var), tmp_reg)
 
     def const(self, val):
         loc = self.allocate()
-        self.asm(f'mov {loc}, {val}')
+        self.asm('mov', loc, val)
 
     add = binop('add')
     sub = binop('sub')
@@ -306,26 +603,42 @@ class Compiler:
     ne = comparison('setne')
 
     def jmp(self, label):
-        self.asm(f'jmp {label}')
+        self.asm('jmp', label)
 
     jz  = cjump('jz')
     jnz = cjump('jnz')
 
+    jlt = cmp_jump('jl')
+    jle = cmp_jump('jle')
+    jgt = cmp_jump('jg')
+    jge = cmp_jump('jge')
+    jeq = cmp_jump('je')
+    jne = cmp_jump('jne')
+
+    def inc_local(self, var, val):
+        self.asm('add', self.location(var), val)
+
+    def list_push_const(self, var, val):
+        self.const(val)
+        self.load(var)
+        self.syscall(syscall.number_by_name('push'))
+
     def ret(self):
         fn = self.program.functions[self.current]
         if fn.returns_value:
             ret = self.pop()
-            self.asm(f'mov {Reg.RAX}, {ret}')
-        self.asm(f'jmp {fn.name}_epilogue')
+            self.asm('mov', Reg.RAX, ret)
+        self.asm('jmp', f'{fn.name}_epilogue')
 
     def allocate(self):
         if self.regs:
             operand = self.regs.pop()
+            self.used.add(operand)
         else:
             if self.stack and type(self.stack[-1]) is StackLocation:
                 offset = self.stack[-1].offset
             else:
-                offset = -1 - len(self.program.functions[self.current].locals)
+                offset = -1 - self.n_slots
             offset -= 1
             self.max_stack_depth = max(abs(offset), self.max_stack_depth)
             operand = StackLocation(offset)
@@ -345,34 +658,64 @@ class Compiler:
         operand = self.stack.pop()
         if type(operand) is Reg:
             assert operand in stack_regs
-            self.regs.append(operand)
+            # volatile regs go to the back of the pool, see stack_pool
+            if operand in volatile_regs:
+                self.regs.insert(0, operand)
+            else:
+                self.regs.append(operand)
         return operand
 
     def line(self, line):
-        self.listing += line + '\n'
+        self.listing.append(Line(line))
 
-    def asm(self, line):
-        instruction, *ops = line.split()
-        self.line(f'    {instruction:<7} {" ".join(ops)}')
+    def asm(self, op, *operands):
+        self.listing.append(Asm(op, operands))
 
     def location(self, var):
-        fn = self.program.functions[self.current]
-        i = try_find(fn.args, var)
-        if i is not None:
-            if i < len(args_regs):
-                return args_regs[i]
-            else:
-                offset = i - len(args_regs)
-                # TODO: figure out what offset we should actually use
-                return StackLocation(i + 2) # 1 for rbp, 1 for rip
-
-        i = try_find(fn.locals, var)
-        if i is not None:
-            return StackLocation(-1 - i)
+        if var in self.variables:
+            return self.variables[var]
 
         assert False, f'Unknown variable: {var}'
 
 
-def compile(program):
+# Functions compile independently: a function only reads its own part of
+# program.source and the signatures of the others, and the labels it adds are
+# prefixed with its name. Workers compile runs of consecutive functions with a
+# Compiler of their own and return them as text, which is joined in the order
+# of the functions, so the listing is the same as the serial one.
+
+# the program of a worker process, set by the initializer of the pool
+worker_program = None
+
+def init_worker(program):
+    global worker_program
+    worker_program = program
+
+def compile_run(names):
+    '''Listing of consecutive functions of worker_program, as text'''
+    compiler = Compiler(worker_program, listing=[])
+    for name in names:
+        compiler.compile_function(worker_program.functions[name])
+    return '\n'.join(str(line) for line in compiler.listing)
+
+def compile_parallel(program, fns, workers):
+    '''Listings of fns compiled in a pool of workers processes'''
+    # a few runs per worker keep them busy when functions differ in size
+    n_runs = min(len(fns), workers * 4)
+    runs = [[fn.name for fn in fns[i * len(fns) // n_runs:(i + 1) * len(fns) // n_runs]] for i in range(n_runs)]
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker, initargs=(program,)) as pool:
+        return [Line(text) for text in pool.map(compile_run, runs)]
+
+
+def compile(program, file=None, workers=1):
+    '''Returns the assembly listing of the program, or writes it to file.
+    With more than one worker the functions are compiled in processes.'''
     compiler = Compiler(program)
-    return compiler.compile()
\ No newline at end of file
+    compiler.compile(workers)
+    if file is not None:
+        compiler.emit(file)
+        return None
+
+    out = io.StringIO()
+    compiler.emit(out)
+    return out.getvalue()
\ No newline at end of file